@@ -1,5 +1,7 @@
 from .frontend import (
     list_subjects,
+    list_subject_codes,
+    load_tree,
     Subject,
     Session,
     Protocol,
@@ -9,5 +11,6 @@ from .frontend import (
     Electrodes,
     )
 from .backend import (
+    load_files,
     File,
     )
@@ -1,5 +1,6 @@
 from logging import getLogger
 from pathlib import Path
+from weakref import WeakValueDictionary
 
 from numpy import (
     array,
@@ -11,18 +12,21 @@ from numpy import (
     issubdtype,
     )
 from PyQt5.QtSql import QSqlQuery
-from PyQt5.QtCore import QVariant
-import sip
 
 from .utils import (
     collect_columns,
     get_dtypes,
     out_date,
     out_datetime,
+    prepared_query,
+    transaction,
     )
 
 lg = getLogger(__name__)
 
+# maximum number of values in one INSERT statement (SQLite has a limit of 999)
+MAX_PLACEHOLDERS = 900
+
 
 class Table():
     """General class to handle one row in a SQL table. End users should not
@@ -34,25 +38,106 @@ class Table():
         currently open database
     id : int
         row index for an unspecified table
+
+    Notes
+    -----
+    There is only one object for each row of the database (for each
+    connection): if an object for the same row is still in use, it is returned
+    instead of creating a new one (see `identity_map`), so that the row
+    snapshot and the preloaded children are shared. The row is checked every
+    time, so a row which does not exist anymore raises ValueError.
     """
     db = None  # instance of database
     t = ''
     columns = {}
+    _row = None  # snapshot of the values in the main table and subtables
+    _children = None  # preloaded children (see load_tree)
+    parent_level = None  # attribute pointing to the parent object
 
-    def __init__(self, db, id):
-        self.db = db
-        self.id = id
+    def __new__(cls, db, id=None, *args, **kwargs):
+        obj = identity_map(db).get((cls.t, id))
+        if obj is None:
+            obj = super().__new__(cls)
+        return obj
 
-        # check if it exists at all
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f'SELECT id FROM {self.t}s WHERE id = :id')
+    def __init__(self, db, id):
+        # check if it exists at all (also for the objects in use, because the
+        # row might have been deleted by ON DELETE CASCADE or by another
+        # connection)
+        query = prepared_query(db, f'SELECT id FROM {self.t}s WHERE id = :id')
         query.bindValue(':id', id)
         if not query.exec():
             raise SyntaxError(query.lastError().text())
-        if not query.next():
+        exists = query.next()
+        query.finish()
+        if not exists:
+            identity_map(db).pop((self.t, id), None)
             raise ValueError(f'Could not find id = {id} in table {self.t}s')
 
+        if 'columns' in self.__dict__:  # live object from the identity map
+            return
+
+        self.db = db
+        self.id = id
         self.columns = collect_columns(self.db, self.t)
+        identity_map(self.db)[(self.t, self.id)] = self
+
+    def refresh(self):
+        """Discard the row snapshot and the preloaded children, so that they
+        are read again from the database (f.e. when the row was modified by
+        another connection, by a trigger or after a rollback).
+        """
+        self._row = None
+        self._children = None
+
+    def _load_row(self):
+        """Read the row of the main table and the matching rows of the
+        subtables in one query and keep them in memory.
+
+        Returns
+        -------
+        dict
+            where the key is the column and the value is the python value
+        """
+        rows = load_rows(self.db, self.t, self.columns, ids=[self.id, ])
+        if self.id not in rows:
+            lg.warning(f"Could not get row from {self.t}s for id = '{self.id}'")
+            return {key: None for key in self.columns}
+        return rows[self.id]
+
+    @classmethod
+    def _from_tree(cls, db, id, columns, row=None):
+        """Create the object for a row which is known to exist (because its id
+        was just read from the database), without checking it again.
+
+        Parameters
+        ----------
+        db : dict
+            information about the database
+        id : int
+            row index
+        columns : dict
+            output of collect_columns, shared by all the objects of the level
+        row : dict
+            row snapshot (output of load_rows), if already available
+
+        Returns
+        -------
+        instance of Table
+            the live object for this row, if there is one, otherwise a new
+            object. If row is specified, it replaces the row snapshot.
+        """
+        objects = identity_map(db)
+        obj = objects.get((cls.t, id))
+        if obj is None:
+            obj = object.__new__(cls)
+            obj.db = db
+            obj.id = id
+            obj.columns = columns
+            objects[(cls.t, id)] = obj
+        if row is not None:
+            obj._row = row
+        return obj
 
     def __str__(self):
         return f'<{self.t} (#{self.id})>'
@@ -78,48 +163,28 @@ class Table():
         if not query.exec():
             raise SyntaxError(query.lastError().text())
 
+        identity_map(self.db).pop((self.t, self.id), None)
         self.id = None
+        self._row = None
 
-    def __getattr__(self, key):
+        # the parent needs to read its children again
+        if self.parent_level is not None:
+            parent = self.__dict__.get(self.parent_level)
+            if parent is not None:
+                parent._children = None
 
+    def __getattr__(self, key):
+        """Values are read from the row snapshot, which is loaded with one
+        query the first time that one of the attributes is accessed. Use
+        refresh() to read the values again from the database.
+        """
         if key not in self.columns:
             raise ValueError(f'{key} is not stored in this {self.t}')
 
-        table_name = self.columns[key]
-        id_name = 'id'
-        if table_name != (self.t + 's'):  # for subtables, use foreign key
-            id_name = f'{self.t}_id'
+        if self._row is None:
+            self._row = self._load_row()
 
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f"SELECT {key} FROM {table_name} WHERE {id_name} = :id")
-        query.bindValue(':id', self.id)
-
-        if not query.exec():
-            raise SyntaxError(query.lastError().text())
-
-        # we need to use QVariant, because QMYSQL in PyQt5 does not distinguish between null and 0.0
-        # see https://www.riverbankcomputing.com/static/Docs/PyQt5/pyqt_qvariant.html
-        autoconversion = sip.enableautoconversion(QVariant, False)
-        if query.next():
-            out = query.value(key)
-
-            if out.isNull():
-                out = None
-
-            elif self.db['tables'][table_name][key]['type'] == 'QDateTime':
-                out = out_datetime(self.db['db'].driverName(), out.value())
-
-            elif self.db['tables'][table_name][key]['type'] == 'QDate':
-                out = out_date(self.db['db'].driverName(), out.value())
-
-            else:
-                out = out.value()
-        else:
-            lg.warning(f"Could not get {key} from {table_name} for id = '{self.id}'")
-            out = None
-
-        sip.enableautoconversion(QVariant, autoconversion)
-        return out
+        return self._row[key]
 
     def __setattr__(self, key, value):
         """Set a value for a key at this row.
@@ -150,6 +215,10 @@ class Table():
             'data',
             'intendedfor',
             '_tb_data',
+            '_row',
+            '_children',
+            '_files',
+            '_codes',
             '__class__',
             )
 
@@ -166,6 +235,7 @@ class Table():
         if table_name != (self.t + 's'):  # for subtables, use foreign key
             id_name = f'{self.t}_id'
 
+        original_value = value
         if self.db['tables'][table_name][key]['type'] == 'QDate':
             value = _date(value)
         elif self.db['tables'][table_name][key]['type'] == 'QDateTime':
@@ -181,24 +251,47 @@ class Table():
             print(value)
             raise ValueError(query.lastError().text())
 
+        if self._row is None:
+            return
+
+        # the discriminator of a subtable might change which rows are relevant
+        if key in _subtable_parameters(self.db, self.t):
+            self._row = None
+            return
+
+        try:
+            self._row[key] = _snapshot_value(
+                self.db['tables'][table_name][key]['type'], original_value)
+        except (TypeError, ValueError):
+            self._row = None
+
 
 class Table_with_files(Table):
     """This class (which should be used by end-users) is useful when handling
     objects which might be associated with files.
     """
+    _files = None  # files, if they were read together with other objects (see load_files)
+
+    def refresh(self):
+        super().refresh()
+        self._files = None
+
     def list_files(self):
         """List all the files associated with this object
         """
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f"SELECT file_id FROM {self.t}s_files WHERE {self.t}_id = :id")
+        if self._files is not None:
+            return list(self._files)
+
+        query = prepared_query(self.db, f"SELECT file_id FROM {self.t}s_files WHERE {self.t}_id = :id")
         query.bindValue(':id', self.id)
         if not query.exec():
             raise SyntaxError(query.lastError().text())
 
-        out = []
+        file_ids = []
         while query.next():
-            out.append(File(self.db, query.value('file_id')))
-        return out
+            file_ids.append(query.value('file_id'))
+        query.finish()
+        return [File(self.db, file_id) for file_id in file_ids]
 
     def add_file(self, format, path):
         """Add a file to this object.
@@ -211,6 +304,7 @@ class Table_with_files(Table):
             path of the file (it does not need to exist)
         """
         path = Path(path).resolve()
+        self._files = None
 
         query = QSqlQuery(self.db['db'])
         query.prepare("SELECT id, format FROM files WHERE path = :path")
@@ -247,6 +341,7 @@ class Table_with_files(Table):
     def delete_file(self, file):
         """There should be a trigger that deletes the file when there are no pointers anymore
         """
+        self._files = None
         query = QSqlQuery(self.db['db'])
         query.prepare(f"DELETE FROM {self.t}s_files WHERE {self.t}_id = :id AND file_id = :file_id")
         query.bindValue(':id', self.id)
@@ -265,62 +360,62 @@ class NumpyTable(Table_with_files):
 
     @property
     def data(self):
-        dtypes = get_dtypes(self.db['tables'][self._tb_data])
-        query_str = ", ".join(f"`{col}`" for col in dtypes.names)
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f"SELECT {query_str} FROM {self._tb_data} WHERE {self.t}_id = :id")
-        query.bindValue(':id', self.id)
-        if not query.exec():
-            raise SyntaxError(query.lastError().text())
-
-        autoconversion = sip.enableautoconversion(QVariant, False)
-        values = []
-        while query.next():
-            row = []
-            for name in dtypes.names:
-                v = query.value(name)
-                if issubdtype(dtypes[name].type, floating) and v.isNull():
-                    row.append(nan)
-                else:
-                    row.append(v.value())
-
-            values.append(tuple(row))
-
-        sip.enableautoconversion(QVariant, autoconversion)
-        return array(values, dtype=dtypes)
+        return self.read_data()
 
     @data.setter
     def data(self, values):
         """If values is None, it deletes all the events.
+
+        Rows are inserted with multi-row prepared statements. NaN and empty
+        strings are not inserted, so that the column gets its default value.
         """
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f"DELETE FROM {self._tb_data} WHERE {self.t}_id = :id")
-        query.bindValue(':id', self.id)
-        if not query.exec():
-            raise SyntaxError(query.lastError().text())
+        with transaction(self.db):
+            query = QSqlQuery(self.db['db'])
+            query.prepare(f"DELETE FROM {self._tb_data} WHERE {self.t}_id = :id")
+            query.bindValue(':id', self.id)
+            if not query.exec():
+                raise SyntaxError(query.lastError().text())
 
-        if values is None:
-            return
+            if values is None:
+                return
 
-        for row in values:
-            column_str, values_str = _create_query(row)
-            query = QSqlQuery(self.db['db'])  # column_str depends on values as well (no column when value is NaN)
-            sql_cmd = f"""\
-                INSERT INTO {self._tb_data} (`{self.t}_id`, {column_str})
-                VALUES ('{self.id}', {values_str})
-                """
-            if not query.exec(sql_cmd):
-                raise ValueError(query.lastError().text())
+            _insert_present_columns(self.db, self._tb_data, f'{self.t}_id', self.id, values)
+
+    def read_data(self, primary_key=False):
+        """Read the rows of this group.
+
+        Parameters
+        ----------
+        primary_key : bool
+            if True, the array also contains the "id" of each row, which is
+            needed by update_data
+
+        Returns
+        -------
+        numpy structured array
+            one row per channel / electrode
+        """
+        return read_rows(self.db, self._tb_data, f'{self.t}_id', self.id, primary_key=primary_key)
 
-    def empty(self, n_rows):
+    def update_data(self, values):
+        """Only write the differences between values and the rows in the
+        database: rows are matched on "id" (see read_data with
+        primary_key=True). Rows with id <= 0 are inserted (at the end) and
+        rows which are not in values are deleted.
+        """
+        update_rows(self.db, self._tb_data, f'{self.t}_id', self.id, values, skip_empty=True)
+
+    def empty(self, n_rows, primary_key=False):
         """convenience function to get an empty array with empty values if
-        necessary"""
-        dtypes = get_dtypes(self.db['tables'][self._tb_data])
+        necessary. If primary_key, the "id" is 0 (i.e. new rows)"""
+        dtypes = get_dtypes(self.db['tables'][self._tb_data], primary_key=primary_key)
 
         values = empty(n_rows, dtype=dtypes)
         for name in values.dtype.names:
             if issubdtype(dtypes[name].type, floating):
                 values[name].fill(nan)
+        if primary_key:
+            values['id'].fill(0)
 
         return values
 
@@ -335,6 +430,377 @@ class File(Table):
     def path(self):
         return Path(self.__getattr__('path')).resolve()
 
+    @property
+    def stored_path(self):
+        """Path as it is stored in the database (path resolves it, which
+        can be slow on network drives)"""
+        return Path(self.__getattr__('path'))
+
+
+def identity_map(db):
+    """Objects which are in use, for one connection to the database.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+
+    Returns
+    -------
+    WeakValueDictionary
+        where the key is (t, id) and the value is the instance of Table. The
+        objects are removed automatically when they are no longer used.
+    """
+    objects = db.get('objects')
+    if objects is None:
+        objects = db['objects'] = WeakValueDictionary()
+    return objects
+
+
+def refresh_objects(db):
+    """Discard the row snapshots of all the objects in use (f.e. after a
+    rollback), so that they are read again from the database."""
+    for obj in list(identity_map(db).values()):
+        obj.refresh()
+
+
+def insert_rows(db, table, columns, rows):
+    """Insert many rows with multi-row prepared statements (with as many rows
+    per statement as allowed by MAX_PLACEHOLDERS).
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    table : str
+        name of the table
+    columns : list of str
+        name of the columns
+    rows : list of list
+        values for each row, in the same order as columns (None and NaN are
+        NULL)
+    """
+    n_rows_per_query = max(1, MAX_PLACEHOLDERS // len(columns))
+    columns_str = ', '.join(f'`{col}`' for col in columns)
+    values_str = '(' + ', '.join(['?', ] * len(columns)) + ')'
+
+    query = None
+    for i in range(0, len(rows), n_rows_per_query):
+        chunk = rows[i:i + n_rows_per_query]
+
+        # the same statement is reused for all the chunks but the last one
+        if query is None or len(chunk) != n_rows_per_query:
+            query = QSqlQuery(db['db'])
+            query.prepare(
+                f"INSERT INTO {table} ({columns_str}) VALUES "
+                + ', '.join([values_str, ] * len(chunk)))
+
+        for row in chunk:
+            for value in row:
+                query.addBindValue(_bind(value))
+
+        if not query.exec():
+            raise ValueError(query.lastError().text())
+
+
+def read_rows(db, table, fk_name, fk_id, primary_key=False):
+    """Read the rows of a table (events, channels, electrodes) which belong to
+    one object, as numpy structured array.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    table : str
+        name of the table
+    fk_name : str
+        name of the column with the foreign key (f.e. run_id)
+    fk_id : int
+        value of the foreign key
+    primary_key : bool
+        if True, include the "id" of each row. If the table does not have the
+        "id" column, the "id" is 0 (see update_rows)
+
+    Returns
+    -------
+    numpy structured array
+        one row per row in the table (NULL is NaN for floats)
+    """
+    dtypes = get_dtypes(db['tables'][table], primary_key=primary_key)
+    names = [name for name in dtypes.names if name != 'id' or has_primary_key(db, table)]
+    query_str = ", ".join(f"`{col}`" for col in names)
+    query = QSqlQuery(db['db'])
+    query.prepare(f"SELECT {query_str} FROM {table} WHERE {fk_name} = :id")
+    query.bindValue(':id', fk_id)
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    values = []
+    while query.next():
+        row = []
+        for name in dtypes.names:
+            if name not in names:
+                row.append(0)
+            elif issubdtype(dtypes[name].type, floating) and query.isNull(name):
+                row.append(nan)
+            else:
+                row.append(query.value(name))
+
+        values.append(tuple(row))
+
+    return array(values, dtype=dtypes)
+
+
+def update_rows(db, table, fk_name, fk_id, values, skip_empty=False):
+    """Compare values with the rows in the database and only send the UPDATE,
+    INSERT and DELETE statements which are necessary.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    table : str
+        name of the table
+    fk_name : str
+        name of the column with the foreign key (f.e. run_id)
+    fk_id : int
+        value of the foreign key
+    values : numpy structured array
+        it needs the "id" field. Rows with id <= 0 are new rows
+    skip_empty : bool
+        if True, NaN and empty strings are not inserted (and they are NULL when
+        updating), as in NumpyTable.data
+
+    Raises
+    ------
+    ValueError
+        if values does not have "id" or if one id belongs to another object
+
+    Notes
+    -----
+    If the table does not have the "id" column (databases created before the
+    primary key was added), all the rows are deleted and values are inserted
+    again.
+    """
+    if 'id' not in values.dtype.names:
+        raise ValueError('The array needs the primary key "id" (read the rows with primary_key=True)')
+    names = [name for name in values.dtype.names if name != 'id']
+
+    if not has_primary_key(db, table):
+        _replace_rows(db, table, fk_name, fk_id, values, names, skip_empty)
+        return
+
+    stored = read_rows(db, table, fk_name, fk_id, primary_key=True)
+    stored = {row['id'].item(): row for row in stored}
+
+    with transaction(db):
+        new_rows = []
+        kept = set()
+        for row in values:
+            row_id = row['id'].item()
+            if row_id <= 0:
+                new_rows.append(row)
+                continue
+            if row_id not in stored:
+                raise ValueError(f'Row with id = {row_id} does not belong to {fk_name} = {fk_id} in {table}')
+            kept.add(row_id)
+
+            changed = [
+                name for name in names
+                if not _same_value(stored[row_id][name].item(), row[name].item())]
+            if len(changed) == 0:
+                continue
+
+            set_str = ', '.join(f'`{name}` = ?' for name in changed)
+            query = QSqlQuery(db['db'])
+            query.prepare(f"UPDATE {table} SET {set_str} WHERE `id` = ? AND `{fk_name}` = ?")
+            for name in changed:
+                query.addBindValue(_bind(row[name].item(), skip_empty))
+            query.addBindValue(row_id)
+            query.addBindValue(fk_id)
+            if not query.exec():
+                raise ValueError(query.lastError().text())
+
+        to_delete = set(stored) - kept
+        if len(to_delete) > 0:
+            ids_str = ', '.join(str(x) for x in sorted(to_delete))
+            query = QSqlQuery(db['db'])
+            if not query.exec(f"DELETE FROM {table} WHERE `{fk_name}` = {int(fk_id)} AND `id` IN ({ids_str})"):
+                raise SyntaxError(query.lastError().text())
+
+        if len(new_rows) > 0:
+            new_rows = array(new_rows, dtype=values.dtype)
+            if skip_empty:
+                _insert_present_columns(db, table, fk_name, fk_id, new_rows)
+            else:
+                insert_rows(db, table, [fk_name, ] + names, [
+                    [fk_id, ] + [_bind(row[name].item()) for name in names]
+                    for row in new_rows])
+
+    lg.debug(f'{table} for {fk_name} = {fk_id}: {len(stored) - len(to_delete)} kept, '
+             f'{len(to_delete)} deleted, {len(new_rows)} inserted')
+
+
+def has_primary_key(db, table):
+    """Whether the table (events, channels, electrodes) has the "id" column"""
+    return 'id' in db['tables'][table]
+
+
+def _replace_rows(db, table, fk_name, fk_id, values, names, skip_empty):
+    """Delete all the rows of one object and insert values (for the tables
+    without "id")"""
+    with transaction(db):
+        query = QSqlQuery(db['db'])
+        query.prepare(f"DELETE FROM {table} WHERE `{fk_name}` = :id")
+        query.bindValue(':id', fk_id)
+        if not query.exec():
+            raise SyntaxError(query.lastError().text())
+
+        if skip_empty:
+            _insert_present_columns(db, table, fk_name, fk_id, values)
+        else:
+            insert_rows(db, table, [fk_name, ] + names, [
+                [fk_id, ] + [_bind(row[name].item()) for name in names]
+                for row in values])
+
+    lg.debug(f'{table} for {fk_name} = {fk_id}: {len(values)} rows replaced (no primary key)')
+
+
+def load_rows(db, t, columns, ids=None):
+    """Read the rows of the main table and the matching rows of the subtables
+    with one query.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    t : str
+        name of the level (subject, session, run, etc)
+    columns : dict
+        output of collect_columns for this level
+    ids : list of int
+        rows to read (if None, read all the rows)
+
+    Returns
+    -------
+    dict of dict
+        the key is the id of the row, the value is a dict with the python
+        value of each column
+    """
+    main_table = t + 's'
+    subtables = sorted(set(columns.values()) - {main_table, })
+
+    keys = list(columns)
+    fields = ', '.join(f'`{columns[key]}`.`{key}`' for key in keys)
+    joins = ''.join(
+        f' LEFT JOIN `{subt}` ON `{subt}`.`{t}_id` = `{main_table}`.`id`'
+        for subt in subtables)
+    where = ''
+    if ids is not None:
+        if len(ids) == 0:
+            return {}
+        ids_str = ', '.join(str(int(x)) for x in set(ids))
+        where = f' WHERE `{main_table}`.`id` IN ({ids_str})'
+
+    query = QSqlQuery(db['db'])
+    query.prepare(f"SELECT `{main_table}`.`id`, {fields} FROM `{main_table}`{joins}{where}")
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    rows = {}
+    while query.next():
+        row_id = query.value(0)
+        if row_id in rows:  # more than one row in a subtable
+            continue
+        rows[row_id] = {
+            key: _out_value(db, columns[key], key, query, i + 1)
+            for i, key in enumerate(keys)}
+
+    return rows
+
+
+def load_files(db, objs):
+    """Read the files of many objects of the same level with one query (and
+    one query to read the rows of the files), so that list_files does not
+    query the database for each object.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    objs : list of instances of Table_with_files
+        objects of the same level (f.e. recordings)
+
+    Returns
+    -------
+    list of instances of Table_with_files
+        the same objects, with the files already loaded (until they are
+        refreshed or a file is added or deleted)
+    """
+    objs = list(objs)
+    if len(objs) == 0:
+        return objs
+
+    t = objs[0].t
+    ids_str = ', '.join(str(int(obj.id)) for obj in set(objs))
+    query = QSqlQuery(db['db'])
+    query.prepare(f"SELECT `{t}_id`, `file_id` FROM `{t}s_files` WHERE `{t}_id` IN ({ids_str})")
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    file_ids = {obj.id: [] for obj in objs}
+    while query.next():
+        file_ids[query.value(0)].append(query.value(1))
+
+    columns = collect_columns(db, File.t)
+    rows = load_rows(db, File.t, columns, ids=[i for ids in file_ids.values() for i in ids])
+    for obj in objs:
+        obj._files = [
+            File._from_tree(db, file_id, columns, row=rows[file_id])
+            for file_id in file_ids[obj.id] if file_id in rows]
+
+    return objs
+
+
+def _out_value(db, table_name, key, query, i):
+    """Convert the value of the current row to python value.
+
+    NULL is checked on the query, because QMYSQL in PyQt5 does not distinguish
+    between null and 0.0 in the values. This is safe in worker threads, unlike
+    disabling the autoconversion of QVariant (which applies to all threads).
+    """
+    if query.isNull(i):
+        return None
+
+    elif db['tables'][table_name][key]['type'] == 'QDateTime':
+        return out_datetime(db['db'].driverName(), query.value(i))
+
+    elif db['tables'][table_name][key]['type'] == 'QDate':
+        return out_date(db['db'].driverName(), query.value(i))
+
+    else:
+        return query.value(i)
+
+
+def _snapshot_value(col_type, value):
+    """Python value as it is stored in the database after UPDATE"""
+    if value is None:
+        return None
+    elif col_type in ('QDate', 'QDateTime'):
+        return value
+    elif col_type == 'int':
+        return int(value)
+    elif col_type == 'double':
+        return float(value)
+    else:
+        return str(value).replace("'", '"').replace('\\', '"')
+
+
+def _subtable_parameters(db, t):
+    """Columns which determine which subtables are used for this level"""
+    return [subt['parameter'] for subt in db['subtables'] if subt['parent'] == t + 's']
+
 
 def _null(s):
     if s is None:
@@ -359,26 +825,54 @@ def _datetime(s):
         return '"' + f'{s:%Y-%m-%d %H:%M:%S.%f}'[:-3] + '"'  # ASP-36 bugfix for time notation in mariadb
 
 
-def _create_query(row):
-    """discard nan and create query strings"""
+def _present_columns(row, names):
+    """discard nan and empty strings"""
     dtypes = row.dtype
     columns = []
-    values = []
-    for name in dtypes.names:
+    for name in names:
         if issubdtype(dtypes[name].type, floating):
             if not isnan(row[name]):
                 columns.append(name)
-                values.append(f"'{row[name]}'")
         elif issubdtype(dtypes[name].type, character):
             if row[name] != '':
                 columns.append(name)
-                values.append(f"'{row[name]}'")
         else:
             raise ValueError(f'Unknown dtype {dtypes[name]}')
 
-        assert 'name' in columns
+    if 'name' not in columns:
+        raise ValueError('Each row needs a name')
+
+    return columns
+
+
+def _insert_present_columns(db, table, fk_name, fk_id, values):
+    """Insert rows without the columns which are NaN or empty. Consecutive rows
+    with the same columns are inserted together."""
+    names = [name for name in values.dtype.names if name != 'id']
+
+    blocks = []
+    for row in values:
+        columns = [fk_name, ] + _present_columns(row, names)
+        row_values = [fk_id, ] + [row[name].item() for name in columns[1:]]
+        if len(blocks) == 0 or blocks[-1][0] != columns:
+            blocks.append((columns, []))
+        blocks[-1][1].append(row_values)
+
+    for columns, rows in blocks:
+        insert_rows(db, table, columns, rows)
+
+
+def _bind(value, skip_empty=False):
+    """Value to bind in a query (NaN is NULL, and also empty strings if
+    skip_empty)"""
+    if isinstance(value, float) and isnan(value):
+        return None
+    if skip_empty and value == '':
+        return None
+    return value
 
-    columns_str = ', '.join([f'`{x}`' for x in columns])
-    values_str = ', '.join(values)
 
-    return columns_str, values_str
+def _same_value(old, new):
+    if isinstance(old, float) and isinstance(new, float):
+        return old == new or (isnan(old) and isnan(new))
+    return old == new
@@ -1,25 +1,41 @@
 from logging import getLogger
+from datetime import datetime
 from PyQt5.QtSql import QSqlQuery
-from numpy import (
-    array,
-    )
 
-from .backend import Table_with_files, NumpyTable
+from .backend import Table_with_files, NumpyTable, insert_rows, load_rows, read_rows, update_rows, _bind
 from .utils import (
+    collect_columns,
     find_subject_id,
-    get_dtypes,
     out_datetime,
     list_channels_electrodes,
+    prepared_query,
     recording_attach,
     recording_get,
+    sort_codes,
     sort_starttime,
-    sort_subjects_alphabetical,
-    sort_subjects_date,
+    subject_name,
+    transaction,
     )
 
 lg = getLogger(__name__)
 
 
+LIST_SUBJECTS_STATEMENT = """\
+    SELECT subjects.id, subject_codes.code, subject_start.start_time FROM subjects
+    LEFT JOIN subject_codes ON subject_codes.subject_id = subjects.id
+    LEFT JOIN (
+        SELECT sessions.subject_id,
+        CASE WHEN COUNT(sessions.id) = COUNT(session_start.start_time) THEN MIN(session_start.start_time) END AS start_time
+        FROM sessions
+        LEFT JOIN (
+            SELECT runs.session_id, MIN(runs.start_time) AS start_time FROM runs GROUP BY runs.session_id
+            ) AS session_start ON session_start.session_id = sessions.id
+        GROUP BY sessions.subject_id
+        ) AS subject_start ON subject_start.subject_id = subjects.id
+    ORDER BY subjects.id
+    """
+
+
 def list_subjects(db, alphabetical=False, reverse=False):
     """List of the subjects in the currently open database, sorted based on
     the date of their first run.
@@ -38,41 +54,197 @@ def list_subjects(db, alphabetical=False, reverse=False):
     -------
     list of instances of Subject
         list of subjects in the database
+
+    Notes
+    -----
+    The codes and the date of the first run of all the subjects are read with
+    one query. The date of the subject is the start time of its earliest
+    session, so it is unknown (and the subject comes first) when the subject
+    has no sessions or when one of its sessions has no runs with start time,
+    as in sort_subjects_date.
+    """
+    columns = collect_columns(db, 'subject')
+    list_of_subjects = []
+    for subj_id, subj_codes in list_subject_codes(db, alphabetical, reverse):
+        subj = Subject._from_tree(db, subj_id, columns)
+        subj._codes = subj_codes
+        list_of_subjects.append(subj)
+    return list_of_subjects
+
+
+def list_subject_codes(db, alphabetical=False, reverse=False):
+    """Ids and codes of the subjects, in the same order as list_subjects,
+    without creating the subjects (f.e. to show a long list of subjects).
+
+    Parameters
+    ----------
+    alphabetical : bool
+        False -> sort by date of first run
+        True -> sort alphabetically
+    reverse : bool
+        False -> oldest to newest, True -> newest to oldest
+        False -> A to Z, True -> Z to A
+
+    Returns
+    -------
+    list of tuple
+        id and list of codes (sorted, see sort_codes) of each subject
     """
     query = QSqlQuery(db['db'])
-    query.exec('SELECT id FROM subjects')
+    if not query.exec(LIST_SUBJECTS_STATEMENT):
+        raise SyntaxError(query.lastError().text())
 
-    list_of_subjects = []
+    driver = db['db'].driverName()
+    codes = {}
+    start_times = {}
     while query.next():
-        list_of_subjects.append(Subject(db, id=query.value('id')))
+        subj_id = query.value(0)
+        codes.setdefault(subj_id, [])
+        if not query.isNull(1):
+            codes[subj_id].append(query.value(1))
+
+        if not query.isNull(2):
+            start_time = out_datetime(driver, query.value(2))
+        else:
+            start_time = None
+        if start_time is None:
+            start_time = datetime(1900, 1, 1, 0, 0, 0)
+        start_times[subj_id] = start_time
+
+    subject_codes = [(subj_id, sort_codes(subj_codes)) for subj_id, subj_codes in codes.items()]
 
     if alphabetical:
-        _sort_subjects = sort_subjects_alphabetical
+        def _sort_subjects(x):
+            return subject_name(x[1]).lower()  # same as sort_subjects_alphabetical
     else:
-        _sort_subjects = sort_subjects_date
+        def _sort_subjects(x):
+            return start_times[x[0]]
+
+    return sorted(subject_codes, key=_sort_subjects, reverse=reverse)
+
+
+def load_tree(db, subset=None):
+    """Load subjects, sessions, runs and recordings with one JOIN query (and
+    one query per level to read all the values), so that the whole hierarchy
+    can be traversed without querying the database for each object.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    subset : dict
+        optional, with keys 'subjects', 'sessions', 'runs', each containing a
+        list of ids. Only the levels which are specified are restricted.
+
+    Returns
+    -------
+    list of instances of Subject
+        list of subjects (sorted by id). The children of each object
+        (list_sessions, list_runs, list_recordings) are already loaded and
+        they have their parent set.
+
+    Notes
+    -----
+    The objects are the same as the ones already in use (see identity_map), so
+    the children are only preloaded when all of them are read. If 'sessions'
+    is restricted, the subjects do not preload their sessions and if 'runs' is
+    restricted, the sessions do not preload their runs (they are read from the
+    database when needed, f.e. in list_sessions and in Session.start_time).
+    """
+    if subset is None:
+        subset = {}
+
+    def _filter(level):
+        ids = subset.get(level)
+        if ids is None:
+            return ''
+        ids = [str(int(x)) for x in ids if x is not None]
+        if len(ids) == 0:
+            return f' AND {level}.id IS NULL'
+        return f' AND {level}.id IN ({", ".join(ids)})'
 
-    return sorted(list_of_subjects, key=_sort_subjects, reverse=reverse)
+    query = QSqlQuery(db['db'])
+    query.prepare(f"""\
+        SELECT subjects.id, sessions.id, runs.id, recordings.id FROM subjects
+        LEFT JOIN sessions ON sessions.subject_id = subjects.id{_filter('sessions')}
+        LEFT JOIN runs ON runs.session_id = sessions.id{_filter('runs')}
+        LEFT JOIN recordings ON recordings.run_id = runs.id
+        WHERE 1 = 1{_filter('subjects')}
+        ORDER BY subjects.id, sessions.id, runs.id, recordings.id""")
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    tree = []
+    while query.next():
+        tree.append(tuple(
+            None if query.isNull(i) else query.value(i)
+            for i in range(4)))
+
+    levels = (Subject, Session, Run, Recording)
+    objects = []
+    for i, cls in enumerate(levels):
+        ids = [row[i] for row in tree if row[i] is not None]
+        columns = collect_columns(db, cls.t)
+        rows = load_rows(db, cls.t, columns, ids=ids)
+        objects.append({
+            id_: cls._from_tree(db, id_, columns, row=row)
+            for id_, row in rows.items()})
+
+    # the children of each level are complete only if the level below is not restricted
+    complete = (subset.get('sessions') is None, subset.get('runs') is None, True, True)
+    for level_objects, is_complete in zip(objects, complete):
+        for obj in level_objects.values():
+            if is_complete:
+                obj._children = []
+
+    list_of_subjects = []
+    linked = set()
+    for row in tree:
+        parent = None
+        for i, id_ in enumerate(row):
+            if id_ is None:
+                break
+            obj = objects[i][id_]
+            if (i, id_) not in linked:
+                linked.add((i, id_))
+                if parent is None:
+                    list_of_subjects.append(obj)
+                else:
+                    setattr(obj, obj.parent_level, parent)
+                    if complete[i - 1]:
+                        parent._children.append(obj)
+            parent = obj
+
+    return list_of_subjects
 
 
 class Subject(Table_with_files):
     t = 'subject'
+    _codes = None  # codes, if they were read together with the list of subjects
 
-    def __init__(self, db, code=None, id=None):
+    def __new__(cls, db, code=None, id=None):
         if code is not None:
             id = find_subject_id(db, code)
             if id is None:
                 raise ValueError(f'There is no "{code}" in "subject_codes" table')
 
+        obj = super().__new__(cls, db, id)
+        if 'columns' not in obj.__dict__:
+            obj.id = id  # so that __init__ does not look up the code again
+        return obj
+
+    def __init__(self, db, code=None, id=None):
+        if code is not None:
+            id = self.id
+
         super().__init__(db, id)
 
+    def refresh(self):
+        super().refresh()
+        self._codes = None
+
     def __str__(self):
-        codes = self.codes
-        if len(codes) == 0:
-            return '(subject without code)'
-        elif len(codes) == 1:
-            return codes[0]
-        else:
-            return ', '.join(codes)
+        return subject_name(self.codes)
 
     @classmethod
     def add(cls, db, code=None):
@@ -85,7 +257,7 @@ class Subject(Table_with_files):
 
         # add empty value to get new id
         query = QSqlQuery(db['db'])
-        query.prepare("INSERT INTO subjects () VALUES () ")
+        query.prepare("INSERT INTO subjects (`id`) VALUES (NULL)")  # also valid in SQLite
         if query.exec():
             id = query.lastInsertId()
         else:
@@ -104,8 +276,10 @@ class Subject(Table_with_files):
     @property
     def codes(self):
         """Get the codes associated with this subjects"""
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT code FROM subject_codes WHERE subject_codes.subject_id = :id")
+        if self._codes is not None:
+            return list(self._codes)
+
+        query = prepared_query(self.db, "SELECT code FROM subject_codes WHERE subject_codes.subject_id = :id")
         query.bindValue(':id', self.id)
         if not query.exec():
             lg.warning(query.lastError().text())
@@ -113,14 +287,14 @@ class Subject(Table_with_files):
         list_of_codes = []
         while query.next():
             list_of_codes.append(query.value('code'))
+        query.finish()
 
-        # put RESP at the end
-        list_of_codes.sort()
-        list_of_codes.sort(key=lambda s: s.startswith('RESP'))
-        return list_of_codes
+        return sort_codes(list_of_codes)
 
     @codes.setter
     def codes(self, codes):
+        self._codes = None
+
         query = QSqlQuery(self.db['db'])
         query.prepare('DELETE FROM subject_codes WHERE subject_id = :id')
         query.bindValue(':id', self.id)
@@ -135,6 +309,8 @@ class Subject(Table_with_files):
             if not query.exec():
                 raise SyntaxError(query.lastError().text())
 
+        self._codes = sort_codes(set(codes))
+
     def add_session(self, name):
         query = QSqlQuery(self.db['db'])
         query.prepare("INSERT INTO sessions (`subject_id`, `name`) VALUES (:id, :name)")
@@ -147,11 +323,14 @@ class Subject(Table_with_files):
         if session_id is None:
             raise SyntaxError(query.lastError().text())
 
+        self._children = None
         return Session(self.db, session_id, subject=self)
 
     def list_sessions(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT sessions.id, name FROM sessions WHERE sessions.subject_id = :id")
+        if self._children is not None:
+            return sorted(self._children, key=sort_starttime)
+
+        query = prepared_query(self.db, "SELECT sessions.id, name FROM sessions WHERE sessions.subject_id = :id")
         query.bindValue(':id', self.id)
         assert query.exec()
 
@@ -159,6 +338,7 @@ class Subject(Table_with_files):
         while query.next():
             list_of_sessions.append(
                 Session(self.db, id=query.value('id'), subject=self))
+        query.finish()
         return sorted(list_of_sessions, key=sort_starttime)
 
     def add_protocol(self, METC):
@@ -174,8 +354,7 @@ class Subject(Table_with_files):
         return Protocol(self.db, protocol_id, subject=self)
 
     def list_protocols(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT id FROM protocols WHERE subject_id = :id")
+        query = prepared_query(self.db, "SELECT id FROM protocols WHERE subject_id = :id")
         query.bindValue(':id', self.id)
 
         if not query.exec():
@@ -185,44 +364,58 @@ class Subject(Table_with_files):
         while query.next():
             list_of_protocols.append(
                 Protocol(self.db, id=query.value('id'), subject=self))
+        query.finish()
 
         return sorted(list_of_protocols, key=lambda obj: obj.metc)
 
 
 class Protocol(Table_with_files):
     t = 'protocol'
+    parent_level = 'subject'
+    subject = None
 
     def __init__(self, db, id, subject=None):
         super().__init__(db, id)
-        self.subject = subject
+        if subject is not None:
+            self.subject = subject
 
 
 class Session(Table_with_files):
     t = 'session'
+    parent_level = 'subject'
     subject = None
 
     def __init__(self, db, id, subject=None):
         super().__init__(db, id)
-        self.subject = subject
+        if subject is not None:
+            self.subject = subject
 
     def __str__(self):
         return f'<{self.t} {self.name} (#{self.id})>'
 
     @property
     def start_time(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT MIN(runs.start_time) FROM runs WHERE runs.session_id = :id")
+        if self._children is not None:
+            start_times = [run.start_time for run in self._children if run.start_time is not None]
+            if len(start_times) == 0:
+                return None
+            return min(start_times)
+
+        query = prepared_query(self.db, "SELECT MIN(runs.start_time) FROM runs WHERE runs.session_id = :id")
         query.bindValue(':id', self.id)
         assert query.exec()
 
         if query.next():
-            return out_datetime(self.db['db'].driverName(), query.value(0))
+            start_time = query.value(0)
+            query.finish()
+            return out_datetime(self.db['db'].driverName(), start_time)
 
     def list_runs(self):
         """List runs which were acquired during session"""
+        if self._children is not None:
+            return sorted(self._children, key=sort_starttime)
 
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT runs.id FROM runs WHERE runs.session_id = :id")
+        query = prepared_query(self.db, "SELECT runs.id FROM runs WHERE runs.session_id = :id")
         query.bindValue(':id', self.id)
         if not query.exec():
             raise SyntaxError(query.lastError().text())
@@ -231,6 +424,7 @@ class Session(Table_with_files):
         while query.next():
             list_of_runs.append(
                 Run(self.db, id=query.value('id'), session=self))
+        query.finish()
         return sorted(list_of_runs, key=sort_starttime)
 
     def list_channels(self):
@@ -257,23 +451,28 @@ class Session(Table_with_files):
             raise ValueError(query.lastError().text())
 
         run_id = query.lastInsertId()
+        self._children = None
         return Run(self.db, run_id, session=self)
 
 
 class Run(Table_with_files):
     t = 'run'
+    parent_level = 'session'
     session = None
 
     def __init__(self, db, id, session=None):
-        self.session = session
         super().__init__(db, id)
+        if session is not None:
+            self.session = session
 
     def __str__(self):
         return f'<{self.t} (#{self.id})>'
 
     def list_recordings(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT recordings.id FROM recordings WHERE recordings.run_id = :id")
+        if self._children is not None:
+            return sorted(self._children, key=lambda obj: obj.modality)
+
+        query = prepared_query(self.db, "SELECT recordings.id FROM recordings WHERE recordings.run_id = :id")
         query.bindValue(':id', self.id)
 
         if not query.exec():
@@ -283,6 +482,7 @@ class Run(Table_with_files):
         while query.next():
             list_of_recordings.append(
                 Recording(self.db, id=query.value('id'), run=self))
+        query.finish()
         return sorted(list_of_recordings, key=lambda obj: obj.modality)
 
     def add_recording(self, modality):
@@ -295,6 +495,7 @@ class Run(Table_with_files):
             raise ValueError(query.lastError().text())
 
         recording_id = query.lastInsertId()
+        self._children = None
         recording = Recording(self.db, recording_id, run=self)
         return recording
 
@@ -317,52 +518,59 @@ class Run(Table_with_files):
 
     @property
     def events(self):
-        dtypes = get_dtypes(self.db['tables']['events'])
-
-        query_str = ', '.join(f"`{x}`" for x in dtypes.names)
-        query = QSqlQuery(self.db['db'])
-        query.prepare(f"SELECT {query_str} FROM events WHERE run_id = :id")
-        query.bindValue(':id', self.id)
-
-        if not query.exec():
-            raise SyntaxError(query.lastError().text())
-
-        values = []
-        while query.next():
-            values.append(
-                tuple(query.value(name) for name in dtypes.names)
-                )
-        return array(values, dtype=dtypes)
+        return self.read_events()
 
     @events.setter
     def events(self, values):
         """If values is None, it deletes all the events.
-        """
-        query = QSqlQuery(self.db['db'])
-        query.prepare('DELETE FROM events WHERE run_id = :id')
-        query.bindValue(':id', self.id)
-        if not query.exec():
-            raise SyntaxError(query.lastError().text())
-
-        if values is None:
-            return
 
-        query_str = ', '.join(f"`{x}`" for x in values.dtype.names)
-
-        for row in values:
-            values_str = ', '.join([f"'{x}'" for x in row])
+        Events are inserted with multi-row prepared statements, in one
+        transaction. NaN are stored as NULL.
+        """
+        with transaction(self.db):
             query = QSqlQuery(self.db['db'])
-            sql_cmd = f"""\
-                INSERT INTO events (`run_id`, {query_str})
-                VALUES ('{self.id}', {values_str})
-                """
-            if not query.exec(sql_cmd):
+            query.prepare('DELETE FROM events WHERE run_id = :id')
+            query.bindValue(':id', self.id)
+            if not query.exec():
                 raise SyntaxError(query.lastError().text())
 
+            if values is None:
+                return
+
+            names = [name for name in values.dtype.names if name != 'id']  # the database assigns the ids
+            columns = ['run_id', ] + names
+            rows = [
+                [self.id, ] + [_bind(x) for x in row]
+                for row in values[names].tolist()]
+            insert_rows(self.db, 'events', columns, rows)
+
+    def read_events(self, primary_key=False):
+        """Read the events of this run.
+
+        Parameters
+        ----------
+        primary_key : bool
+            if True, the array also contains the "id" of each event, which is
+            needed by update_events
+
+        Returns
+        -------
+        numpy structured array
+            one row per event
+        """
+        return read_rows(self.db, 'events', 'run_id', self.id, primary_key=primary_key)
+
+    def update_events(self, values):
+        """Only write the differences between values and the events in the
+        database: events are matched on "id" (see read_events with
+        primary_key=True). Events with id <= 0 are inserted and events which
+        are not in values are deleted.
+        """
+        update_rows(self.db, 'events', 'run_id', self.id, values)
+
     @property
     def experimenters(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT name FROM experimenters JOIN runs_experimenters ON experimenters.id = runs_experimenters.experimenter_id WHERE run_id = :id")
+        query = prepared_query(self.db, "SELECT name FROM experimenters JOIN runs_experimenters ON experimenters.id = runs_experimenters.experimenter_id WHERE run_id = :id")
         query.bindValue(':id', self.id)
         if not query.exec():
             raise SyntaxError(query.lastError().text())
@@ -370,6 +578,7 @@ class Run(Table_with_files):
         list_of_experimenters = []
         while query.next():
             list_of_experimenters.append(query.value('name'))
+        query.finish()
         return sorted(list_of_experimenters)
 
     @experimenters.setter
@@ -404,8 +613,7 @@ class Run(Table_with_files):
 
     @property
     def intendedfor(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT target FROM intended_for WHERE run_id = :id")
+        query = prepared_query(self.db, "SELECT target FROM intended_for WHERE run_id = :id")
         query.bindValue(':id', self.id)
 
         if not query.exec():
@@ -415,6 +623,7 @@ class Run(Table_with_files):
         while query.next():
             list_of_intendedfor.append(
                 Run(self.db, query.value('target')))
+        query.finish()
         return list_of_intendedfor
 
     @intendedfor.setter
@@ -453,8 +662,7 @@ class Run(Table_with_files):
             raise SyntaxError(query.lastError().text())
 
     def list_protocols(self):
-        query = QSqlQuery(self.db['db'])
-        query.prepare("SELECT protocol_id FROM runs_protocols WHERE run_id = :id")
+        query = prepared_query(self.db, "SELECT protocol_id FROM runs_protocols WHERE run_id = :id")
         query.bindValue(':id', self.id)
 
         if not query.exec():
@@ -464,16 +672,19 @@ class Run(Table_with_files):
         while query.next():
             list_of_protocols.append(
                 Protocol(self.db, query.value('protocol_id')))
+        query.finish()
         return list_of_protocols
 
 
 class Recording(Table_with_files):
     t = 'recording'
+    parent_level = 'run'
     run = None
 
     def __init__(self, db, id, run=None):
-        self.run = run
         super().__init__(db, id)
+        if run is not None:
+            self.run = run
 
     @property
     def electrodes(self):
@@ -1,8 +1,8 @@
 from logging import getLogger
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from PyQt5.QtSql import QSqlQuery
-from PyQt5.QtCore import QVariant
-import sip
 
 from numpy import (
     dtype,
@@ -11,6 +11,11 @@ from numpy import (
 
 lg = getLogger(__name__)
 
+# size of string fields when the schema does not specify the length
+MAX_STRING_LENGTH = 4096
+# number of prepared statements which are kept for each connection
+MAX_PREPARED_STATEMENTS = 64
+
 
 def collect_columns(db, t=None, obj=None):
     """For each attribute, this function looks up in which table the information
@@ -28,7 +33,10 @@ def collect_columns(db, t=None, obj=None):
     Returns
     -------
     dict
-        where the key is the attribute and the value is the table
+        where the key is the attribute and the value is the table. If obj is
+        specified, only the subtables which match the values of obj are
+        included, otherwise all the subtables are included. The dict is
+        shared (see column_maps), so it should not be modified.
     """
     if obj is not None:
         table = obj.t + 's'
@@ -37,23 +45,144 @@ def collect_columns(db, t=None, obj=None):
     else:
         raise ValueError('You need to specify either t (level name) or obj (actual object)')
 
-    # main table
-    attr_tables = {k: table for k in list(db['tables'][table])}
+    maps = column_maps(db)[table]
+    if obj is None:
+        return maps['all']
+
+    values = tuple(getattr(obj, parameter) for parameter in maps['parameters'])
+    attr_tables = maps['combined'].get(values)
+    if attr_tables is None:
+        attr_tables = dict(maps['main'])
+        for parameter, value in zip(maps['parameters'], values):
+            attr_tables.update(maps['by_value'].get((parameter, value), {}))
+        maps['combined'][values] = attr_tables
+
+    return attr_tables
+
+
+def column_maps(db):
+    """Maps between attributes and tables, computed once for each connection
+    (the first time this function is called, usually in access_database).
+
+    Parameters
+    ----------
+    db : dict
+        information about all the tables
+
+    Returns
+    -------
+    dict of dict
+        where the key is the name of the main table and the values are:
+          - 'main' : attributes in the main table
+          - 'all' : attributes in the main table and in all the subtables
+          - 'parameters' : columns which define which subtables are used
+          - 'by_value' : attributes in the subtables, for each (parameter,
+            value)
+          - 'combined' : attributes for each combination of the values of the
+            parameters (filled by collect_columns)
+    """
+    maps = db.get('columns')
+    if maps is not None:
+        return maps
+
+    maps = {}
+    for table, columns in db['tables'].items():
+        main = {k: table for k in columns}
+        maps[table] = {
+            'main': main,
+            'all': dict(main),
+            'parameters': [],
+            'by_value': {},
+            'combined': {},
+            }
 
-    # look up attributes in subtables
-    subtables = []
     for subt in db['subtables']:
-        if subt['parent'] != table:
+        if subt['parent'] not in maps:
             continue
-        if obj is None or getattr(obj, subt['parameter']) in subt['values']:
-            subtables.append(subt['subtable'])
+        parent = maps[subt['parent']]
+        attr_tables = {k: subt['subtable'] for k in db['tables'][subt['subtable']]}
+        parent['all'].update(attr_tables)
+        if subt['parameter'] not in parent['parameters']:
+            parent['parameters'].append(subt['parameter'])
+        for value in subt['values']:
+            parent['by_value'].setdefault((subt['parameter'], value), {}).update(attr_tables)
 
-    for subt in subtables:
-        attr_tables.update(
-            {k: subt for k in list(db['tables'][subt])}
-            )
+    db['columns'] = maps
+    return maps
 
-    return attr_tables
+
+@contextmanager
+def transaction(db):
+    """Run the enclosed statements in one transaction. If the caller already
+    opened a transaction (f.e. the GUI, which sets db['transaction'] to True),
+    the statements become part of that transaction instead.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    """
+    if db.get('transaction', False):
+        yield
+        return
+
+    if not db['db'].transaction():
+        raise SyntaxError(db['db'].lastError().text())
+    db['transaction'] = True
+    try:
+        yield
+    except Exception:
+        db['db'].rollback()
+        raise
+    else:
+        if not db['db'].commit():
+            raise SyntaxError(db['db'].lastError().text())
+    finally:
+        db['transaction'] = False
+
+
+def prepared_query(db, statement):
+    """Prepared statement, which is reused the next time the same statement
+    is used with the same connection (only the values are bound again).
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    statement : str
+        SQL statement with placeholders
+
+    Returns
+    -------
+    instance of QSqlQuery
+        prepared query. Call finish() when all the rows are read, so that
+        the query can be reused. If the cached query is still in use (f.e. the
+        same statement in a nested loop), it returns a new query.
+
+    Notes
+    -----
+    The statements are kept in db['statements'] (with the exact text of the
+    statement as key), the least recently used is discarded when there are
+    more than MAX_PREPARED_STATEMENTS.
+    """
+    statements = db.get('statements')
+    if statements is None:
+        statements = db['statements'] = OrderedDict()
+
+    query = statements.get(statement)
+    if query is not None and not query.isActive():
+        statements.move_to_end(statement)
+        return query
+
+    query = QSqlQuery(db['db'])
+    if not query.prepare(statement):
+        return query  # the error is reported when it's executed
+
+    if statement not in statements:
+        statements[statement] = query
+        if len(statements) > MAX_PREPARED_STATEMENTS:
+            statements.popitem(last=False)
+    return query
 
 
 def find_subject_id(db, code):
@@ -71,29 +200,37 @@ def find_subject_id(db, code):
     int
         index of the subject
     """
-    query = QSqlQuery(db['db'])
-    query.prepare('SELECT subject_id FROM subject_codes WHERE subject_codes.code = :code')
+    query = prepared_query(db, 'SELECT subject_id FROM subject_codes WHERE subject_codes.code = :code')
     query.bindValue(':code', code)
 
     if query.exec():
-        if query.next():
-            return query.value('subject_id')
-        else:
-            return None
+        subject_id = query.value('subject_id') if query.next() else None
+        query.finish()
+        return subject_id
 
     else:
         lg.warning(query.lastError().text())
 
 
-def get_dtypes(table):
+def get_dtypes(table, primary_key=False):
     """The columns can only be index, strings or double, but nothing else (no int, no dates)
+
+    If primary_key is True, the "id" (as int) is included as first field.
+
+    The size of the string fields is the length declared in the schema (f.e.
+    'U255' for VARCHAR(255)), up to MAX_STRING_LENGTH (f.e. for TEXT).
     """
     dtypes = []
+    if primary_key:
+        dtypes.append(('id', 'int'))
     for k, v in table.items():
         if not (v['index'] is False):   # index is False when it's not an index
             continue
         elif v['type'] == 'QString':
-            dtypes.append((k, 'U4096'))
+            length = v.get('length', None)
+            if length is None or length > MAX_STRING_LENGTH:
+                length = MAX_STRING_LENGTH
+            dtypes.append((k, f'U{max(length, 1)}'))
         elif v['type'] == 'double':
             dtypes.append((k, 'float'))
         else:
@@ -102,6 +239,23 @@ def get_dtypes(table):
     return dtype(dtypes)
 
 
+def sort_codes(codes):
+    """Sort the codes of one subject, with the RESP codes at the end"""
+    codes = sorted(codes)
+    codes.sort(key=lambda s: s.startswith('RESP'))
+    return codes
+
+
+def subject_name(codes):
+    """Name of a subject, based on its codes (see sort_codes)"""
+    if len(codes) == 0:
+        return '(subject without code)'
+    elif len(codes) == 1:
+        return codes[0]
+    else:
+        return ', '.join(codes)
+
+
 def sort_subjects_alphabetical(subj):
     return str(subj).lower()  # ASP-62 Subjects all lowercase requested
 
@@ -147,7 +301,7 @@ def out_datetime(driver, out):
         if out == '':
             return None
         else:
-            return datetime.strptime(out, '%Y-%m-%dT%H:%M:%S')
+            return datetime.fromisoformat(out)  # with 'T' or ' ' and with or without ms
     else:
         if out.isValid():
             return out.toPyDateTime()
@@ -157,8 +311,7 @@ def out_datetime(driver, out):
 
 def list_channels_electrodes(db, session_id, name='channel'):
 
-    query = QSqlQuery(db['db'])
-    query.prepare(f"""\
+    query = prepared_query(db, f"""\
         SELECT DISTINCT recordings_ephys.{name}_group_id FROM recordings_ephys
         JOIN recordings ON recordings_ephys.recording_id = recordings.id
         JOIN runs ON runs.id = recordings.run_id
@@ -169,32 +322,26 @@ def list_channels_electrodes(db, session_id, name='channel'):
     if not query.exec():
         lg.warning(query.lastError().text())
 
-    autoconversion = sip.enableautoconversion(QVariant, False)
     list_of_items = []
     while query.next():
-        val = query.value(0)
-        if val.isNull():
+        if query.isNull(0):
             continue
-        list_of_items.append(int(val.value()))
+        list_of_items.append(int(query.value(0)))
+    query.finish()
 
-    sip.enableautoconversion(QVariant, autoconversion)
     return list_of_items
 
 
 def recording_get(db, group, recording_id):
-    query = QSqlQuery(db['db'])
-    query.prepare(f"SELECT {group}_group_id FROM recordings_ephys WHERE recording_id = :recording_id")
+    query = prepared_query(db, f"SELECT {group}_group_id FROM recordings_ephys WHERE recording_id = :recording_id")
     query.bindValue(':recording_id', recording_id)
     if not query.exec():
         lg.warning(query.lastError().text())
 
-    autoconversion = sip.enableautoconversion(QVariant, False)
     out_value = None
-    if query.next():
-        out = query.value(f'{group}_group_id')
-        if not out.isNull():
-            out_value = out.value()
-    sip.enableautoconversion(QVariant, autoconversion)
+    if query.next() and not query.isNull(0):
+        out_value = query.value(0)
+    query.finish()
     return out_value
 
 
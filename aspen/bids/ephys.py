@@ -27,21 +27,20 @@ lg = getLogger(__name__)
 EXCLUDE_CHAN_TYPES = ['OTHER', ]
 
 
-def convert_ephys(run, rec, dest_path, name, intendedfor):
+def convert_ephys(run, rec, dest_path, name, intendedfor, file=None):
+    """file is the input file (see find_ephys_file), if it was already found"""
     start_time = run.start_time + timedelta(seconds=rec.offset)
 
     end_time = start_time + timedelta(seconds=run.duration)
 
-    file = find_one_file(rec, ('blackrock', 'micromed', 'bci2000'))
     if file is None:
-        return
+        file = find_ephys_file(rec)
+        if file is None:
+            return
 
     electrodes = rec.electrodes
     if electrodes is not None:
-        elec_name = electrodes.name
-        if elec_name is None:
-            elec_name = 'unspecified'
-        name['acq'] = 'acq-' + sub('[\s()]', '', elec_name)
+        name['acq'] = acq_label(electrodes)
 
         electrodes_tsv = dest_path / make_bids_name(name, 'electrodes')
         save_tsv(electrodes_tsv, electrodes.data, ['name', 'x', 'y', 'z', 'size'])
@@ -92,6 +91,18 @@ def convert_ephys(run, rec, dest_path, name, intendedfor):
     return output_ephys
 
 
+def find_ephys_file(rec):
+    return find_one_file(rec, ('blackrock', 'micromed', 'bci2000'))
+
+
+def acq_label(electrodes):
+    """_acq-<label>_ field, based on the name of the electrodes"""
+    elec_name = electrodes.name
+    if elec_name is None:
+        elec_name = 'unspecified'
+    return 'acq-' + sub('[\s()]', '', elec_name)
+
+
 def replace_micro(channels_tsv):
     """delete this when the PR is accepted
     https://github.com/bids-standard/bids-validator/pull/923"""
@@ -0,0 +1,357 @@
+"""Estimate the size of the files and the duration of a BIDS export, without
+converting anything (dry run of the plan, see plan_bids).
+
+The rows of the runs, the recordings and their files and the number of events
+are read with a few queries for the whole plan. Only the headers of the input
+files are read (PAR, NIfTI and ephys headers), not the data.
+
+The sizes of the large files are computed from the headers:
+
+    - MRI : number of voxels x size of each voxel, compressed by gzip (if the
+            input is a .nii.gz which is copied as it is, its size)
+    - ephys : number of channels x number of samples in the run x 4 bytes
+              (BrainVision is written as float32)
+
+The duration of each stage is based on the throughput and the overhead of each
+kind of conversion (the constants below, which depend on the computer and on
+the network drive).
+"""
+from logging import getLogger
+
+from PyQt5.QtSql import QSqlQuery
+
+from ..api import Recording, load_files
+from ..api.backend import load_rows
+from ..api.utils import collect_columns
+from ..io.utils import localize_blackrock
+from ..nibabel import load as niload
+from ..nibabel.parrec import parse_PAR_header
+from .io.parrec import MR_TYPES
+from .mri import DEFACE_MODALITIES
+from .plan import dataset_files
+
+lg = getLogger(__name__)
+
+STAGES = ('mri', 'ephys', 'physio', 'events', 'dataset')
+
+# size (in bytes) of the small files (sidecars, channels, electrodes etc)
+SIDECAR_SIZE = 2_000
+# size (in bytes) of each event in the _events.tsv and in the .vmrk files
+EVENT_SIZE = 50
+# size (in bytes) of each sample of each channel in BrainVision
+EPHYS_SAMPLE_SIZE = 4
+# size of the MRI compressed with gzip, relative to the uncompressed size
+MRI_GZIP_RATIO = 0.5
+# size of the physio .tsv.gz, relative to the size of the input file
+PHYSIO_RATIO = 0.5
+# data (in bytes, before compression) which is converted in 1 s by each stage
+THROUGHPUT = {
+    'mri': 20e6,
+    'ephys': 50e6,
+    'physio': 5e6,
+    'events': 1e6,
+    'dataset': 1e6,
+    }
+# time (in s) to start each conversion (query the database, read the headers)
+OVERHEAD = {
+    'mri': 2,
+    'ephys': 3,
+    'physio': 1,
+    'events': 0.2,
+    'dataset': 0.05,
+    }
+# time (in s) to remove the face from one MRI
+DEFACE_TIME = 60
+
+PHYSIO_FORMATS = {
+    'dataglove': 'recording-dataglove',
+    'scanphyslog': 'recording-resp',
+    'flip': 'recording-flip',
+    }
+
+
+def estimate_plan(db, plan, deface=True, keep_phase=False):
+    """Estimate the size of each file and the duration of each stage of the
+    export
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    plan : dict
+        output of plan_bids (or load_plan)
+    deface : bool
+        remove the face from the anatomical MRI (it takes long)
+    keep_phase : bool
+        keep the phase images
+
+    Returns
+    -------
+    dict
+        with keys:
+            'files' : list of dict, for each planned file, with keys 'path',
+                      'stage', 'source_format' (format of the input file or
+                      'database') and 'size' (in bytes, None if the input
+                      file cannot be read)
+            'size' : estimated size (in bytes) of the whole dataset
+            'time' : stage -> estimated time (in s)
+            'total_time' : estimated time (in s) of the whole export
+
+    Notes
+    -----
+    The time of the stages assumes that the recordings are converted in one
+    process (n_workers=1 in create_bids).
+    """
+    tasks = plan['tasks']
+    runs = _load_rows(db, 'run', {task['run_id'] for task in tasks})
+    recordings = _load_recordings(db, {task['recording_id'] for task in tasks if 'recording_id' in task})
+    n_events = count_events(db, {task['run_id'] for task in tasks if task['kind'] in ('events', 'ephys')})
+
+    files = []
+    time = {stage: 0. for stage in STAGES}
+    for task in tasks:
+        stage = task['kind']
+        run = runs[task['run_id']]
+
+        if stage == 'mri':
+            rec = recordings[task['recording_id']]
+            task_files, processed = _estimate_mri(task, rec, run, _find_file(rec, task['file_id']), keep_phase)
+            if deface and rec.modality in DEFACE_MODALITIES:
+                time[stage] += DEFACE_TIME
+
+        elif stage == 'ephys':
+            rec = recordings[task['recording_id']]
+            task_files, processed = _estimate_ephys(task, run, _find_file(rec, task['file_id']), n_events.get(task['run_id'], 0))
+
+        elif stage == 'physio':
+            task_files, processed = _estimate_physio(task, recordings[task['recording_id']])
+
+        elif stage == 'events':
+            size = (n_events.get(task['run_id'], 0) + 1) * EVENT_SIZE
+            task_files, processed = [_planned_file(task['output'], stage, 'database', size), ], size
+
+        files.extend(task_files)
+        time[stage] += OVERHEAD[stage] + (processed or 0) / THROUGHPUT[stage]
+
+    for dataset_file in dataset_files(plan):
+        files.append(_planned_file(dataset_file, 'dataset', 'database', SIDECAR_SIZE))
+        time['dataset'] += OVERHEAD['dataset'] + SIDECAR_SIZE / THROUGHPUT['dataset']
+
+    return {
+        'files': files,
+        'size': sum(f['size'] for f in files if f['size'] is not None),
+        'time': time,
+        'total_time': sum(time.values()),
+        }
+
+
+def count_events(db, run_ids):
+    """Number of events of each run, with one query
+
+    Returns
+    -------
+    dict
+        where the key is the run id and the value is the number of events
+        (runs without events are not included)
+    """
+    if len(run_ids) == 0:
+        return {}
+
+    ids_str = ', '.join(str(int(x)) for x in run_ids)
+    query = QSqlQuery(db['db'])
+    query.prepare(f"SELECT run_id, COUNT(*) FROM events WHERE run_id IN ({ids_str}) GROUP BY run_id")
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    n_events = {}
+    while query.next():
+        n_events[query.value(0)] = query.value(1)
+    return n_events
+
+
+def format_estimate(estimate):
+    """Short description of the estimate, f.e. for a message box"""
+    n_unknown = sum(1 for f in estimate['files'] if f['size'] is None)
+
+    lines = [
+        f'{len(estimate["files"])} files, {_format_size(estimate["size"])}',
+        ]
+    if n_unknown > 0:
+        lines.append(f'(the size of {n_unknown} files is not known)')
+    lines.append(f'Estimated time: {_format_time(estimate["total_time"])}')
+    for stage in STAGES:
+        if estimate['time'][stage] > 0:
+            lines.append(f' - {stage}: {_format_time(estimate["time"][stage])}')
+    return '\n'.join(lines)
+
+
+def _estimate_mri(task, rec, run, file, keep_phase):
+    """Returns the planned files and the size of the uncompressed data"""
+    output, sidecar, phase_file = task['writes']
+    if file is None:
+        return [_planned_file(output, 'mri', None, None), _planned_file(sidecar, 'mri', 'database', SIDECAR_SIZE)], None
+
+    try:
+        n_voxels, voxel_size, n_volumes, has_phase = _read_mri_header(file)
+    except Exception as err:
+        lg.warning(f'Could not read the header of {file.path}: {err}')
+        return [_planned_file(output, 'mri', file.format, None), _planned_file(sidecar, 'mri', 'database', SIDECAR_SIZE)], None
+
+    processed = n_voxels * voxel_size
+    if run['task_name'] == 'MP2RAGE':  # only the first volume is kept
+        n_voxels //= n_volumes
+
+    if file.format == 'nifti' and file.path.name.endswith('.nii.gz') and run['task_name'] != 'MP2RAGE':
+        size = file.path.stat().st_size  # the file is copied
+    else:
+        size = int(n_voxels * voxel_size * MRI_GZIP_RATIO)
+
+    files = []
+    if has_phase:  # the second half of the volumes
+        files.append(_planned_file(output, 'mri', file.format, size // 2))
+        if keep_phase:
+            files.append(_planned_file(phase_file, 'mri', file.format, size // 2))
+    else:
+        files.append(_planned_file(output, 'mri', file.format, size))
+    files.append(_planned_file(sidecar, 'mri', 'database', SIDECAR_SIZE))
+    return files, processed
+
+
+def _read_mri_header(file):
+    """Read only the header of PAR or NIfTI
+
+    Returns
+    -------
+    int
+        number of voxels
+    int
+        size of each voxel (in bytes)
+    int
+        number of volumes
+    bool
+        if it has magnitude and phase images (only PAR)
+    """
+    if file.format == 'parrec':
+        with file.path.open() as f:
+            hdr, image_defs = parse_PAR_header(f)
+        resolution = image_defs['recon resolution']
+        n_voxels = int((resolution[:, 0] * resolution[:, 1]).sum())
+        voxel_size = int(image_defs['image pixel size'][0]) // 8
+        n_volumes = max(len(image_defs) // image_defs['slice number'].max(), 1)
+        has_phase = any(MR_TYPES.get(x) == 'phase' for x in set(image_defs['image_type_mr']))
+
+    else:
+        img = niload(file.path)  # the data is not read
+        shape = img.shape
+        n_voxels = 1
+        for n in shape:
+            n_voxels *= n
+        voxel_size = img.get_data_dtype().itemsize
+        n_volumes = shape[3] if len(shape) > 3 else 1
+        has_phase = False
+
+    return n_voxels, voxel_size, n_volumes, has_phase
+
+
+def _estimate_ephys(task, run, file, n_events):
+    """Returns the planned files and the size of the data"""
+    writes = task['writes']
+    output = task['output']
+    eeg_file = output.with_suffix('.eeg')
+    vmrk_file = output.with_suffix('.vmrk')
+
+    size = None
+    if file is not None and run['duration'] is not None:
+        try:
+            d = localize_blackrock(file.path)
+            n_samples = int(run['duration'] * d.header['s_freq'])
+            size = len(d.header['chan_name']) * n_samples * EPHYS_SAMPLE_SIZE
+        except Exception as err:
+            lg.warning(f'Could not read the header of {file.path}: {err}')
+
+    source_format = None if file is None else file.format
+    files = []
+    for planned in writes:
+        if planned == eeg_file:
+            files.append(_planned_file(planned, 'ephys', source_format, size))
+        elif planned == vmrk_file:
+            files.append(_planned_file(planned, 'ephys', 'database', (n_events + 1) * EVENT_SIZE))
+        else:
+            files.append(_planned_file(planned, 'ephys', 'database', SIDECAR_SIZE))
+    return files, size
+
+
+def _estimate_physio(task, rec):
+    """Returns the planned files and the size of the input files"""
+    files = []
+    processed = 0
+    for file in rec.list_files():
+        label = PHYSIO_FORMATS.get(file.format)
+        if label is None:
+            continue
+        try:
+            input_size = file.path.stat().st_size
+        except OSError:
+            input_size = None
+
+        for planned in task['writes']:  # .tsv.gz and .json of this recording label
+            if f'_{label}_' not in planned.name:
+                continue
+            if planned.name.endswith('.json'):
+                files.append(_planned_file(planned, 'physio', 'database', SIDECAR_SIZE))
+            else:
+                size = None if input_size is None else int(input_size * PHYSIO_RATIO)
+                files.append(_planned_file(planned, 'physio', file.format, size))
+        processed += input_size or 0
+
+    return files, processed
+
+
+def _planned_file(path, stage, source_format, size):
+    return {
+        'path': path,
+        'stage': stage,
+        'source_format': source_format,
+        'size': size,
+        }
+
+
+def _find_file(rec, file_id):
+    for file in rec.list_files():
+        if file.id == file_id:
+            return file
+    lg.warning(f'The file (#{file_id}) of {rec} is not in the database anymore')
+    return None
+
+
+def _load_rows(db, t, ids):
+    if len(ids) == 0:
+        return {}
+    return load_rows(db, t, collect_columns(db, t), ids=sorted(ids))
+
+
+def _load_recordings(db, ids):
+    """Recordings with their rows and their files"""
+    columns = collect_columns(db, Recording.t)
+    rows = _load_rows(db, Recording.t, ids)
+    recordings = {id_: Recording._from_tree(db, id_, columns, row=row) for id_, row in rows.items()}
+    load_files(db, recordings.values())
+    return recordings
+
+
+def _format_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return f'{size:.0f} {unit}'
+        size /= 1000
+    return f'{size:.1f} TB'
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f'{hours} h {minutes} min'
+    elif minutes > 0:
+        return f'{minutes} min {seconds} s'
+    return f'{seconds} s'
@@ -2,8 +2,9 @@ from logging import getLogger
 from pathlib import Path
 from numpy import unique
 from ...nibabel.parrec import parse_PAR_header
-from ...nibabel.cmdline.parrec2nii import get_opt_parser, proc_file, verbose
+from ...nibabel.cmdline.parrec2nii import get_opt_parser, make_nifti, proc_file, verbose
 from ...nibabel.mriutils import calculate_dwell_time
+from ...nibabel.openers import gzip_threads
 from tempfile import mkdtemp
 
 lg = getLogger(__name__)
@@ -14,9 +15,11 @@ MR_TYPES = {
     -1: 'reconstructed',  # relevant for MP2RAGE
     }
 
-def convert_parrec_nibabel(par_file, MagneticFieldStrength=None):
-    """
+def convert_parrec_nibabel(par_file, MagneticFieldStrength=None, threads=None):
+    """Convert PAR/REC to a temporary .nii.gz file
 
+    threads is the number of threads which compress the output (one per CPU,
+    if None)
     """
     input_par = Path(par_file).resolve()
     hdr = parse_PAR(input_par, MagneticFieldStrength)
@@ -24,22 +27,50 @@ def convert_parrec_nibabel(par_file, MagneticFieldStrength=None):
     tmp_dir = mkdtemp()
     lg.debug(f'Temporary directory for PAR/REC conversion: {tmp_dir}')
 
+    opts, infiles = _parse_options(input_par, tmp_dir)
+    with gzip_threads(threads):
+        proc_file(infiles[0], opts)
+
+    output = next(Path(tmp_dir).glob('*.nii.gz'))
+
+    return output, hdr
+
+
+def load_parrec_nibabel(par_file, MagneticFieldStrength=None):
+    """Convert PAR/REC to a NIfTI image in memory, so that it can be modified
+    before it's written (and compressed) only once.
+
+    Returns
+    -------
+    instance of Nifti1Image
+        image with the same data and header as the output of
+        convert_parrec_nibabel
+    dict
+        see parse_PAR
+    """
+    input_par = Path(par_file).resolve()
+    hdr = parse_PAR(input_par, MagneticFieldStrength)
+
+    opts, infiles = _parse_options(input_par)
+    img = make_nifti(infiles[0], opts)[0]
+
+    return img, hdr
+
+
+def _parse_options(input_par, output_dir=None):
+    """Options of parrec2nii"""
     parser = get_opt_parser()
-    (opts, infiles) = parser.parse_args([
-        '--output-dir=' + tmp_dir,
+    args = [
         '--compressed',
         '--permit-truncated',
         '--store-header',
         '--strict-sort',  # necessary for magnitute / phase
         ] + [str(input_par), ]
-        )
+    if output_dir is not None:
+        args.insert(0, '--output-dir=' + output_dir)
+    (opts, infiles) = parser.parse_args(args)
     verbose.switch = opts.verbose
-
-    proc_file(infiles[0], opts)
-
-    output = next(Path(tmp_dir).glob('*.nii.gz'))
-
-    return output, hdr
+    return opts, infiles
 
 
 def parse_PAR(par_file, MagneticFieldStrength=None):
@@ -0,0 +1,189 @@
+"""Manifest of a BIDS export, so that the next export only converts again the
+recordings which changed (see create_bids with incremental=True).
+
+The manifest is stored in the root BIDS directory (MANIFEST_FILE). For each
+task of the plan (see plan_bids), it keeps the files which were written and a
+fingerprint of everything which was used to write them:
+
+    - the task (BIDS name, output files, IntendedFor targets)
+    - the identity of the input files (path, size, modification time)
+    - the rows in the database (run, session, recording, events, electrodes,
+      channels)
+    - the options of create_bids which change the output and the version of
+      aspen
+
+It also keeps the files which describe the whole dataset (f.e. _scans.tsv) and
+the folders, so that the ones which are not needed anymore can be removed.
+"""
+from hashlib import sha256
+from json import dump, dumps, load
+from logging import getLogger
+from os import stat
+
+from .. import __version__
+from ..api import Run, Recording, File
+from ..api.backend import load_rows
+from ..api.utils import collect_columns
+from .plan import find_intendedfor
+
+lg = getLogger(__name__)
+
+MANIFEST_FILE = '.aspen_manifest.json'  # hidden files are ignored by the BIDS validator
+MANIFEST_VERSION = 1
+
+
+def read_manifest(data_path):
+    """Read the manifest of the previous export
+
+    Returns
+    -------
+    dict or None
+        manifest with keys 'version', 'tasks', 'files' and 'directories' (None
+        if there is no valid manifest)
+    """
+    manifest_file = data_path / MANIFEST_FILE
+    if not manifest_file.exists():
+        return None
+
+    try:
+        with manifest_file.open() as f:
+            manifest = load(f)
+    except (OSError, ValueError) as err:
+        lg.warning(f'Could not read {manifest_file}: {err}')
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        lg.info(f'{manifest_file} was written by another version, the whole dataset will be converted')
+        return None
+
+    return manifest
+
+
+def write_manifest(data_path, tasks, files, directories):
+    """Write the manifest of this export
+
+    Parameters
+    ----------
+    data_path : Path
+        root BIDS directory
+    tasks : dict
+        where the key is the task key (see task_key) and the value is a dict
+        with 'fingerprint' and 'outputs'
+    files : list of str
+        files which describe the whole dataset (relative to data_path)
+    directories : list of str
+        folders of the dataset (relative to data_path)
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'tasks': tasks,
+        'files': sorted(files),
+        'directories': directories,
+        }
+    with (data_path / MANIFEST_FILE).open('w') as f:
+        dump(manifest, f, indent=1)
+
+
+def task_key(task, data_path):
+    """Name of the task in the manifest (the kind, the id of the recording or
+    the run and the first file that it writes, which depends on the BIDS
+    name)"""
+    id_ = task.get('recording_id', task['run_id'])
+    return f"{task['kind']} {id_} {task['writes'][0].relative_to(data_path)}"
+
+
+def task_outputs(task, data_path):
+    """Files written by the task, which exist
+
+    Returns
+    -------
+    list of str
+        relative to data_path
+    """
+    return [str(f.relative_to(data_path)) for f in task['writes'] if f.exists()]
+
+
+def compute_fingerprints(db, plan, **options):
+    """Fingerprint of the inputs of each task
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    plan : dict
+        output of plan_bids
+    **options
+        options of create_bids which change the output (f.e. deface)
+
+    Returns
+    -------
+    dict
+        where the key is the task key (see task_key) and the value is the
+        fingerprint (str)
+    """
+    tasks = plan['tasks']
+    rows = {
+        'session': _load_rows(db, 'session', {task['session_id'] for task in tasks}),
+        'run': _load_rows(db, 'run', {task['run_id'] for task in tasks}),
+        'recording': _load_rows(db, 'recording', {task['recording_id'] for task in tasks if 'recording_id' in task}),
+        }
+
+    targets = {}  # the files in IntendedFor are added later, see _add_intendedfor
+    for run_id in plan['intendedfor']:
+        found = set(find_intendedfor(db, run_id)) & set(plan['intendedfor'])
+        targets[run_id] = sorted(str(plan['intendedfor'][i]) for i in found)
+
+    fingerprints = {}
+    for task in tasks:
+        h = sha256()
+        _update(h, __version__, options, task)
+        _update(h, rows['session'].get(task['session_id']), rows['run'].get(task['run_id']))
+        _update(h, targets.get(task['run_id']))
+
+        if task['kind'] in ('events', 'ephys'):
+            _update_array(h, Run(db, id=task['run_id']).events)
+
+        if 'recording_id' in task:
+            rec = Recording(db, id=task['recording_id'])
+            _update(h, rows['recording'].get(rec.id))
+
+            if 'file_id' in task:
+                files = [File(db, id=task['file_id']), ]
+            else:
+                files = rec.list_files()
+            _update(h, [_file_identity(file) for file in files])
+
+            if task['kind'] == 'ephys':
+                for group in (rec.electrodes, rec.channels):
+                    if group is None:
+                        _update(h, None)
+                        continue
+                    _update(h, group._load_row())
+                    _update_array(h, group.data)
+
+        fingerprints[task_key(task, plan['data_path'])] = h.hexdigest()
+
+    return fingerprints
+
+
+def _load_rows(db, t, ids):
+    if len(ids) == 0:
+        return {}
+    return load_rows(db, t, collect_columns(db, t), ids=sorted(ids))
+
+
+def _file_identity(file):
+    path = file.path
+    try:
+        st = stat(path)
+    except OSError:
+        return [file.format, str(path), None, None]
+    return [file.format, str(path), st.st_size, st.st_mtime_ns]
+
+
+def _update(h, *values):
+    h.update(dumps(values, sort_keys=True, default=str).encode())
+
+
+def _update_array(h, x):
+    _update(h, str(x.dtype), x.tolist())
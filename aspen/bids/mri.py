@@ -3,16 +3,16 @@ from json import dump
 from os import environ
 from numpy import linspace, r_, tile
 from pathlib import Path
-from shutil import move, copyfile, copyfileobj
+from shutil import copyfile, copyfileobj
 from subprocess import run, DEVNULL
 from tempfile import mkstemp, gettempdir
-import gzip
 
 from ..nibabel import save as nisave
 from ..nibabel import load as niload
+from ..nibabel.openers import ImageOpener, ParallelGzipFile, gzip_threads
 from ..bidso.utils import replace_extension
 
-from .io.parrec import convert_parrec_nibabel
+from .io.parrec import load_parrec_nibabel
 from .utils import rename_task, make_bids_name, find_one_file, make_taskdescription, set_notnone
 
 lg = getLogger(__name__)
@@ -27,48 +27,67 @@ DIRECTION = {
     'IS': 'k',
     'SI': 'k-',
     }
+# anatomical images, which are defaced (see run_deface)
+DEFACE_MODALITIES = ('T1w', 'T2w', 'T2star', 'PD', 'FLAIR')
+# threads which compress each .nii.gz (one per CPU, if None)
+GZIP_THREADS = None
 
 
-def convert_mri(run, rec, dest_path, name, deface=True):
-    """Return base name for this run"""
-    output_nii = dest_path / f'{make_bids_name(name)}_{rec.modality}.nii.gz'
+def convert_mri(run, rec, dest_path, name, deface=True, file=None):
+    """Return base name for this run
 
-    file = find_one_file(rec, ('parrec', ))
-    if file is not None:
-        input_nii, PAR = convert_parrec_nibabel(file.path, MagneticFieldStrength=run.session.MagneticFieldStrength)
-        move(input_nii, output_nii)
+    file is the input file (see find_mri_file), if it was already found.
 
-    else:
-        file = find_one_file(rec, ('nifti', ))
-        PAR = None
+    The image is modified in memory (selection of the volumes, phase, TR) and
+    each output file is written (and compressed) only once. If only the header
+    changes, the voxel data is copied as it is (see _copy_with_header).
+    """
+    if file is None:
+        file = find_mri_file(rec)
         if file is None:
             return None
 
-        else:
-            input_nii = file.path
+    output_nii = dest_path / f'{make_bids_name(name)}_{rec.modality}.nii.gz'
 
-            if input_nii.name.endswith('.nii.gz'):
-                copyfile(file.path, output_nii)
-            elif input_nii.name.endswith('.nii'):
-                gz(file.path, output_nii)
-            else:
-                lg.warning(f'Unknown extension for nifti for {input_nii}')
-                return None
+    if file.format == 'parrec':
+        img, PAR = load_parrec_nibabel(file.path, MagneticFieldStrength=run.session.MagneticFieldStrength)
+        hdr = None
+
+    else:
+        PAR = None
+        img = niload(file.path)  # only the header is read
+        hdr = _read_header(file.path, img)
 
     if run.task_name == 'MP2RAGE':
         lg.info('Keeping only the first volume for MP2RAGE')
-        select(output_nii, 'first')
+        img = select(img, 'first')[0]
+        hdr = None
 
-    nii_shape = _fix_tr(output_nii, rec)
+    if hdr is None:  # the voxel data has to be written
+        _fix_tr(img.header, rec)
+        nii_shape = img.shape
+    else:
+        _fix_tr(hdr, rec)
+        nii_shape = hdr.get_data_shape()
 
+    # after _fix_tr, so that the phase has the same header
+    phase_nii = None
     if PAR is not None and 'phase' in PAR['image_types']:
         phase_file = dest_path / f'{make_bids_name(name)}_phase.nii.gz'
         lg.info(f'Splitting phase info to {phase_file.name}')
-        phase_nii = select(output_nii, 'split')
-        phase_nii.to_filename(phase_file)
+        img, phase_nii = select(img, 'split')
+
+    with gzip_threads(GZIP_THREADS):
+        if deface and rec.modality in DEFACE_MODALITIES:
+            tmp_nii = _make_tmp_file(output_nii.parent, '.nii')  # not compressed, it's only read by mri_deface
+            _write_nii(img, hdr, file.path, tmp_nii)
+            run_deface(tmp_nii, output_nii)
+            tmp_nii.unlink()
+        else:
+            _write_nii(img, hdr, file.path, output_nii)
 
-    if deface and rec.modality in ('T1w', 'T2w', 'T2star', 'PD', 'FLAIR'):
-        run_deface(output_nii)
+        if phase_nii is not None:
+            nisave(phase_nii, phase_file)
 
     sidecar = _convert_sidecar(run, rec, PAR, nii_shape)
     sidecar_file = replace_extension(output_nii, '.json')
@@ -79,48 +98,99 @@ def convert_mri(run, rec, dest_path, name, deface=True):
     return output_nii
 
 
-def select(nii, slicing):
-    """If slicing is "split", it returns the nifti of the second half"""
-    img = niload(nii)
+def find_mri_file(rec):
+    """Find the PAR/REC or, if missing, the nifti file of a recording (None if
+    there is no file which can be converted)"""
+    file = find_one_file(rec, ('parrec', ))
+    if file is None:
+        file = find_one_file(rec, ('nifti', ))
+        if file is not None and not file.path.name.endswith(('.nii.gz', '.nii')):
+            lg.warning(f'Unknown extension for nifti for {file.path}')
+            return None
+
+    return file
+
+
+def select(img, slicing):
+    """Select the volumes of the image (in memory)
+
+    Returns
+    -------
+    instance of Nifti1Image
+        image with the selected volumes
+    instance of Nifti1Image
+        if slicing is "split", the image with the second half, otherwise None
+    """
     half = int(img.shape[3] / 2)
     secondhalf = None
 
     if slicing == 'first':
-        img = img.slicer[:, :, :, 0]
+        img_sel = _slice_volumes(img, 0)
 
     elif slicing == 'firsthalf':
-        img = img.slicer[:, :, :, :half]
+        img_sel = _slice_volumes(img, slice(None, half))
 
     elif slicing == 'secondhalf':
-        img = img.slicer[:, :, :, half:]
+        img_sel = _slice_volumes(img, slice(half, None))
 
     elif slicing == 'split':
-        secondhalf = img.slicer[:, :, :, half:]
-        img = img.slicer[:, :, :, :half]
+        secondhalf = _slice_volumes(img, slice(half, None))
+        img_sel = _slice_volumes(img, slice(None, half))
 
-    img.to_filename(nii)
+    return img_sel, secondhalf
 
-    return secondhalf
 
+def _slice_volumes(img, volumes):
+    """Like img.slicer[:, :, :, volumes], but it keeps the scaling of the data
+    (the image from PAR/REC has the data which is not scaled yet, while a
+    NIfTI file returns the scaled data)"""
+    slope, inter = img.header.get_slope_inter()
+    out = img.__class__(img.dataobj[:, :, :, volumes], img.affine, img.header)
+    out.header.set_slope_inter(slope, inter)
+    return out
 
-def _fix_tr(nii, rec):
-    """
-    Returns
-    -------
-    tuple
-        shape of the nifti file
-    """
-    img = niload(str(nii))
 
+def _fix_tr(hdr, rec):
+    """Modify the header in place"""
     # this seems a bug in nibabel. It stores time in sec, not in msec
-    img.header.set_xyzt_units('mm', 'sec')
+    hdr.set_xyzt_units('mm', 'sec')
 
     if rec.modality in ('bold', 'epi') and rec.RepetitionTime is not None:
-        img.header['pixdim'][4] = rec.RepetitionTime
+        hdr['pixdim'][4] = rec.RepetitionTime
+
 
-    nisave(img, str(nii))
+def _read_header(nii, img):
+    """Header of the NIfTI file as it is stored (the header of the image
+    loaded by nibabel does not have the scaling of the data)"""
+    with ImageOpener(nii) as f:
+        return img.header.__class__.from_fileobj(f)
 
-    return img.shape
+
+def _write_nii(img, hdr, input_nii, output_nii):
+    """Write the image (if hdr is None) or the input file with the new header"""
+    if hdr is None:
+        nisave(img, output_nii)
+    else:
+        _copy_with_header(input_nii, hdr, output_nii)
+
+
+def _copy_with_header(input_nii, hdr, output_nii):
+    """Copy a NIfTI file, replacing only its header (the header has the same
+    size, so the extensions and the voxel data are copied as they are). If the
+    header and the compression do not change, the file is copied."""
+    new_block = hdr.binaryblock
+    with ImageOpener(input_nii) as f_in:
+        old_block = f_in.read(len(new_block))
+
+    same_compression = input_nii.name.endswith('.gz') == output_nii.name.endswith('.gz')
+    if old_block == new_block and same_compression:
+        copyfile(input_nii, output_nii)
+        return
+
+    with ImageOpener(input_nii) as f_in, ImageOpener(output_nii, 'wb') as f_out:
+        f_in.seek(len(new_block))
+        f_out.write(new_block)
+        copyfileobj(f_in, f_out)
 
 
 def _convert_sidecar(run, rec, hdr=None, shape=None):
@@ -190,17 +260,21 @@ def add_slicetiming(D, hdr, rec):
     D['SliceTiming'] = SliceTiming.tolist()
 
 
-def run_deface(nii):
+def run_deface(nii, output_nii=None):
+    """Remove the face with mri_deface. If output_nii is None, nii is replaced
+    """
     lg.info(f'Defacing {nii.name}, it might take a while')
     path_avg = Path(environ['FREESURFER_HOME']) / 'average'
 
-    # generate a unique file name in the same folder
-    if nii.name.endswith('.nii.gz'):
-        suffix = '.nii.gz'
-    elif nii.name.endswith('.nii'):
-        suffix = '.nii'
-    nii_tmp = Path(mkstemp(dir=nii.parent, suffix=suffix)[1])
-    nii_tmp.unlink()
+    if output_nii is None:
+        # generate a unique file name in the same folder
+        if nii.name.endswith('.nii.gz'):
+            suffix = '.nii.gz'
+        elif nii.name.endswith('.nii'):
+            suffix = '.nii'
+        nii_tmp = _make_tmp_file(nii.parent, suffix)
+    else:
+        nii_tmp = output_nii
 
     run([
         'mri_deface',  # from freesurfer
@@ -212,10 +286,18 @@ def run_deface(nii):
         cwd=gettempdir(),
         )
 
-    nii_tmp.rename(nii)
+    if output_nii is None:
+        nii_tmp.rename(nii)
+
+
+def _make_tmp_file(folder, suffix):
+    """Unique file name in the folder (the file does not exist)"""
+    tmp_file = Path(mkstemp(dir=folder, suffix=suffix)[1])
+    tmp_file.unlink()
+    return tmp_file
 
 
 def gz(input_file, output_file):
     with input_file.open('rb') as f_in:
-        with gzip.open(output_file, 'wb') as f_out:
+        with ParallelGzipFile(output_file, 'wb', threads=GZIP_THREADS) as f_out:
             copyfileobj(f_in, f_out)
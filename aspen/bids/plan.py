@@ -0,0 +1,506 @@
+"""Plan the conversion to BIDS, without writing any file.
+
+The plan resolves, on the main thread, everything which depends on the other
+runs: the BIDS names (with the session and run counters), the input file of
+each recording, the names of the output files and the IntendedFor targets.
+Each conversion in the plan (a task) only depends on its own recording, so the
+tasks can be executed in any order, also in other processes (see create_bids).
+
+The tasks are dicts with keys:
+
+    'kind' : 'mri', 'ephys', 'physio' or 'events'
+    'session_id', 'run_id', 'recording_id' : ids of the session, the run and
+                                             the recording ('events' has no
+                                             recording)
+    'file_id' : id of the input file ('mri' and 'ephys')
+    'dest_path' : modality folder
+    'name' : parts of the BIDS name (see make_bids_name)
+    'output' : main output file ('physio' has no predictable output)
+    'writes' : files which can be written by the task (used to convert the
+               tasks which write the same files one after the other and to
+               find the output of each task, see task_outputs)
+    'intendedfor' : run id -> output of the T1w image of the electrodes
+                    ('ephys' only, see save_coordsystem)
+
+The plan can be stored (see save_plan) and executed later, also in another
+root BIDS directory (see load_plan and create_bids).
+"""
+from collections import defaultdict
+from copy import copy as c
+from datetime import date, datetime
+from json import dump, load
+from logging import getLogger
+from pathlib import Path
+
+from PyQt5.QtSql import QSqlQuery
+
+from ..api import load_tree, load_files
+from ..bidso.utils import replace_extension
+from ..api.utils import sort_subjects_date
+from .ephys import find_ephys_file, acq_label
+from .mri import find_mri_file
+from .utils import rename_task, make_bids_name, add_extra_fields_to_json
+
+lg = getLogger(__name__)
+
+MRI_MODALITIES = ('bold', 'T1w', 'T2w', 'T2star', 'PD', 'FLAIR', 'angio', 'epi')
+EPHYS_MODALITIES = ('ieeg', 'eeg', 'meg')
+BRAINVISION_SUFFIXES = ('.eeg', '.vhdr', '.vmrk', '.json')
+PHYSIO_RECORDINGS = ('recording-dataglove', 'recording-resp', 'recording-flip')
+
+PLAN_VERSION = 1
+PATH_KEY = '__path__'  # paths are stored relative to the root BIDS directory
+
+# protocols
+PROTOCOL_HEALTHY = [
+    '16-816',
+    ]
+
+
+def plan_bids(db, data_path, subset=None):
+    """Plan the conversion to BIDS
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    data_path : path
+        root BIDS directory
+    subset : dict
+        ids of 'subjects', 'sessions' and 'runs' to convert (all, if None). It
+        should already include the runs which are intended for the runs in the
+        subset (see add_intended_for)
+
+    Returns
+    -------
+    dict
+        with keys:
+            'data_path' : root BIDS directory
+            'directories' : folders to create, in order
+            'tasks' : conversions of each recording, in the serial order
+            'scans' : list of (tsv file, rows, root folder) for the _scans.tsv
+                      and _sessions.tsv files
+            'sessions_json' : sidecars of the _sessions.tsv files
+            'participants' : rows of participants.tsv
+            'scans_json' : description of the extra fields in the scans
+            'intendedfor' : run id -> main output of the run
+    """
+    data_path = Path(data_path)
+
+    if subset is not None:
+        subset_subj = set(subset['subjects'])
+        subset_sess = set(subset['sessions'])
+        subset_run = set(subset['runs'])
+
+    plan = {
+        'data_path': data_path,
+        'directories': [],
+        'tasks': [],
+        'scans': [],
+        'sessions_json': [],
+        'participants': [],
+        'scans_json': {},
+        'intendedfor': {},
+        }
+    intendedfor = plan['intendedfor']
+
+    if subset is None:
+        subjects = load_tree(db)
+    else:
+        subjects = load_tree(db, subset={'subjects': subset['subjects']})  # BIDS counters need all sessions and runs
+
+    # read the files of all the recordings at once
+    load_files(db, [
+        rec for subj in subjects for sess in subj.list_sessions()
+        for run in sess.list_runs() for rec in run.list_recordings()])
+
+    for subj in sorted(subjects, key=sort_subjects_date):
+        bids_name = {
+            'sub': None,
+            'ses': None,
+            'task': None,
+            'acq': None,
+            'rec': None,
+            'dir': None,
+            'run': None,
+            'recording': None,  # only for physiology
+            }
+        if subset is not None and subj.id not in subset_subj:
+            continue
+
+        reference_date = _reference_date(subj)
+
+        lg.info(f'Adding {subj.codes}')
+        codes = subj.codes
+        if len(codes) == 0:
+            code = 'id{subj.id}'  # use id if code is empty
+        else:
+            code = codes[0]
+        bids_name['sub'] = 'sub-' + code
+        subj_path = data_path / bids_name['sub']
+        plan['directories'].append(subj_path)
+
+        if subj.date_of_birth is None:
+            lg.warning(f'You need to add date_of_birth to {subj.codes}')
+            age = 'n/a'
+        else:
+            age = (reference_date - subj.date_of_birth).days // 365.2425
+            age = f'{age:.0f}'
+
+        patient_or_healthy = 'patient'
+        for p in subj.list_protocols():
+            if p.metc in PROTOCOL_HEALTHY:
+                patient_or_healthy = 'healthy'
+
+        plan['participants'].append({
+            'participant_id': bids_name['sub'],
+            'sex': subj.sex,
+            'age': age,
+            'group': patient_or_healthy,
+            })
+
+        sess_count = defaultdict(int)
+        sess_files = []
+        for sess in subj.list_sessions():
+            sess_count[_make_sess_name(sess)] += 1  # also count the sessions which are not included
+            if subset is not None and sess.id not in subset_sess:
+                continue
+
+            bids_name['ses'] = f'ses-{_make_sess_name(sess)}{sess_count[_make_sess_name(sess)]}'
+            sess_path = subj_path / bids_name['ses']
+            plan['directories'].append(sess_path)
+            lg.info(f'Adding {bids_name["sub"]} / {bids_name["ses"]}')
+
+            sess_files.append({
+                'session_id': bids_name['ses'],
+                'resection': 'n/a',
+                'implantation': 'no',
+                })
+            if sess.name in ('IEMU', 'OR', 'CT'):
+                sess_files[-1]['implantation'] = 'yes'
+
+            run_count = defaultdict(int)
+            run_files = []
+            for run in sess.list_runs():
+                run_count[run.task_name] += 1  # also count the runs which are not included
+
+                if subset is not None and run.id not in subset_run:
+                    continue
+
+                if len(run.list_recordings()) == 0:
+                    lg.warning(f'No recordings for {subj.codes}/{run.task_name}')
+                    continue
+
+                acquisition = get_bids_acquisition(run)
+                bids_name['run'] = f'run-{run_count[run.task_name]}'
+
+                if acquisition in ('ieeg', 'eeg', 'meg', 'func'):
+                    bids_name['task'] = f'task-{rename_task(run.task_name)}'
+                else:
+                    bids_name['task'] = None
+                mod_path = sess_path / acquisition
+                plan['directories'].append(mod_path)
+                lg.info(f'Adding {bids_name["sub"]} / {bids_name["ses"]} / {acquisition} / {bids_name["task"]} ({run})')
+
+                data_name = None
+                events_tsv = set()
+                for rec in run.list_recordings():
+
+                    # dir can only go with bold and epi modality
+                    if rec.modality in ('bold', 'epi') and rec.PhaseEncodingDirection is not None:
+                        bids_name['dir'] = 'dir-' + rec.PhaseEncodingDirection
+                    else:
+                        bids_name['dir'] = None
+
+                    task = {
+                        'kind': None,
+                        'session_id': sess.id,
+                        'run_id': run.id,
+                        'recording_id': rec.id,
+                        'dest_path': mod_path,
+                        'name': c(bids_name),
+                        }
+
+                    if rec.modality in MRI_MODALITIES:
+                        data_name = None
+                        file = find_mri_file(rec)
+                        if file is not None:
+                            data_name = mod_path / f'{make_bids_name(bids_name)}_{rec.modality}.nii.gz'
+                            phase_file = mod_path / f'{make_bids_name(bids_name)}_phase.nii.gz'
+                            writes = [data_name, replace_extension(data_name, '.json'), phase_file]
+                            task.update(kind='mri', file_id=file.id, output=data_name, writes=writes)
+                            plan['tasks'].append(task)
+
+                    elif rec.modality in EPHYS_MODALITIES:
+                        if run.duration is None:
+                            lg.warning(f'You need to specify duration for {subj.codes}/{run}')
+                            continue
+                        data_name = None
+                        file = find_ephys_file(rec)
+                        if file is not None:
+                            name = c(bids_name)
+                            electrodes = rec.electrodes
+                            targets = {}
+                            writes = []
+                            if electrodes is not None:
+                                name['acq'] = acq_label(electrodes)
+                                if electrodes.IntendedFor in intendedfor:
+                                    targets[electrodes.IntendedFor] = intendedfor[electrodes.IntendedFor]
+                                writes.append(mod_path / make_bids_name(name, 'electrodes'))
+                                writes.append(mod_path / make_bids_name(name, 'coordsystem'))
+                            else:
+                                name['acq'] = None
+                            data_name = mod_path / make_bids_name(name, rec.modality)
+                            writes.append(mod_path / make_bids_name(name, 'channels'))
+                            writes.extend(data_name.with_suffix(suffix) for suffix in BRAINVISION_SUFFIXES)
+                            task.update(kind='ephys', file_id=file.id, output=data_name, intendedfor=targets, writes=writes)
+                            plan['tasks'].append(task)
+
+                    elif rec.modality == 'physio':
+                        if data_name is None:
+                            lg.warning('physio only works after another recording modality')
+                        elif acquisition == 'fmap':
+                            lg.info('physio was recorded but BIDS says that it should not be included in fmap')
+                        else:
+                            writes = []
+                            for recording in PHYSIO_RECORDINGS:  # the recording depends on the file
+                                physio_tsv = mod_path / make_bids_name(dict(bids_name, recording=recording), 'physio')
+                                writes.extend([physio_tsv, replace_extension(physio_tsv, '.json')])
+                            task.update(kind='physio', output=None, writes=writes)
+                            plan['tasks'].append(task)
+
+                    else:
+                        lg.warning(f'Unknown modality {rec.modality} for {rec}')
+                        continue
+
+                    if data_name is not None and acquisition in ('ieeg', 'eeg', 'meg', 'func'):
+                        output = mod_path / f'{make_bids_name(bids_name)}_events.tsv'
+                        if output not in events_tsv:  # the same events are written only once
+                            events_tsv.add(output)
+                            plan['tasks'].append({
+                                'kind': 'events',
+                                'session_id': sess.id,
+                                'run_id': run.id,
+                                'dest_path': mod_path,
+                                'name': c(bids_name),
+                                'output': output,
+                                'writes': [output, ],
+                                })
+
+                    if data_name is not None and rec.modality != 'physio':  # secondary modality
+                        intendedfor[run.id] = data_name
+                        fields = {
+                            'filename': data_name,
+                            'acq_time': _set_date_to_1900(reference_date, run.start_time).isoformat(timespec='seconds'),
+                            }
+                        run_files.append(add_extra_fields_to_json(run, fields, plan['scans_json']))
+
+            if len(run_files) == 0:
+                continue
+            tsv_file = sess_path / f'{bids_name["sub"]}_{bids_name["ses"]}_scans.tsv'
+            plan['scans'].append((tsv_file, run_files, sess_path))
+
+        tsv_file = subj_path / f'{bids_name["sub"]}_sessions.tsv'
+        if sess_files:
+            plan['scans'].append((tsv_file, sess_files, data_path))
+        plan['sessions_json'].append(tsv_file.with_suffix('.json'))
+
+    return plan
+
+
+def dataset_files(plan):
+    """Files which describe the whole dataset (they are not part of a task)"""
+    data_path = plan['data_path']
+    files = [tsv_file for tsv_file, _, _ in plan['scans']]
+    files.extend(plan['sessions_json'])
+    files.extend(data_path / f for f in (
+        'dataset_description.json',
+        'README',
+        'participants.tsv',
+        'participants.json',
+        'scans.json',
+        '.bids-validator-config.json',
+        ))
+    return files
+
+
+def save_plan(plan, json_file):
+    """Store the plan (see plan_bids), so that it can be executed later
+
+    Parameters
+    ----------
+    plan : dict
+        output of plan_bids
+    json_file : path
+        file where the plan is stored
+
+    Notes
+    -----
+    The paths are stored relative to the root BIDS directory.
+    """
+    data_path = plan['data_path']
+    stored = _map_paths(plan, lambda path: {PATH_KEY: str(path.relative_to(data_path))})
+    stored['version'] = PLAN_VERSION
+    stored['data_path'] = str(data_path)
+    with Path(json_file).open('w') as f:
+        dump(stored, f, indent=1)
+
+
+def load_plan(json_file, data_path=None):
+    """Read a plan which was stored with save_plan
+
+    Parameters
+    ----------
+    json_file : path
+        file where the plan is stored
+    data_path : path
+        root BIDS directory (if None, the directory of the stored plan)
+
+    Returns
+    -------
+    dict
+        plan (see plan_bids)
+    """
+    with Path(json_file).open() as f:
+        stored = load(f)
+
+    if stored.get('version') != PLAN_VERSION:
+        raise ValueError(f'{json_file} was written by another version of aspen, please plan the conversion again')
+
+    if data_path is None:
+        data_path = stored['data_path']
+    data_path = Path(data_path)
+
+    plan = _map_stored_paths(stored, data_path)
+    plan.pop('version')
+    plan['data_path'] = data_path
+
+    # json only has str keys and lists
+    plan['intendedfor'] = {int(k): v for k, v in plan['intendedfor'].items()}
+    for task in plan['tasks']:
+        if 'intendedfor' in task:
+            task['intendedfor'] = {int(k): v for k, v in task['intendedfor'].items()}
+    plan['scans'] = [tuple(x) for x in plan['scans']]
+    return plan
+
+
+def rebase_plan(plan, data_path):
+    """The same plan, in another root BIDS directory
+
+    Parameters
+    ----------
+    plan : dict
+        output of plan_bids (or load_plan)
+    data_path : path
+        new root BIDS directory
+
+    Returns
+    -------
+    dict
+        plan where all the paths are in data_path (it's the same plan, if
+        data_path does not change)
+    """
+    data_path = Path(data_path)
+    old_path = plan['data_path']
+    if data_path == old_path:
+        return plan
+    return _map_paths(plan, lambda path: data_path / path.relative_to(old_path))
+
+
+def _map_paths(x, func):
+    """Apply func to all the paths in the plan"""
+    if isinstance(x, Path):
+        return func(x)
+    elif isinstance(x, dict):
+        return {k: _map_paths(v, func) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_map_paths(v, func) for v in x]
+    elif isinstance(x, tuple):
+        return tuple(_map_paths(v, func) for v in x)
+    return x
+
+
+def _map_stored_paths(x, data_path):
+    """Inverse of the mapping in save_plan"""
+    if isinstance(x, dict):
+        if list(x) == [PATH_KEY, ]:
+            return data_path / x[PATH_KEY]
+        return {k: _map_stored_paths(v, data_path) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_map_stored_paths(v, data_path) for v in x]
+    return x
+
+
+def get_bids_acquisition(run):
+    for recording in run.list_recordings():
+        modality = recording.modality
+        if modality == 'ieeg':
+            return 'ieeg'
+        elif modality == 'eeg':
+            return 'eeg'
+        elif modality == 'meg':
+            return 'meg'
+        elif modality in ('T1w', 'T2w', 'T2star', 'FLAIR', 'PD', 'angio'):
+            return 'anat'
+        elif modality in ('bold', 'phase'):
+            return 'func'
+        elif modality in ('epi', ):
+            return 'fmap'
+        elif modality in ('ct', ):
+            return 'ct'
+
+    raise ValueError(f'I cannot determine BIDS folder for {repr(run)}')
+
+
+def _make_sess_name(sess):
+    if sess.name == 'MRI':
+        MagneticFieldStrength = sess.MagneticFieldStrength
+        if MagneticFieldStrength is None:
+            lg.warning(f'Please specify Magnetic Field Strength for {sess}')
+            sess_name = 'mri'
+        elif MagneticFieldStrength == '1.5T':  # we cannot use 1.5 in session name
+            sess_name = 'mri'
+        else:
+            sess_name = MagneticFieldStrength.lower()
+    else:
+        sess_name = sess.name.lower()
+    return sess_name
+
+
+def find_intendedfor(db, run_id):
+    query = QSqlQuery(db['db'])
+    query.prepare("SELECT target FROM intended_for WHERE run_id = :runid")
+    query.bindValue(':runid', run_id)
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    topups = []
+    while query.next():
+        topups.append(query.value('target'))
+    return topups
+
+
+def _reference_date(subj):
+    """use relative date based on date_of_signature"""
+    reference_dates = [p.date_of_signature for p in subj.list_protocols()]
+    reference_dates = [date for date in reference_dates if date is not None]
+    if len(reference_dates) == 0:
+        lg.warning(f'You need to add at least one research protocol with dates for {subj.codes}')
+        lg.info('Using date of the first task performed by the subject')
+        reference_dates = [x.start_time for x in subj.list_sessions() if x.start_time is not None]
+        if len(reference_dates):
+            return min(reference_dates).date()
+        else:
+            return datetime(2000, 1, 1, 12, 0, 0)  # if no task has dates, then use a random date
+    else:
+        return max(reference_dates)
+
+
+def _set_date_to_1900(base_date, datetime_of_interest):
+    if datetime_of_interest is None:  # run.start_time is null
+        return datetime(1900, 1, 1, 0, 0, 0)
+    else:
+        return datetime.combine(
+            date(1900, 1, 1) + (datetime_of_interest.date() - base_date),
+            datetime_of_interest.time())
@@ -1,228 +1,384 @@
-from json import dump, load
-from pathlib import Path
-from copy import copy as c
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy as c, deepcopy
+from json import dumps, load
 from logging import getLogger
-from datetime import date, datetime
-from shutil import copy, rmtree
+from logging.handlers import QueueHandler
+from multiprocessing import get_context
+from os import cpu_count
+from pathlib import Path
+from shutil import rmtree
 
 from ..bidso.utils import replace_extension
+from PyQt5.QtCore import QCoreApplication
 from PyQt5.QtSql import QSqlQuery
 
-from ..api import list_subjects, Run
+from ..api import Session, Run, Recording, File
+from ..database.pool import connection_info, open_connection
+from . import mri
 from .mri import convert_mri
 from .ephys import convert_ephys
 from .physio import convert_physio
 from .events import convert_events
-from .utils import rename_task, prepare_subset, add_extra_fields_to_json
+from .manifest import read_manifest, write_manifest, compute_fingerprints, task_key, task_outputs
+from .plan import plan_bids, rebase_plan, dataset_files, find_intendedfor
+from .utils import prepare_subset
 from .templates import (
     JSON_PARTICIPANTS,
     JSON_SESSIONS,
     )
 
-# protocols
-PROTOCOL_HEALTHY = [
-    '16-816',
-    ]
-
 
 lg = getLogger(__name__)
 
+# state of the worker processes (see _init_worker)
+_worker = {}
+
 
-def create_bids(db, data_path, deface=True, subset=None, keep_phase=False):
+def create_bids(db, data_path, deface=True, subset=None, keep_phase=False, n_workers=1, incremental=False, plan=None):
+    """Convert the data in the database to BIDS
 
-    if subset is not None:
-        subset = add_intended_for(db, subset)
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    data_path : path
+        root BIDS directory (it's deleted, if it exists, unless incremental)
+    deface : bool
+        remove the face from the anatomical MRI
+    subset : dict
+        ids of 'subjects', 'sessions' and 'runs' to convert (all, if None)
+    keep_phase : bool
+        keep the phase images (the BIDS validator does not accept them)
+    n_workers : int
+        number of processes which convert the recordings at the same time (if
+        None, one per CPU). If 1, the recordings are converted in this
+        process.
+    incremental : bool
+        if data_path has the manifest of a previous export (see
+        aspen.bids.manifest), convert only the recordings which changed and
+        remove the files which are not part of the dataset anymore. It writes
+        the manifest for the next export.
+    plan : dict
+        plan of the conversion (output of plan_bids or load_plan), f.e. if it
+        was already estimated (see aspen.bids.estimate). It's executed in
+        data_path. If None, the conversion of the subset is planned here.
+
+    Raises
+    ------
+    ValueError
+        if both subset and plan are specified (the plan already has the
+        subset)
+
+    Notes
+    -----
+    First, the whole conversion is planned in this process (see plan_bids),
+    then the recordings are converted and the files which describe the whole
+    dataset are written at the end, so the output does not depend on
+    n_workers.
+    Each worker process opens its own connection to the database, so it
+    does not see the changes which have not been committed yet.
+    """
+    if plan is not None and subset is not None:
+        raise ValueError('Specify either subset or plan (the subset is chosen when the plan is made)')
 
-        subset_subj = set(subset['subjects'])
-        subset_sess = set(subset['sessions'])
-        subset_run = set(subset['runs'])
+    if plan is None:
+        if subset is not None:
+            subset = add_intended_for(db, subset)
+        plan = plan_bids(db, data_path, subset=subset)
+    else:
+        plan = rebase_plan(plan, data_path)
 
-    data_path = Path(data_path)
-    if data_path.exists():
-        rmtree(data_path, ignore_errors=True)
+    data_path = plan['data_path']
+    tasks = plan['tasks']
+
+    manifest = None
+    if incremental:
+        fingerprints = compute_fingerprints(db, plan, deface=deface, keep_phase=keep_phase)
+        manifest = read_manifest(data_path)
+
+    if manifest is None:
+        if data_path.exists():
+            rmtree(data_path, ignore_errors=True)
+    else:
+        tasks = _update_dataset(plan, manifest, fingerprints)
     data_path.mkdir(parents=True, exist_ok=True)
 
     # the dataset_description.json is used by find_root, in some subscripts
     _make_dataset_description(data_path)
 
-    intendedfor = {}
-    scans_json = {}
-
-    participants = []
-    for subj in list_subjects(db):
-        bids_name = {
-            'sub': None,
-            'ses': None,
-            'task': None,
-            'acq': None,
-            'rec': None,
-            'dir': None,
-            'run': None,
-            'recording': None,  # only for physiology
-            }
-        if subset is not None and subj.id not in subset_subj:
-            continue
+    for directory in plan['directories']:
+        directory.mkdir(parents=True, exist_ok=True)
 
-        # use relative date based on date_of_signature
-        reference_dates = [p.date_of_signature for p in subj.list_protocols()]
-        reference_dates = [date for date in reference_dates if date is not None]
-        if len(reference_dates) == 0:
-            lg.warning(f'You need to add at least one research protocol with dates for {subj.codes}')
-            lg.info('Using date of the first task performed by the subject')
-            reference_dates = [x.start_time for x in subj.list_sessions() if x.start_time is not None]
-            if len(reference_dates):
-                reference_date = min(reference_dates).date()
-            else:
-                reference_date = datetime(2000, 1, 1, 12, 0, 0)  # if no task has dates, then use a random date
-        else:
-            reference_date = max(reference_dates)
+    convert_tasks(db, tasks, deface=deface, n_workers=n_workers)
 
-        lg.info(f'Adding {subj.codes}')
-        codes = subj.codes
-        if len(codes) == 0:
-            code = 'id{subj.id}'  # use id if code is empty
-        else:
-            code = codes[0]
-        bids_name['sub'] = 'sub-' + code
-        subj_path = data_path / bids_name['sub']
-        subj_path.mkdir(parents=True, exist_ok=True)
-
-        if subj.date_of_birth is None:
-            lg.warning(f'You need to add date_of_birth to {subj.codes}')
-            age = 'n/a'
-        else:
-            age = (reference_date - subj.date_of_birth).days // 365.2425
-            age = f'{age:.0f}'
-
-        patient_or_healthy = 'patient'
-        for p in subj.list_protocols():
-            if p.metc in PROTOCOL_HEALTHY:
-                patient_or_healthy = 'healthy'
-
-        participants.append({
-            'participant_id': bids_name['sub'],
-            'sex': subj.sex,
-            'age': age,
-            'group': patient_or_healthy,
-            })
-
-        sess_count = defaultdict(int)
-        sess_files = []
-        for sess in subj.list_sessions():
-            sess_count[_make_sess_name(sess)] += 1  # also count the sessions which are not included
-            if subset is not None and sess.id not in subset_sess:
-                continue
-
-            bids_name['ses'] = f'ses-{_make_sess_name(sess)}{sess_count[_make_sess_name(sess)]}'
-            sess_path = subj_path / bids_name['ses']
-            sess_path.mkdir(parents=True, exist_ok=True)
-            lg.info(f'Adding {bids_name["sub"]} / {bids_name["ses"]}')
-
-            sess_files.append({
-                'session_id': bids_name['ses'],
-                'resection': 'n/a',
-                'implantation': 'no',
-                })
-            if sess.name in ('IEMU', 'OR', 'CT'):
-                sess_files[-1]['implantation'] = 'yes'
-
-            run_count = defaultdict(int)
-            run_files = []
-            for run in sess.list_runs():
-                run_count[run.task_name] += 1  # also count the runs which are not included
-
-                if subset is not None and run.id not in subset_run:
-                    continue
-
-                if len(run.list_recordings()) == 0:
-                    lg.warning(f'No recordings for {subj.codes}/{run.task_name}')
-                    continue
-
-                acquisition = get_bids_acquisition(run)
-                bids_name['run'] = f'run-{run_count[run.task_name]}'
-
-                if acquisition in ('ieeg', 'eeg', 'meg', 'func'):
-                    bids_name['task'] = f'task-{rename_task(run.task_name)}'
-                else:
-                    bids_name['task'] = None
-                mod_path = sess_path / acquisition
-                mod_path.mkdir(parents=True, exist_ok=True)
-                lg.info(f'Adding {bids_name["sub"]} / {bids_name["ses"]} / {acquisition} / {bids_name["task"]} ({run})')
-
-                data_name = None
-                for rec in run.list_recordings():
-
-                    # dir can only go with bold and epi modality
-                    if rec.modality in ('bold', 'epi') and rec.PhaseEncodingDirection is not None:
-                        bids_name['dir'] = 'dir-' + rec.PhaseEncodingDirection
-                    else:
-                        bids_name['dir'] = None
-
-                    if rec.modality in ('bold', 'T1w', 'T2w', 'T2star', 'PD', 'FLAIR', 'angio', 'epi'):
-                        data_name = convert_mri(run, rec, mod_path, c(bids_name), deface)
-
-                    elif rec.modality in ('ieeg', 'eeg', 'meg'):
-                        if run.duration is None:
-                            lg.warning(f'You need to specify duration for {subj.codes}/{run}')
-                            continue
-                        data_name = convert_ephys(run, rec, mod_path, c(bids_name), intendedfor)
-
-                    elif rec.modality == 'physio':
-                        if data_name is None:
-                            lg.warning('physio only works after another recording modality')
-                        elif acquisition == 'fmap':
-                            lg.info('physio was recorded but BIDS says that it should not be included in fmap')
-                        else:
-                            convert_physio(rec, mod_path, c(bids_name))
-
-                    else:
-                        lg.warning(f'Unknown modality {rec.modality} for {rec}')
-                        continue
-
-                    if data_name is not None and acquisition in ('ieeg', 'eeg', 'meg', 'func'):
-                        convert_events(run, mod_path, c(bids_name))
-
-                    if data_name is not None and rec.modality != 'physio':  # secondary modality
-                        intendedfor[run.id] = data_name
-                        fields = {
-                            'filename': data_name,
-                            'acq_time': _set_date_to_1900(reference_date, run.start_time).isoformat(timespec='seconds'),
-                            }
-                        run_files.append(add_extra_fields_to_json(run, fields, scans_json))
-
-            if len(run_files) == 0:
-                continue
-            tsv_file = sess_path / f'{bids_name["sub"]}_{bids_name["ses"]}_scans.tsv'
-            if run_files:
-                _list_scans(tsv_file, c(run_files), sess_path)
-
-        tsv_file = subj_path / f'{bids_name["sub"]}_sessions.tsv'
-        if sess_files:
-            _list_scans(tsv_file, sess_files, data_path)
-
-        json_sessions = tsv_file.with_suffix('.json')
-        copy(JSON_SESSIONS, json_sessions)  # https://github.com/bids-standard/bids-validator/issues/888
+    for tsv_file, scans, root_dir in plan['scans']:
+        _list_scans(tsv_file, deepcopy(scans), root_dir)
+
+    for json_sessions in plan['sessions_json']:
+        _write_if_changed(json_sessions, JSON_SESSIONS.read_text())  # https://github.com/bids-standard/bids-validator/issues/888
 
     # add IntendedFor for top_up scans
-    _add_intendedfor(db, data_path, intendedfor)
+    _add_intendedfor(db, data_path, plan['intendedfor'])
 
     # remove phase because we get lots of warnings from BIDS
     if not keep_phase:
         remove_phase(data_path)
 
     # here the rest
-    if len(scans_json) > 0:
-        with (data_path / 'scans.json').open('w') as f:
-            dump(scans_json, f, ensure_ascii=False, indent=' ')
+    if len(plan['scans_json']) > 0:
+        _write_if_changed(data_path / 'scans.json', dumps(plan['scans_json'], ensure_ascii=False, indent=' '))
 
     _make_README(data_path)
     tsv_file = data_path / 'participants.tsv'
-    _list_scans(tsv_file, participants, data_path)
+    _list_scans(tsv_file, deepcopy(plan['participants']), data_path)
     json_participants = tsv_file.with_suffix('.json')
-    copy(JSON_PARTICIPANTS, json_participants)
+    _write_if_changed(json_participants, JSON_PARTICIPANTS.read_text())
     _make_bids_config(data_path)
 
+    if incremental:
+        write_manifest(
+            data_path,
+            {task_key(task, data_path): {
+                'fingerprint': fingerprints[task_key(task, data_path)],
+                'outputs': task_outputs(task, data_path),
+                } for task in plan['tasks']},
+            [str(f.relative_to(data_path)) for f in dataset_files(plan) if f.exists()],
+            [str(d.relative_to(data_path)) for d in plan['directories']],
+            )
+
+
+def _update_dataset(plan, manifest, fingerprints):
+    """Compare the plan with the manifest of the previous export and remove
+    the files which are not up-to-date
+
+    Returns
+    -------
+    list of dict
+        tasks which need to be converted (the tasks which write the same files
+        as a task which changed are converted again too, see _chain_tasks)
+    """
+    data_path = plan['data_path']
+    old_tasks = manifest['tasks']
+
+    # files written by the tasks which are not in the dataset anymore
+    removed = set()
+    for key, old in old_tasks.items():
+        if key not in fingerprints:
+            removed.update(old['outputs'])
+
+    changed = set()
+    for task in plan['tasks']:
+        key = task_key(task, data_path)
+        old = old_tasks.get(key)
+        if (old is None or old['fingerprint'] != fingerprints[key]
+                or not all((data_path / f).exists() for f in old['outputs'])
+                or removed.intersection(old['outputs'])):  # f.e. a removed run had the same BIDS name
+            changed.add(key)
+
+    to_convert = set()
+    for chain in _chain_tasks(plan['tasks']):
+        keys = [task_key(task, data_path) for task in chain]
+        if changed.intersection(keys):
+            to_convert.update(keys)
+
+    up_to_date = set()  # files of the tasks which are not converted again
+    for task in plan['tasks']:
+        key = task_key(task, data_path)
+        if key not in to_convert:
+            up_to_date.update(old_tasks[key]['outputs'])
+
+    to_remove = set(manifest['files']) - {str(f.relative_to(data_path)) for f in dataset_files(plan)}
+    to_remove.update(removed)
+    for key in to_convert:
+        to_remove.update(old_tasks.get(key, {}).get('outputs', []))
+    _remove_files(data_path, sorted(to_remove - up_to_date))
+
+    directories = {str(d.relative_to(data_path)) for d in plan['directories']}
+    _remove_empty_folders(data_path, [d for d in manifest['directories'] if d not in directories])
+
+    lg.info(f'{len(to_convert)} of {len(plan["tasks"])} conversions are not up-to-date')
+    return [task for task in plan['tasks'] if task_key(task, data_path) in to_convert]
+
+
+def _remove_files(data_path, files):
+    """Remove the files (relative to data_path) and the folders which become
+    empty"""
+    folders = set()
+    for f in files:
+        path = data_path / f
+        lg.info(f'Removing {path}')
+        path.unlink(missing_ok=True)
+        folders.update(str(folder.relative_to(data_path)) for folder in path.parents if data_path in folder.parents)
+
+    _remove_empty_folders(data_path, folders)
+
+
+def _remove_empty_folders(data_path, folders):
+    """Remove the folders (relative to data_path) if they are empty, the
+    deepest first"""
+    for folder in sorted(folders, key=lambda x: len(Path(x).parts), reverse=True):
+        path = data_path / folder
+        if path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+
+def _write_if_changed(path, text):
+    """Write the file only if the content changed (so that an incremental
+    export does not modify the files which are up-to-date)"""
+    if path.exists() and path.read_text() == text:
+        return
+    path.write_text(text)
+
+
+def convert_tasks(db, tasks, deface=True, n_workers=1):
+    """Convert the recordings planned by plan_bids
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    tasks : list of dict
+        conversions (see plan_bids)
+    deface : bool
+        remove the face from the anatomical MRI
+    n_workers : int
+        number of processes (if None, one per CPU). If 1, the tasks are
+        converted in this process.
+
+    Notes
+    -----
+    The tasks which write the same files (f.e. two runs which get the same
+    BIDS name) are converted one after the other, in the order of the plan,
+    so that the output is the same as when they are converted in this process.
+    The messages logged in the worker processes are logged again in this
+    process.
+    """
+    if n_workers is None:
+        n_workers = cpu_count()
+    chains = _chain_tasks(tasks)
+    n_workers = min(n_workers, len(chains))
+
+    if n_workers <= 1:
+        for task in tasks:
+            _convert(db, task, deface)
+        return
+
+    lg.info(f'Running {len(tasks)} conversions in {n_workers} processes')
+    executor = ProcessPoolExecutor(
+        n_workers,
+        mp_context=get_context('spawn'),  # Qt does not like fork
+        initializer=_init_worker,
+        initargs=(connection_info(db), getLogger('aspen').getEffectiveLevel(), n_workers),
+        )
+    try:
+        futures = [executor.submit(_convert_in_worker, chain, deface) for chain in chains]
+        for future in futures:
+            records, error = future.result()
+            for record in records:
+                getLogger(record.name).handle(record)
+            if error is not None:
+                raise error
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _chain_tasks(tasks):
+    """Group the tasks which write the same files
+
+    Returns
+    -------
+    list of list of dict
+        groups of tasks, each in the order of the plan
+    """
+    chains = {}  # index of the first task -> indices of the tasks
+    owner = {}  # file -> index of the first task of the chain
+    for i, task in enumerate(tasks):
+        firsts = sorted({owner[f] for f in task['writes'] if f in owner})
+        if len(firsts) == 0:
+            first = i
+            chains[first] = []
+        else:
+            first = firsts[0]
+            for other in firsts[1:]:  # this task joins two chains
+                for j in chains[other]:
+                    for f in tasks[j]['writes']:
+                        owner[f] = first
+                chains[first].extend(chains.pop(other))
+
+        chains[first].append(i)
+        for f in task['writes']:
+            owner[f] = first
+
+    return [[tasks[j] for j in sorted(chains[first])] for first in sorted(chains)]
+
+
+def _convert(db, task, deface):
+    run = Run(db, id=task['run_id'], session=Session(db, id=task['session_id']))
+    dest_path = task['dest_path']
+    name = c(task['name'])
+
+    if task['kind'] == 'events':
+        convert_events(run, dest_path, name)
+        return
+
+    rec = Recording(db, id=task['recording_id'], run=run)
+    if task['kind'] == 'mri':
+        convert_mri(run, rec, dest_path, name, deface, file=File(db, id=task['file_id']))
+
+    elif task['kind'] == 'ephys':
+        convert_ephys(run, rec, dest_path, name, task['intendedfor'], file=File(db, id=task['file_id']))
+
+    elif task['kind'] == 'physio':
+        convert_physio(rec, dest_path, name)
+
+
+class _RecordsHandler(QueueHandler):
+    """Keep the messages of the worker process, so that they can be logged
+    in the main process"""
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def enqueue(self, record):
+        self.records.append(record)
+
+
+def _init_worker(info, level, n_workers):
+    _worker['app'] = QCoreApplication.instance() or QCoreApplication([])
+    _worker['db'] = open_connection(info, 'bids_worker')
+
+    # the processes share the CPUs to compress the MRI
+    mri.GZIP_THREADS = max((cpu_count() or 1) // n_workers, 1)
+
+    handler = _worker['handler'] = _RecordsHandler()
+    logger = getLogger('aspen')
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+
+def _convert_in_worker(chain, deface):
+    """Convert some tasks, one after the other, in the worker process
+
+    Returns
+    -------
+    list of LogRecord
+        messages logged during the conversion
+    Exception or None
+        error raised during the conversion (the remaining tasks are skipped)
+    """
+    handler = _worker['handler']
+    handler.records = []
+    error = None
+    try:
+        for task in chain:
+            _convert(_worker['db'], task, deface)
+    except Exception as err:
+        error = err
+    finally:
+        _worker['db']['objects'].clear()  # do not keep the rows of the previous tasks
+    return handler.records, error
+
 
 def _list_scans(tsv_file, scans, root_dir):
     """
@@ -235,13 +391,13 @@ def _list_scans(tsv_file, scans, root_dir):
 
     cols = _find_columns(scans)
 
-    with tsv_file.open('w') as f:
-        f.write('\t'.join(cols) + '\n')
-        for scan in scans:
-            values = []
-            for k in cols:
-                values.append(scan.get(k, 'n/a'))
-            f.write('\t'.join(values) + '\n')
+    lines = ['\t'.join(cols) + '\n', ]
+    for scan in scans:
+        values = []
+        for k in cols:
+            values.append(scan.get(k, 'n/a'))
+        lines.append('\t'.join(values) + '\n')
+    _write_if_changed(tsv_file, ''.join(lines))
 
 
 def _make_dataset_description(data_path):
@@ -269,29 +425,7 @@ def _make_dataset_description(data_path):
         "DatasetDOI": ""
         }
 
-    with (data_path / 'dataset_description.json').open('w') as f:
-        dump(d, f, ensure_ascii=False, indent=' ')
-
-
-def get_bids_acquisition(run):
-    for recording in run.list_recordings():
-        modality = recording.modality
-        if modality == 'ieeg':
-            return 'ieeg'
-        elif modality == 'eeg':
-            return 'eeg'
-        elif modality == 'meg':
-            return 'meg'
-        elif modality in ('T1w', 'T2w', 'T2star', 'FLAIR', 'PD', 'angio'):
-            return 'anat'
-        elif modality in ('bold', 'phase'):
-            return 'func'
-        elif modality in ('epi', ):
-            return 'fmap'
-        elif modality in ('ct', ):
-            return 'ct'
-
-    raise ValueError(f'I cannot determine BIDS folder for {repr(run)}')
+    _write_if_changed(data_path / 'dataset_description.json', dumps(d, ensure_ascii=False, indent=' '))
 
 
 def add_intended_for(db, subset):
@@ -356,38 +490,12 @@ def _make_bids_config(data_path):
             ]
         }
 
-    with (data_path / '.bids-validator-config.json').open('w') as f:
-        dump(d, f, ensure_ascii=False, indent=' ')
+    _write_if_changed(data_path / '.bids-validator-config.json', dumps(d, ensure_ascii=False, indent=' '))
 
 
 def _make_README(data_path):
 
-    with (data_path / 'README').open('w') as f:
-        f.write('Converted with aspen')
-
-
-def _set_date_to_1900(base_date, datetime_of_interest):
-    if datetime_of_interest is None:  # run.start_time is null
-        return datetime(1900, 1, 1, 0, 0, 0)
-    else:
-        return datetime.combine(
-            date(1900, 1, 1) + (datetime_of_interest.date() - base_date),
-            datetime_of_interest.time())
-
-
-def _make_sess_name(sess):
-    if sess.name == 'MRI':
-        MagneticFieldStrength = sess.MagneticFieldStrength
-        if MagneticFieldStrength is None:
-            lg.warning(f'Please specify Magnetic Field Strength for {sess}')
-            sess_name = 'mri'
-        elif MagneticFieldStrength == '1.5T':  # we cannot use 1.5 in session name
-            sess_name = 'mri'
-        else:
-            sess_name = MagneticFieldStrength.lower()
-    else:
-        sess_name = sess.name.lower()
-    return sess_name
+    _write_if_changed(data_path / 'README', 'Converted with aspen')
 
 
 def _add_intendedfor(db, bids_dir, intendedfor):
@@ -419,22 +527,7 @@ def _add_intendedfor_to_json(json_file, fields):
 
     sidecar['IntendedFor'] = fields
 
-    with json_file.open('w') as f:
-        dump(sidecar, f, indent=2)
-
-
-def find_intendedfor(db, run_id):
-    query = QSqlQuery(db['db'])
-    query.prepare("SELECT target FROM intended_for WHERE run_id = :runid")
-    query.bindValue(':runid', run_id)
-
-    if not query.exec():
-        raise SyntaxError(query.lastError().text())
-
-    topups = []
-    while query.next():
-        topups.append(query.value('target'))
-    return topups
+    _write_if_changed(json_file, dumps(sidecar, indent=2))
 
 
 def remove_phase(bids_dir):
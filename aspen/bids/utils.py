@@ -145,10 +145,9 @@ def add_extra_fields_to_json(run, fields, info):
     """Add extra fields to json file which are coming from subtables
     """
     db = run.db
-    SUBTABLES = [x['subtable'] for x in db['subtables']]
 
     for col, tbl in collect_columns(db, obj=run).items():
-        if tbl not in SUBTABLES:
+        if tbl == run.t + 's':  # only subtables
             continue
         if db['tables'][tbl][col]['index']:
             continue
@@ -0,0 +1,146 @@
+"""Keep the parsed schema (tables, aliases, docs, allowed values and subtables)
+on disk, so that it does not need to be parsed every time the database is
+opened.
+"""
+from json import dump, load
+from logging import getLogger
+from pathlib import Path
+
+from PyQt5.QtSql import QSqlQuery
+
+from .tables import parse_all_tables, parse_all_subtables
+
+lg = getLogger(__name__)
+
+SCHEMA_CACHE_DIR = Path.home() / '.cache' / 'aspen'
+SCHEMA_CACHE_VERSION = 2
+
+FINGERPRINT_STATEMENT = """\
+    SELECT
+    (SELECT COUNT(*) FROM `tables` WHERE `table_schema` = :schema_tables),
+    (SELECT COUNT(*) FROM `columns` WHERE `table_schema` = :schema_columns),
+    (SELECT SUM(CRC32(CONCAT_WS(':', `table_name`, `column_name`, `column_type`, `column_comment`))) FROM `columns` WHERE `table_schema` = :schema_crc_columns),
+    (SELECT SUM(CRC32(CONCAT_WS(':', `table_name`, `column_name`, `referenced_table_name`))) FROM `key_column_usage` WHERE `table_schema` = :schema_keys),
+    (SELECT COUNT(*) FROM `triggers` WHERE `event_object_schema` = :schema_triggers),
+    (SELECT SUM(CRC32(`action_statement`)) FROM `triggers` WHERE `event_object_schema` = :schema_crc_triggers)
+    """
+ALLOWED_VALUES_STATEMENT = """\
+    SELECT COUNT(*), SUM(CRC32(CONCAT_WS(':', `table_name`, `column_name`, `allowed_value`))) FROM allowed_values
+    """
+
+
+def schema_fingerprint(info_schema, db):
+    """Compute a cheap fingerprint of the schema. It changes when tables,
+    columns, comments, indices, triggers or allowed values change, but not
+    when rows are added to the tables with data.
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    list of str
+        values which identify the current schema
+    """
+    if not info_schema.databaseName() == 'information_schema':
+        raise ValueError('The first argument should be the `information_schema` database, not the database with the data')
+
+    query = QSqlQuery(info_schema)
+    query.prepare(FINGERPRINT_STATEMENT)
+    for placeholder in ('tables', 'columns', 'crc_columns', 'keys', 'triggers', 'crc_triggers'):
+        query.bindValue(f':schema_{placeholder}', db.databaseName())
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    fingerprint = [SCHEMA_CACHE_VERSION, ]
+    if query.next():
+        fingerprint.extend(str(query.value(i)) for i in range(6))
+
+    query = QSqlQuery(db)
+    if not query.exec(ALLOWED_VALUES_STATEMENT):
+        raise SyntaxError(query.lastError().text())
+    if query.next():
+        fingerprint.extend(str(query.value(i)) for i in range(2))
+
+    return fingerprint
+
+
+def schema_cache_path(db, cache_dir=None):
+    """Path of the cache file for one database on one host"""
+    if cache_dir is None:
+        cache_dir = SCHEMA_CACHE_DIR
+    return Path(cache_dir) / f'schema_{db.hostName()}_{db.databaseName()}.json'
+
+
+def load_schema(info_schema, db, cache_dir=None):
+    """Read the schema from the cache if the fingerprint matches, otherwise
+    parse it from the database and store it in the cache.
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+    cache_dir : Path or str
+        directory with the cache files (default: SCHEMA_CACHE_DIR)
+
+    Returns
+    -------
+    dict
+        information about all the tables (same as parse_all_tables)
+    list of dict
+        information about the subtables (same as parse_all_subtables)
+    """
+    cache_file = schema_cache_path(db, cache_dir)
+    fingerprint = schema_fingerprint(info_schema, db)
+
+    cached = _read_cache(cache_file)
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        lg.debug(f'Reading schema from {cache_file}')
+        return cached['tables'], cached['subtables']
+
+    lg.debug('Parsing schema from the database')
+    all_tables = parse_all_tables(info_schema, db)
+    subtables = parse_all_subtables(info_schema, db)
+
+    _write_cache(cache_file, {
+        'fingerprint': fingerprint,
+        'tables': all_tables,
+        'subtables': subtables,
+        })
+    return all_tables, subtables
+
+
+def _read_cache(cache_file):
+    try:
+        with cache_file.open() as f:
+            cached = load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        lg.warning(f'Could not read schema cache {cache_file}: {err}')
+        return None
+
+    if not isinstance(cached, dict) or not {'fingerprint', 'tables', 'subtables'} <= set(cached):
+        lg.warning(f'Schema cache {cache_file} is not valid')
+        return None
+
+    return cached
+
+
+def _write_cache(cache_file, cached):
+    """Write to a temporary file first, so that other instances never read a
+    partial cache"""
+    tmp_file = cache_file.with_suffix('.tmp')
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with tmp_file.open('w') as f:
+            dump(cached, f, indent=1)
+        tmp_file.replace(cache_file)
+    except OSError as err:
+        lg.warning(f'Could not write schema cache {cache_file}: {err}')
@@ -0,0 +1,278 @@
+"""Optional instrumentation of the SQL statements.
+
+When it is enabled, every call to QSqlQuery.exec records the normalized SQL
+statement, the call site, the number of rows and the wall time. When it is
+disabled, QSqlQuery is not modified at all, so there is no overhead.
+
+The statements can be executed in several threads (f.e. the connection pool),
+so the statistics are only changed while holding _lock.
+
+Call start_instrumentation() (optionally with the path of the report which
+is written when python exits), run the slow code and then look at
+instrumentation_report() or write_instrumentation_report().
+"""
+from atexit import register, unregister
+from json import dump
+from logging import getLogger
+from pathlib import Path
+from re import compile as re_compile, sub, IGNORECASE
+from sys import _getframe
+from threading import Lock
+from time import perf_counter
+
+from PyQt5.QtSql import QSqlQuery
+
+lg = getLogger(__name__)
+
+# number of executions of the same statement from the same call site, which
+# is reported as a possible N+1 pattern
+N_PLUS_ONE_MIN_CALLS = 10
+
+THIS_FILE = __file__
+PACKAGE_DIR = Path(__file__).resolve().parents[1]
+INTERNAL_DIRS = (PACKAGE_DIR / 'api', PACKAGE_DIR / 'database')
+
+RE_STRING = re_compile(r"'(?:[^'\\]|\\.|'')*'")
+RE_NUMBER = re_compile(r'(?<![\w`.])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b')
+RE_PLACEHOLDER = re_compile(r':\w+')
+RE_IN_LIST = re_compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', flags=IGNORECASE)
+RE_VALUES = re_compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+
+_state = {
+    'methods': None,  # original methods of QSqlQuery
+    'stats': {},
+    'output': None,
+    }
+_lock = Lock()
+
+
+def start_instrumentation(output=None):
+    """Start recording all the SQL statements.
+
+    Parameters
+    ----------
+    output : path
+        if specified, the report is written to this file when python exits
+        (as json if the extension is .json, otherwise as text)
+    """
+    if _state['methods'] is None:
+        _state['methods'] = {}
+        for method in ('exec', 'exec_'):
+            original = QSqlQuery.__dict__.get(method)
+            if original is None:
+                continue
+            _state['methods'][method] = original
+            setattr(QSqlQuery, method, _instrumented(original))
+        lg.debug('SQL instrumentation started')
+
+    if output is not None:
+        if _state['output'] is None:
+            register(_write_at_exit)
+        _state['output'] = Path(output)
+
+
+def stop_instrumentation():
+    """Restore QSqlQuery, so that the statements are not recorded anymore.
+    The statistics which were collected are kept (see reset_instrumentation).
+    """
+    if _state['methods'] is None:
+        return
+    for method, original in _state['methods'].items():
+        setattr(QSqlQuery, method, original)
+    _state['methods'] = None
+    if _state['output'] is not None:
+        unregister(_write_at_exit)
+        _state['output'] = None
+    lg.debug('SQL instrumentation stopped')
+
+
+def reset_instrumentation():
+    """Discard the statistics collected so far"""
+    with _lock:
+        _state['stats'] = {}
+
+
+def normalize_sql(statement):
+    """Replace values, placeholders and lists of values in a SQL statement, so
+    that the same statement with different values is counted only once.
+
+    Parameters
+    ----------
+    statement : str
+        SQL statement
+
+    Returns
+    -------
+    str
+        normalized SQL statement
+    """
+    statement = RE_STRING.sub('?', statement)
+    statement = RE_NUMBER.sub('?', statement)
+    statement = RE_PLACEHOLDER.sub('?', statement)
+    statement = RE_IN_LIST.sub('IN (...)', statement)
+    statement = RE_VALUES.sub(r'\1, ...', statement)
+    return sub(r'\s+', ' ', statement).strip()
+
+
+def instrumentation_stats():
+    """Statistics for each statement and call site.
+
+    Returns
+    -------
+    list of dict
+        with keys 'sql', 'call_site', 'calls', 'errors', 'rows' (None if the
+        driver does not report the size of the query), 'total_time',
+        'max_time' (in s), sorted by total time
+    """
+    with _lock:
+        stats = [dict(v, sql=k[0], call_site=k[1]) for k, v in _state['stats'].items()]
+    return sorted(stats, key=lambda x: x['total_time'], reverse=True)
+
+
+def instrumentation_report(n_top=20):
+    """Summary of the statements: top statements by total time and
+    statements which are executed many times from the same call site (f.e. a
+    query in a loop instead of one query for all the rows).
+
+    Parameters
+    ----------
+    n_top : int
+        number of statements to report in each section
+
+    Returns
+    -------
+    str
+        report
+    """
+    stats = instrumentation_stats()
+    n_calls = sum(x['calls'] for x in stats)
+    total_time = sum(x['total_time'] for x in stats)
+
+    lines = [
+        f'{n_calls} statements in {total_time * 1000:.1f} ms ({len(stats)} distinct statements / call sites)',
+        '',
+        f'Top {n_top} statements by total time',
+        ]
+    for x in stats[:n_top]:
+        lines.extend(_format_stat(x))
+
+    plus_one = _n_plus_one(stats)
+    lines.extend([
+        '',
+        f'Possible N+1 patterns (at least {N_PLUS_ONE_MIN_CALLS} calls from the same call site)',
+        ])
+    for x in plus_one[:n_top]:
+        lines.extend(_format_stat(x))
+    if len(plus_one) == 0:
+        lines.append('  none')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_instrumentation_report(output, n_top=20):
+    """Write the report to file.
+
+    Parameters
+    ----------
+    output : path
+        path to the report (if the extension is .json, it contains all the
+        statistics and the N+1 patterns, otherwise it's the text report)
+    n_top : int
+        number of statements to report in each section of the text report
+    """
+    output = Path(output)
+    if output.suffix == '.json':
+        stats = instrumentation_stats()
+        with output.open('w') as f:
+            dump({
+                'statements': stats,
+                'n_plus_one': _n_plus_one(stats),
+                }, f, indent=2)
+    else:
+        output.write_text(instrumentation_report(n_top))
+    lg.info(f'SQL instrumentation report written to {output}')
+
+
+def _instrumented(original):
+
+    def exec(self, *args):
+        t0 = perf_counter()
+        success = original.__get__(self)(*args)
+        duration = perf_counter() - t0
+        _record(self, _call_site(), success, duration)
+        return success
+
+    return exec
+
+
+def _record(query, call_site, success, duration):
+    key = (normalize_sql(query.lastQuery()), call_site)
+    if query.isSelect():
+        n_rows = query.size()  # -1 if the driver does not know
+    else:
+        n_rows = query.numRowsAffected()
+
+    with _lock:
+        stat = _state['stats'].get(key)
+        if stat is None:
+            stat = _state['stats'][key] = {
+                'calls': 0,
+                'errors': 0,
+                'rows': None,
+                'total_time': 0.,
+                'max_time': 0.,
+                }
+
+        stat['calls'] += 1
+        if not success:
+            stat['errors'] += 1
+        stat['total_time'] += duration
+        stat['max_time'] = max(stat['max_time'], duration)
+        if n_rows >= 0:
+            stat['rows'] = (stat['rows'] or 0) + n_rows
+
+
+def _call_site():
+    """First frame outside of this module, together with the first frame
+    outside of the api and of the database modules (f.e. the loop in the GUI
+    or in the BIDS export which creates the objects)"""
+    frame = _getframe(1)
+    while frame is not None and frame.f_code.co_filename == THIS_FILE:
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+
+    call_site = _format_frame(frame)
+
+    caller = frame
+    while caller is not None and Path(caller.f_code.co_filename).parent in INTERNAL_DIRS:
+        caller = caller.f_back
+    if caller is not None and caller is not frame:
+        call_site += ' <- ' + _format_frame(caller)
+    return call_site
+
+
+def _format_frame(frame):
+    filename = Path(frame.f_code.co_filename)
+    try:
+        filename = filename.resolve().relative_to(PACKAGE_DIR.parent)
+    except ValueError:
+        pass
+    return f'{filename}:{frame.f_lineno} ({frame.f_code.co_name})'
+
+
+def _n_plus_one(stats):
+    return [x for x in stats if x['calls'] >= N_PLUS_ONE_MIN_CALLS]
+
+
+def _format_stat(x):
+    rows = 'n/a' if x['rows'] is None else x['rows']
+    return [
+        f"  {x['total_time'] * 1000:9.1f} ms  {x['calls']:7d} calls  {rows:>9} rows  {x['call_site']}",
+        f"      {x['sql']}",
+        ]
+
+
+def _write_at_exit():
+    if _state['output'] is not None:
+        write_instrumentation_report(_state['output'])
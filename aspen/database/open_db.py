@@ -2,29 +2,64 @@
 """
 from logging import getLogger
 from getpass import getpass
+from pathlib import Path
+
+from weakref import WeakValueDictionary
 
 from PyQt5.QtSql import (
     QSqlDatabase,
     )
 
-from .tables import parse_all_tables, parse_subtables, LEVELS, EXPECTED_TABLES
+from ..api.utils import column_maps
+from .tables import parse_all_tables, parse_all_subtables, EXPECTED_TABLES
+from .cache import load_schema
+from .sqlite import open_sqlite_database
 
 
 lg = getLogger(__name__)
 
 
-def access_database(db_name, username, hostname='localhost', password=None):
+def access_database(db_name, username=None, hostname='localhost', password=None, schema_cache=True):
+    """Open the database and parse its schema
+
+    Parameters
+    ----------
+    db_name : str
+        database name (QMYSQL) or path to a snapshot (with extension .sqlite,
+        see `create_snapshot`), which is opened read-only
+    username : str
+        user name to open database (not used for snapshots)
+    hostname : str
+        host name (if different from localhost)
+    password : str
+        password to open database (if None, it asks for it)
+    schema_cache : bool
+        if True, read the schema from the cache on disk when the schema in the
+        database has not changed (see `load_schema`)
+
+    Returns
+    -------
+    dict
+        information about the database, with keys 'db', 'info', 'tables',
+        'subtables', 'objects' (the objects in use, see `identity_map`),
+        'columns' (where each attribute is stored, see `column_maps`)
+    """
+    if Path(db_name).suffix == '.sqlite':
+        out = open_sqlite_database(db_name, read_only=True, connectionName='xelo2_database')
+        column_maps(out)
+        return out
+
     if password is None:
         password = getpass(f'Enter Password for user `{username}` to `{db_name}` (hostname: `{hostname}`):')
 
     db = open_database(db_name, username=username, password=password, hostname=hostname, connectionName='xelo2_database')
     info_schema = open_database('information_schema', username=username, password=password, hostname=hostname, connectionName='info')
 
-    all_tables = parse_all_tables(info_schema, db)
-
-    subtables = []
-    for table in LEVELS:
-        subtables.extend(parse_subtables(info_schema, db, table))
+    if schema_cache:
+        all_tables, subtables = load_schema(info_schema, db)
+    else:
+        all_tables = parse_all_tables(info_schema, db)
+        subtables = parse_all_subtables(info_schema, db)
 
     expected_tables = EXPECTED_TABLES + [x['subtable'] for x in subtables]
 
@@ -37,7 +72,9 @@ def access_database(db_name, username, hostname='localhost', password=None):
         'info': info_schema,
         'tables': all_tables,
         'subtables': subtables,
+        'objects': WeakValueDictionary(),
         }
+    column_maps(out)
     return out
 
 
@@ -76,7 +113,12 @@ def open_database(db_name, username=None, password=None, hostname=None, connecti
 
 
 def close_database(db):
+    if db.get('pool') is not None:
+        db['pool'].close()
+    db.get('objects', {}).clear()
+    db.get('statements', {}).clear()
     db['db'].close()
     QSqlDatabase.removeDatabase(db['db'].connectionName())
-    db['info'].close()
-    QSqlDatabase.removeDatabase(db['info'].connectionName())
+    if db['info'] is not None:  # SQLite has no information_schema
+        db['info'].close()
+        QSqlDatabase.removeDatabase(db['info'].connectionName())
@@ -0,0 +1,320 @@
+"""Connections to the same database for the worker threads.
+
+A QSqlDatabase can only be used in the thread which opened it, so each worker
+thread gets its own copy of the connection (same driver, host, user, password
+and options). The copies are kept open after they are released, so a thread
+which runs many tasks (f.e. in a ThreadPoolExecutor or a QThreadPool) opens
+its connection only once.
+
+    pool = connection_pool(db)
+    with pool.connection() as worker_db:
+        subj = Subject(worker_db, 'sub0001')
+
+The objects of the api created with a worker connection belong to that thread
+and should not be passed to other threads (pass the id instead).
+
+Worker processes cannot clone the connection of the main process, so they
+open a new one from the parameters returned by connection_info (see
+open_connection).
+"""
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Condition, get_ident, local
+from weakref import WeakValueDictionary
+
+from PyQt5.QtSql import QSqlDatabase
+
+from ..api.utils import column_maps
+from .sqlite import _exec
+
+lg = getLogger(__name__)
+
+# maximum number of connections which are open at the same time (besides the
+# main connection)
+MAX_CONNECTIONS = 4
+
+
+class ConnectionPool():
+    """Pool of connections to the same database, one for each thread.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database (see access_database). The pool should
+        be created in the thread which opened the database.
+    max_connections : int
+        maximum number of connections which are open at the same time. When
+        all the connections are in use, the other threads wait.
+
+    Notes
+    -----
+    A connection is only closed by the thread which opened it. When the pool
+    is full, a thread which releases its connection closes it if other
+    threads are waiting. The least recently used idle connection is marked
+    and its thread closes it the next time it acquires or releases it, or
+    when the thread exits. After close, the connections of the other threads
+    are closed in the same way.
+    """
+    def __init__(self, db, max_connections=MAX_CONNECTIONS):
+        if max_connections < 1:
+            raise ValueError('The pool needs at least one connection')
+        self.db = db
+        column_maps(db)  # shared by all the connections
+        self.max_connections = max_connections
+        self.main_thread = get_ident()
+
+        self._connections = {}  # thread id -> db (in use and idle)
+        self._idle = []  # thread ids, the least recently used first
+        self._to_close = set()  # thread ids, closed by their own thread
+        self._n_waiting = 0
+        self._n_created = 0
+        self._closed = False
+        self._condition = Condition()
+        self._local = local()
+
+    def __len__(self):
+        """Number of connections which are open"""
+        return len(self._connections)
+
+    @contextmanager
+    def connection(self):
+        """Connection for the current thread (in the main thread, it's the
+        main connection)
+
+        Yields
+        ------
+        dict
+            information about the database, with the same keys as the main
+            connection. Each connection has its own objects (see
+            `identity_map`) but it shares the schema with the main connection.
+        """
+        if get_ident() == self.main_thread:
+            yield self.db
+            return
+
+        worker_db = self.acquire()
+        try:
+            yield worker_db
+        finally:
+            self.release()
+
+    def acquire(self):
+        """Get the connection of the current thread (it should be released
+        with `release`, better use `connection`)"""
+        thread_id = get_ident()
+        if thread_id in self._to_close:
+            self._close_own(thread_id)
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ValueError('The connection pool is closed')
+
+                if thread_id in self._connections:
+                    if thread_id in self._idle:
+                        self._idle.remove(thread_id)
+                    return self._connections[thread_id]
+
+                if len(self._connections) < self.max_connections:
+                    break
+
+                # ask the thread of the least recently used idle connection to close it
+                for idle_id in self._idle:
+                    if idle_id not in self._to_close:
+                        self._to_close.add(idle_id)
+                        break
+
+                self._n_waiting += 1
+                self._condition.wait()
+                self._n_waiting -= 1
+
+            # it's reserved while the connection is opened (outside of the lock)
+            self._n_created += 1
+            name = f"{self.db['db'].connectionName()}_pool_{self._n_created}"
+            self._connections[thread_id] = None
+
+        try:
+            worker_db = self._open(name)
+        except Exception:
+            with self._condition:
+                self._connections.pop(thread_id)
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._connections[thread_id] = worker_db
+            closed = self._closed
+        # closed at the latest when this thread exits
+        if getattr(self._local, 'owner', None) is None:
+            self._local.owner = _Owner(self, thread_id)
+
+        if closed:  # closed while the connection was opened
+            self._close_own(thread_id)
+            raise ValueError('The connection pool is closed')
+        return worker_db
+
+    def release(self):
+        """The connection of the current thread is not in use anymore (it's
+        kept open for the next task in the same thread, unless other threads
+        are waiting for a connection)"""
+        thread_id = get_ident()
+        with self._condition:
+            if thread_id not in self._connections or thread_id in self._idle:
+                return
+            self._idle.append(thread_id)
+            to_close = self._n_waiting > 0 or thread_id in self._to_close
+            self._condition.notify()
+
+        if to_close:
+            self._close_own(thread_id)
+
+    def close(self):
+        """Close the connection of the current thread and ask the other
+        threads to close theirs (this is called by close_database)"""
+        with self._condition:
+            self._closed = True
+            self._to_close.update(self._connections)
+            self._condition.notify_all()
+
+        self._close_own(get_ident())
+
+    def _open(self, name):
+        clone = QSqlDatabase.cloneDatabase(self.db['db'].connectionName(), name)
+        clone.open()
+        if not clone.isOpen():
+            error = clone.lastError().text()
+            del clone
+            QSqlDatabase.removeDatabase(name)
+            raise ValueError(f'Could not open database: {error}')
+        if clone.driverName() == 'QSQLITE':
+            _exec(clone, 'PRAGMA foreign_keys = ON')
+
+        lg.debug(f'Opened connection {name}')
+        return {
+            'db': clone,
+            'info': None,  # the schema is already parsed
+            'tables': self.db['tables'],
+            'subtables': self.db['subtables'],
+            'columns': self.db['columns'],
+            'objects': WeakValueDictionary(),
+            }
+
+    def _close_own(self, thread_id):
+        """Close the connection of thread_id (only called in that thread)"""
+        with self._condition:
+            if self._connections.get(thread_id) is None:  # not open or still being opened
+                return
+            worker_db = self._connections.pop(thread_id)
+            if thread_id in self._idle:
+                self._idle.remove(thread_id)
+            self._to_close.discard(thread_id)
+            self._condition.notify_all()
+
+        worker_db['objects'].clear()
+        worker_db.get('statements', {}).clear()
+        qdb = worker_db.pop('db')  # the caller can still hold worker_db
+        name = qdb.connectionName()
+        qdb.close()
+        del qdb
+        QSqlDatabase.removeDatabase(name)
+        lg.debug(f'Closed connection {name}')
+
+
+class _Owner():
+    """Kept in a thread-local variable, so that the connection is closed by its
+    thread when the thread exits"""
+    def __init__(self, pool, thread_id):
+        self.pool = pool
+        self.thread_id = thread_id
+
+    def __del__(self):
+        self.pool._close_own(self.thread_id)
+
+
+def connection_pool(db, max_connections=MAX_CONNECTIONS):
+    """Pool of connections for the worker threads, created the first time
+    (in the thread which opened the database).
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+    max_connections : int
+        maximum number of connections which are open at the same time (only
+        used when the pool is created)
+
+    Returns
+    -------
+    instance of ConnectionPool
+        pool (stored in db['pool'])
+    """
+    pool = db.get('pool')
+    if pool is None:
+        pool = db['pool'] = ConnectionPool(db, max_connections)
+    return pool
+
+
+def connection_info(db):
+    """Parameters to open another connection to the same database in another
+    process (they can be pickled)
+
+    Parameters
+    ----------
+    db : dict
+        information about the database
+
+    Returns
+    -------
+    dict
+        driver, connection parameters and schema (so that it's not parsed
+        again, see open_connection)
+    """
+    qdb = db['db']
+    return {
+        'driver': qdb.driverName(),
+        'db_name': qdb.databaseName(),
+        'hostname': qdb.hostName(),
+        'port': qdb.port(),
+        'username': qdb.userName(),
+        'password': qdb.password(),
+        'options': qdb.connectOptions(),
+        'tables': db['tables'],
+        'subtables': db['subtables'],
+        }
+
+
+def open_connection(info, connectionName):
+    """Open a connection with the parameters returned by connection_info (f.e.
+    in a worker process). It should be closed with close_database.
+
+    Returns
+    -------
+    dict
+        information about the database, with the same keys as the main
+        connection
+    """
+    qdb = QSqlDatabase.addDatabase(info['driver'], connectionName)
+    qdb.setDatabaseName(info['db_name'])
+    qdb.setHostName(info['hostname'])
+    qdb.setPort(info['port'])
+    qdb.setUserName(info['username'])
+    qdb.setPassword(info['password'])
+    qdb.setConnectOptions(info['options'])
+    qdb.open()
+    if not qdb.isOpen():
+        error = qdb.lastError().text()
+        del qdb
+        QSqlDatabase.removeDatabase(connectionName)
+        raise ValueError(f'Could not open database: {error}')
+    if info['driver'] == 'QSQLITE':
+        _exec(qdb, 'PRAGMA foreign_keys = ON')
+
+    db = {
+        'db': qdb,
+        'info': None,  # the schema is already parsed
+        'tables': info['tables'],
+        'subtables': info['subtables'],
+        'objects': WeakValueDictionary(),
+        }
+    column_maps(db)
+    return db
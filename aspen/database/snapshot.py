@@ -0,0 +1,508 @@
+"""Read-only copy of the MySQL database in a local SQLite file.
+
+The snapshot has the same tables, the same schema (including the subtables)
+and the same data as the MySQL database, so it can be opened with
+access_database and used with the same objects in aspen.api, without any
+connection to the server. It cannot be modified.
+
+When change tracking is installed in the MySQL database (a table, CHANGE_LOG,
+with the rows which were inserted, updated or deleted, maintained by
+triggers), an existing snapshot is refreshed by copying only the rows which
+changed since the last refresh.
+
+    aspen-snapshot -U username -H hostname aspen_db snapshot.sqlite
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import datetime
+from logging import getLogger, basicConfig, INFO
+from pathlib import Path
+
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtSql import QSqlDatabase, QSqlQuery
+
+from ..api.backend import insert_rows
+from .open_db import access_database
+from .sqlite import (
+    _open_sqlite,
+    _exec,
+    create_sqlite_tables,
+    create_sqlite_triggers,
+    read_sqlite_schema,
+    write_sqlite_schema,
+    )
+from .tables import CHANGE_LOG
+
+lg = getLogger(__name__)
+
+# number of rows which are read from MySQL before they are written to SQLite
+SNAPSHOT_CHUNK = 10000
+# number of changed rows which are read with one query
+REFRESH_CHUNK = 1000
+
+CHANGE_LOG_STATEMENTS = {
+    'QMYSQL': f"""CREATE TABLE IF NOT EXISTS `{CHANGE_LOG}` (
+        `id` int(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        `table_name` varchar(64) NOT NULL,
+        `row_key` int(11) DEFAULT NULL,
+        `changed_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP)""",
+    'QSQLITE': f"""CREATE TABLE IF NOT EXISTS `{CHANGE_LOG}` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `table_name` TEXT NOT NULL,
+        `row_key` INTEGER,
+        `changed_at` DATETIME DEFAULT CURRENT_TIMESTAMP)""",
+    }
+
+
+def create_snapshot(db, path, connectionName='aspen_snapshot'):
+    """Copy the schema and all the rows of the MySQL database into a new
+    SQLite file.
+
+    Parameters
+    ----------
+    db : dict
+        information about the MySQL database (see access_database)
+    path : path
+        path to the SQLite file. The file is written to a temporary file
+        first, so an existing snapshot is replaced only when the copy is
+        complete.
+    connectionName : str
+        name of the Qt connection to the SQLite file
+
+    Notes
+    -----
+    The triggers which add the rows to the subtables are created after the
+    data is copied, otherwise the rows of the subtables would be added twice.
+
+    All the tables are read in one transaction (see read_transaction), so the
+    rows which refer to each other are consistent, even if the MySQL database
+    changes while the rows are copied.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    tables = _snapshot_tables(db)
+
+    snapshot = {
+        'db': _open_sqlite(tmp_path, False, connectionName),
+        'info': None,
+        'tables': tables,
+        'subtables': db['subtables'],
+        }
+    sqlite_db = snapshot['db']
+
+    try:
+        _exec(sqlite_db, 'PRAGMA foreign_keys = OFF')  # tables are copied in any order
+        sqlite_db.transaction()
+        create_sqlite_tables(sqlite_db, tables, db['subtables'])
+        write_sqlite_schema(sqlite_db, 'tables', tables)
+        write_sqlite_schema(sqlite_db, 'subtables', db['subtables'])
+
+        with read_transaction(db):
+            # the rows are copied as they were at this change
+            change_id = last_change(db)
+            write_sqlite_schema(sqlite_db, 'snapshot', _snapshot_info(db, change_id))
+
+            for table, columns in tables.items():
+                n_rows = 0
+                for rows in _read_table(db, table, columns):
+                    insert_rows(snapshot, table, list(columns), rows)
+                    n_rows += len(rows)
+                lg.info(f'Copied {n_rows} rows from {table}')
+
+        create_sqlite_triggers(sqlite_db, db['subtables'])
+        sqlite_db.commit()
+
+    except Exception:
+        sqlite_db.rollback()
+        raise
+
+    finally:
+        sqlite_db.close()
+        del sqlite_db, snapshot
+        QSqlDatabase.removeDatabase(connectionName)
+
+    tmp_path.replace(path)
+    lg.info(f'Snapshot of {db["db"].databaseName()} written to {path}')
+
+
+def refresh_snapshot(db, path, connectionName='aspen_snapshot'):
+    """Copy only the rows which were inserted, updated or deleted since the
+    snapshot was created or refreshed.
+
+    Parameters
+    ----------
+    db : dict
+        information about the MySQL database (see access_database)
+    path : path
+        path to the SQLite file
+    connectionName : str
+        name of the Qt connection to the SQLite file
+
+    Returns
+    -------
+    int
+        number of rows (or groups of rows) which were copied again. If the
+        snapshot does not exist, if the schema changed or if there is no
+        change tracking, it creates a new snapshot and it returns None.
+
+    Notes
+    -----
+    The rows which MySQL deletes because of ON DELETE CASCADE are not in
+    CHANGE_LOG (MySQL does not run triggers for them), but the same foreign
+    keys in the snapshot delete them as well.
+    """
+    path = Path(path)
+    tables = _snapshot_tables(db)
+
+    if last_change(db) is None:
+        lg.warning(f'There is no change tracking in {db["db"].databaseName()}, creating a new snapshot')
+        create_snapshot(db, path, connectionName)
+        return None
+
+    if not path.exists():
+        create_snapshot(db, path, connectionName)
+        return None
+
+    snapshot = {
+        'db': _open_sqlite(path, False, connectionName),
+        'info': None,
+        'tables': tables,
+        'subtables': db['subtables'],
+        }
+    sqlite_db = snapshot['db']
+
+    try:
+        schema = read_sqlite_schema(sqlite_db)
+        previous_id = schema.get('snapshot', {}).get('change_id')
+        if (schema.get('tables') != tables
+                or schema.get('subtables') != db['subtables']
+                or previous_id is None):
+            lg.info('The schema changed or the snapshot was created without change tracking')
+            previous_id = None
+
+        else:
+            sqlite_db.transaction()
+            with read_transaction(db):
+                change_id = last_change(db)
+                changes = _read_changes(db, previous_id, change_id)
+                for table in _sorted_by_dependency(tables):
+                    if table in changes:
+                        _refresh_table(db, snapshot, table, changes[table])
+            write_sqlite_schema(sqlite_db, 'snapshot', _snapshot_info(db, change_id))
+            sqlite_db.commit()
+
+    except Exception:
+        sqlite_db.rollback()
+        raise
+
+    finally:
+        sqlite_db.close()
+        del sqlite_db, snapshot
+        QSqlDatabase.removeDatabase(connectionName)
+
+    if previous_id is None:
+        create_snapshot(db, path, connectionName)
+        return None
+
+    n_changes = sum(len(keys) if keys is not None else 1 for keys in changes.values())
+    lg.info(f'Snapshot {path} refreshed ({n_changes} changes in {len(changes)} tables)')
+    return n_changes
+
+
+def install_change_tracking(db):
+    """Create CHANGE_LOG and the triggers which add a row to CHANGE_LOG every
+    time a row is inserted, updated or deleted. It needs the privileges to
+    create tables and triggers.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database (see access_database)
+    """
+    driver = db['db'].driverName()
+    _exec(db['db'], CHANGE_LOG_STATEMENTS[driver])
+
+    for table, columns in _snapshot_tables(db).items():
+        for name, statement in _change_log_triggers(table, columns):
+            _exec(db['db'], f'DROP TRIGGER IF EXISTS `{name}`')
+            _exec(db['db'], statement)
+    lg.info(f'Change tracking installed in {db["db"].databaseName()}')
+
+
+def remove_change_tracking(db):
+    """Remove the triggers and CHANGE_LOG (see install_change_tracking)"""
+    for table, columns in _snapshot_tables(db).items():
+        for name, statement in _change_log_triggers(table, columns):
+            _exec(db['db'], f'DROP TRIGGER IF EXISTS `{name}`')
+    _exec(db['db'], f'DROP TABLE IF EXISTS `{CHANGE_LOG}`')
+
+
+@contextmanager
+def read_transaction(db):
+    """Read all the tables in one transaction, so that they are read as they
+    were at the same time. In MySQL, the transaction starts WITH CONSISTENT
+    SNAPSHOT, so that the snapshot is taken when the transaction starts (not
+    at the first read).
+
+    Parameters
+    ----------
+    db : dict
+        information about the database (see access_database)
+    """
+    if db.get('transaction', False):  # the reads are part of the open transaction
+        yield
+        return
+
+    if db['db'].driverName() == 'QMYSQL':
+        _exec(db['db'], 'START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    elif not db['db'].transaction():
+        raise SyntaxError(db['db'].lastError().text())
+    db['transaction'] = True
+    try:
+        yield
+    finally:
+        db['transaction'] = False
+        # nothing was written, so it's the same as a commit
+        db['db'].rollback()
+
+
+def last_change(db):
+    """Last row in CHANGE_LOG
+
+    Returns
+    -------
+    int or None
+        id of the last change (0 if there are no changes yet), None if there
+        is no change tracking
+    """
+    if CHANGE_LOG not in db['db'].tables():
+        return None
+
+    query = QSqlQuery(db['db'])
+    if not query.exec(f'SELECT MAX(`id`) FROM `{CHANGE_LOG}`'):
+        raise SyntaxError(query.lastError().text())
+    query.next()
+    if query.isNull(0):
+        return 0
+    return int(query.value(0))
+
+
+def _snapshot_tables(db):
+    return {k: v for k, v in db['tables'].items() if k != CHANGE_LOG}
+
+
+def _snapshot_info(db, change_id):
+    return {
+        'hostname': db['db'].hostName(),
+        'database': db['db'].databaseName(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'change_id': change_id,
+        }
+
+
+def _change_key(columns):
+    """Column which is stored in CHANGE_LOG: the id or, for the tables without
+    id (subtables and tables which link two tables), the first foreign key.
+    If None, the whole table is copied when it changes (f.e. allowed_values)"""
+    if 'id' in columns and columns['id']['index'] is None:
+        return 'id'
+    for name, v in columns.items():
+        if v['index']:
+            return name
+    return None
+
+
+def _change_log_triggers(table, columns):
+    key = _change_key(columns)
+    insert = f"INSERT INTO `{CHANGE_LOG}` (`table_name`, `row_key`) VALUES ('{table}', {{}});"
+
+    new_key = 'NULL' if key is None else f'NEW.`{key}`'
+    old_key = 'NULL' if key is None else f'OLD.`{key}`'
+    update = insert.format(new_key)
+    if key is not None and key != 'id':  # the foreign key can change
+        update += ' ' + insert.format(old_key)
+
+    return [
+        (f'log_change_insert_{table}',
+         f"CREATE TRIGGER `log_change_insert_{table}` AFTER INSERT ON `{table}` FOR EACH ROW BEGIN {insert.format(new_key)} END"),
+        (f'log_change_update_{table}',
+         f"CREATE TRIGGER `log_change_update_{table}` AFTER UPDATE ON `{table}` FOR EACH ROW BEGIN {update} END"),
+        (f'log_change_delete_{table}',
+         f"CREATE TRIGGER `log_change_delete_{table}` AFTER DELETE ON `{table}` FOR EACH ROW BEGIN {insert.format(old_key)} END"),
+        ]
+
+
+def _read_changes(db, previous_id, change_id):
+    """Rows which changed between two changes
+
+    Returns
+    -------
+    dict
+        where the key is the table and the value is the set of changed keys
+        (None if the whole table should be copied)
+    """
+    query = QSqlQuery(db['db'])
+    query.prepare(f"""SELECT DISTINCT `table_name`, `row_key` FROM `{CHANGE_LOG}`
+        WHERE `id` > :previous_id AND `id` <= :change_id""")
+    query.bindValue(':previous_id', previous_id)
+    query.bindValue(':change_id', change_id)
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    changes = {}
+    while query.next():
+        table = query.value(0)
+        if query.isNull(1):
+            changes[table] = None
+        elif table not in changes or changes[table] is not None:
+            changes.setdefault(table, set()).add(int(query.value(1)))
+
+    return changes
+
+
+def _refresh_table(db, snapshot, table, keys):
+    """Copy the rows with the keys again. The rows which have an id are
+    updated in place, so that the rows which refer to them are not deleted
+    by the foreign keys."""
+    columns = db['tables'][table]
+    key = _change_key(columns)
+
+    if keys is None:
+        _exec(snapshot['db'], f'DELETE FROM `{table}`')
+        for rows in _read_table(db, table, columns):
+            insert_rows(snapshot, table, list(columns), rows)
+        return
+
+    keys = sorted(keys)
+    for i in range(0, len(keys), REFRESH_CHUNK):
+        chunk = keys[i:i + REFRESH_CHUNK]
+        where = f' WHERE `{key}` IN (' + ', '.join(str(k) for k in chunk) + ')'
+        rows = [row for rows in _read_table(db, table, columns, where) for row in rows]
+
+        if key == 'id':
+            id_col = list(columns).index('id')
+            deleted = set(chunk) - set(row[id_col] for row in rows)
+            if len(deleted) > 0:
+                _exec(snapshot['db'], f'DELETE FROM `{table}` WHERE `id` IN (' + ', '.join(str(k) for k in deleted) + ')')
+            _upsert_rows(snapshot, table, list(columns), rows)
+
+        else:
+            _exec(snapshot['db'], f'DELETE FROM `{table}`{where}')
+            insert_rows(snapshot, table, list(columns), rows)
+
+
+def _upsert_rows(db, table, columns, rows):
+    """Insert the rows or update them if the id exists already (only SQLite)"""
+    columns_str = ', '.join(f'`{col}`' for col in columns)
+    values_str = ', '.join(['?', ] * len(columns))
+    update_str = ', '.join(f'`{col}` = excluded.`{col}`' for col in columns if col != 'id')
+
+    query = QSqlQuery(db['db'])
+    query.prepare(
+        f"INSERT INTO `{table}` ({columns_str}) VALUES ({values_str}) "
+        f"ON CONFLICT (`id`) DO UPDATE SET {update_str}")
+    for row in rows:
+        for i, value in enumerate(row):
+            query.bindValue(i, value)
+        if not query.exec():
+            raise ValueError(query.lastError().text())
+
+
+def _sorted_by_dependency(tables):
+    """Sort the tables, so that each table comes after the tables it refers to
+    (the rows of a new session are inserted before the rows of its runs)"""
+    refs = {}
+    for table, columns in tables.items():
+        refs[table] = set(
+            v['index'].split(' ')[0] for v in columns.values() if v['index']) - {table, }
+
+    sorted_tables = []
+    while len(refs) > 0:
+        ready = [t for t, r in refs.items() if len(r & set(refs)) == 0]
+        if len(ready) == 0:  # circular references
+            ready = list(refs)
+        for t in ready:
+            sorted_tables.append(t)
+            refs.pop(t)
+    return sorted_tables
+
+
+def _read_table(db, table, columns, where=''):
+    """Read all the rows of one table, in chunks of SNAPSHOT_CHUNK rows"""
+    columns_str = ', '.join(f'`{col}`' for col in columns)
+    query = QSqlQuery(db['db'])
+    query.setForwardOnly(True)
+    if not query.exec(f'SELECT {columns_str} FROM `{table}`{where}'):
+        raise SyntaxError(query.lastError().text())
+
+    col_types = [v['type'] for v in columns.values()]
+
+    rows = []
+    while query.next():
+        rows.append([
+            _snapshot_value(col_type, query, i)
+            for i, col_type in enumerate(col_types)])
+        if len(rows) == SNAPSHOT_CHUNK:
+            yield rows
+            rows = []
+
+    if len(rows) > 0:
+        yield rows
+
+
+def _snapshot_value(col_type, query, i):
+    """Convert the value of the current row to the value stored in SQLite
+    (dates as text, like when they are written by the api). NULL is checked on
+    the query, because QMYSQL does not distinguish between null and 0.0"""
+    if query.isNull(i):
+        return None
+
+    value = query.value(i)
+    if isinstance(value, str):  # dates in SQLite are already text
+        return value
+    elif col_type == 'QDate':
+        return value.toString('yyyy-MM-dd')
+    elif col_type == 'QDateTime':
+        return value.toString('yyyy-MM-dd HH:mm:ss.zzz')
+    else:
+        return value
+
+
+def main(arguments=None):
+    parser = ArgumentParser(prog='aspen-snapshot', description=(
+        'Copy the MySQL database into a SQLite file, which can be opened '
+        'read-only with access_database. If the file exists, only the rows '
+        'which changed are copied (if change tracking is installed)'))
+    parser.add_argument('-U', '--username', required=True, help='user name to open the MySQL database')
+    parser.add_argument('-P', '--password', help='password (if not specified, it asks for it)')
+    parser.add_argument('-H', '--hostname', default='localhost', help='host name of the MySQL server')
+    parser.add_argument('--full', action='store_true', help='copy all the rows, even if the file exists')
+    parser.add_argument(
+        '--install-tracking', action='store_true',
+        help='install change tracking in the MySQL database (it needs the privileges to create triggers)')
+    parser.add_argument('mysql', help='name of the MySQL database')
+    parser.add_argument('output', help='path to the SQLite file (extension: .sqlite)')
+    args = parser.parse_args(arguments)
+
+    basicConfig(format='%(asctime)s %(message)s', level=INFO)
+    app = QCoreApplication.instance() or QCoreApplication([])  # noqa: F841
+
+    output = Path(args.output)
+    if output.suffix != '.sqlite':
+        parser.error('The extension of the output file should be .sqlite')
+
+    db = access_database(args.mysql, args.username, args.hostname, args.password)
+    if args.install_tracking:
+        install_change_tracking(db)
+
+    if args.full:
+        create_snapshot(db, output)
+    else:
+        refresh_snapshot(db, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""Local SQLite database with the same schema as the MySQL database.
+
+The SQLite file contains the tables, the triggers which add the rows to the
+subtables and one extra table (SCHEMA_TABLE) with the parsed schema (the same
+information as parse_all_tables and parse_all_subtables), because SQLite has
+no information_schema.
+"""
+from json import dumps, loads
+from logging import getLogger
+from pathlib import Path
+from re import findall, finditer, search, DOTALL
+from weakref import WeakValueDictionary
+
+from PyQt5.QtSql import (
+    QSqlDatabase,
+    QSqlQuery,
+    )
+
+from .tables import parse_trigger_statements, split_comment
+
+lg = getLogger(__name__)
+
+SCHEMA_TABLE = 'aspen_schema'
+
+SQLITE_TYPES = {
+    'int': 'INTEGER',
+    'uint': 'INTEGER',
+    'qlonglong': 'INTEGER',
+    'qulonglong': 'INTEGER',
+    'double': 'REAL',
+    'QString': 'TEXT',
+    'QDate': 'DATE',
+    'QDateTime': 'DATETIME',
+    }
+
+# MySQL type -> (type name in Qt, length of text columns)
+MYSQL_TYPES = {
+    'int': ('int', None),
+    'float': ('double', None),
+    'double': ('double', None),
+    'text': ('QString', 65535),
+    'varchar': ('QString', None),  # length is specified
+    'date': ('QDate', None),
+    'timestamp': ('QDateTime', None),
+    'datetime': ('QDateTime', None),
+    }
+
+
+def open_sqlite_database(path, read_only=False, connectionName='xelo2_database'):
+    """Open a SQLite database created by create_sqlite_database
+
+    Parameters
+    ----------
+    path : path
+        path to the SQLite file
+    read_only : bool
+        open the file in read-only mode
+    connectionName : str
+        name of the Qt connection
+
+    Returns
+    -------
+    dict
+        information about the database, with keys 'db', 'info' (None, there is
+        no information_schema), 'tables', 'subtables', 'objects'
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f'{path} does not exist')
+
+    db = _open_sqlite(path, read_only, connectionName)
+
+    schema = read_sqlite_schema(db)
+    if 'tables' not in schema:
+        raise ValueError(f'{path} is not an ASPEN database')
+
+    return {
+        'db': db,
+        'info': None,
+        'tables': schema['tables'],
+        'subtables': schema['subtables'],
+        'objects': WeakValueDictionary(),
+        }
+
+
+def read_sqlite_schema(db):
+    """Read the information stored in SCHEMA_TABLE
+
+    Returns
+    -------
+    dict
+        where the key is the name (f.e. 'tables', 'subtables') and the value
+        is the stored value
+    """
+    query = QSqlQuery(db)
+    if not query.exec(f'SELECT `name`, `value` FROM `{SCHEMA_TABLE}`'):
+        lg.warning(query.lastError().text())
+        return {}
+
+    schema = {}
+    while query.next():
+        schema[query.value('name')] = loads(query.value('value'))
+    return schema
+
+
+def create_sqlite_database(path, tables, subtables, connectionName='xelo2_database'):
+    """Create an empty SQLite database with the given schema. The allowed
+    values are copied into the `allowed_values` table.
+
+    Parameters
+    ----------
+    path : path
+        path to the SQLite file (it should not exist)
+    tables : dict
+        information about all the tables (see parse_all_tables)
+    subtables : list of dict
+        information about the subtables (see parse_all_subtables)
+    connectionName : str
+        name of the Qt connection
+
+    Returns
+    -------
+    dict
+        information about the database (see open_sqlite_database)
+    """
+    path = Path(path)
+    if path.exists():
+        raise FileExistsError(f'{path} exists already')
+
+    db = _open_sqlite(path, False, connectionName)
+
+    db.transaction()
+    create_sqlite_tables(db, tables, subtables)
+    write_sqlite_schema(db, 'tables', tables)
+    write_sqlite_schema(db, 'subtables', subtables)
+
+    if 'allowed_values' in tables:
+        query = QSqlQuery(db)
+        query.prepare('INSERT INTO `allowed_values` (`table_name`, `column_name`, `allowed_value`) VALUES (:table, :column, :value)')
+        for table, columns in tables.items():
+            for column, v in columns.items():
+                for value in v['values']:
+                    query.bindValue(':table', table)
+                    query.bindValue(':column', column)
+                    query.bindValue(':value', value)
+                    if not query.exec():
+                        raise SyntaxError(query.lastError().text())
+
+    create_sqlite_triggers(db, subtables)
+    db.commit()
+
+    return {
+        'db': db,
+        'info': None,
+        'tables': tables,
+        'subtables': subtables,
+        'objects': WeakValueDictionary(),
+        }
+
+
+def create_sqlite_tables(db, tables, subtables):
+    """Create the tables (and SCHEMA_TABLE) in an empty SQLite database
+
+    Parameters
+    ----------
+    db : instance of QSqlDatabase
+        SQLite database
+    tables : dict
+        information about all the tables (see parse_all_tables)
+    subtables : list of dict
+        information about the subtables (see parse_all_subtables)
+    """
+    subtable_names = [subt['subtable'] for subt in subtables]
+
+    _exec(db, f'CREATE TABLE `{SCHEMA_TABLE}` (`name` TEXT PRIMARY KEY, `value` TEXT)')
+    for table, columns in tables.items():
+        for statement in _create_table(table, columns, table in subtable_names):
+            _exec(db, statement)
+
+
+def create_sqlite_triggers(db, subtables):
+    """Create the triggers which add the rows to the subtables. When copying
+    data, they should be created after the data is copied, otherwise the rows
+    in the subtables are duplicated."""
+    for subt in subtables:
+        for statement in _create_subtable_triggers(subt):
+            _exec(db, statement)
+
+
+def write_sqlite_schema(db, name, value):
+    """Store information about the database in SCHEMA_TABLE (as json)"""
+    query = QSqlQuery(db)
+    query.prepare(f'REPLACE INTO `{SCHEMA_TABLE}` (`name`, `value`) VALUES (:name, :value)')
+    query.bindValue(':name', name)
+    query.bindValue(':value', dumps(value))
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+
+def parse_sql_dump(sql_files):
+    """Parse the schema from MySQL dumps (CREATE TABLE statements, allowed
+    values and the triggers which add rows to the subtables), without
+    connecting to MySQL.
+
+    Parameters
+    ----------
+    sql_files : list of path
+        MySQL dumps (f.e. tests/data/example/sql/*.sql)
+
+    Returns
+    -------
+    dict
+        information about all the tables (same as parse_all_tables)
+    list of dict
+        information about the subtables (same as parse_all_subtables)
+    """
+    tables = {}
+    allowed_values = []
+    subtables = []
+    for sql_file in sql_files:
+        sql = Path(sql_file).read_text()
+
+        for m in finditer(r'CREATE TABLE `(\w+)` \((.*?)\n\)\s*;', sql, flags=DOTALL):
+            tables[m.group(1)] = _parse_create_table(m.group(2))
+
+        for m in finditer(r'INSERT INTO `allowed_values` VALUES (.*?);\n', sql, flags=DOTALL):
+            allowed_values.extend(findall(
+                r"\(\s*'((?:[^']|'')*)'\s*,\s*'((?:[^']|'')*)'\s*,\s*'((?:[^']|'')*)'\s*\)", m.group(1)))
+
+        for m in finditer(r'AFTER INSERT ON `?(\w+)`?\s+FOR EACH ROW\s+(BEGIN.*?END)\s*;;', sql, flags=DOTALL):
+            sub = parse_trigger_statements(m.group(2))
+            if sub is not None:
+                sub['parent'] = m.group(1)
+                subtables.append(sub)
+
+    for table, column, value in allowed_values:
+        try:
+            tables[table][column]['values'].append(value.replace("''", "'"))
+        except KeyError:
+            lg.warning(f'Allowed value for unknown column {table}.{column}')
+
+    return {k: tables[k] for k in sorted(tables)}, subtables
+
+
+def _open_sqlite(path, read_only, connectionName):
+    db = QSqlDatabase.addDatabase('QSQLITE', connectionName)
+    assert db.isValid()
+
+    db.setDatabaseName(str(path))
+    if read_only:
+        db.setConnectOptions('QSQLITE_OPEN_READONLY')
+    db.open()
+
+    if not db.isOpen():
+        raise ValueError(f'Could not open database {path}: {db.lastError().text()}')
+
+    _exec(db, 'PRAGMA foreign_keys = ON')
+    return db
+
+
+def _exec(db, statement):
+    query = QSqlQuery(db)
+    if not query.exec(statement):
+        raise SyntaxError(f'{query.lastError().text()} in:\n{statement}')
+
+
+def _create_table(table, columns, is_subtable):
+    """CREATE TABLE (and indices for the foreign keys)"""
+    defs = []
+    indices = []
+    fk_seen = False
+    for name, v in columns.items():
+        col_type = SQLITE_TYPES.get(v['type'], 'TEXT')
+        if v['index'] is None and name == 'id':
+            defs.append(f'`{name}` INTEGER PRIMARY KEY AUTOINCREMENT')
+        elif v['index']:
+            ref_table, ref_col = search(r'(\w+) \((\w+)\)', v['index']).groups()
+            # the first foreign key of a subtable points to its parent
+            on_delete = 'SET NULL' if (is_subtable and fk_seen) else 'CASCADE'
+            defs.append(f'`{name}` {col_type} REFERENCES `{ref_table}` (`{ref_col}`) ON DELETE {on_delete}')
+            indices.append(f'CREATE INDEX `{table}_{name}` ON `{table}` (`{name}`)')
+            fk_seen = True
+        else:
+            defs.append(f'`{name}` {col_type}')
+
+    return [f'CREATE TABLE `{table}` ({", ".join(defs)})', ] + indices
+
+
+def _create_subtable_triggers(subt):
+    """Same as the MySQL triggers: a row in the subtable is added when the
+    row in the parent table matches the values, and it's moved when the value
+    changes."""
+    parent = subt['parent']
+    subtable = subt['subtable']
+    fk = parent[:-1] + '_id'
+    values = ', '.join("'" + v.replace("'", "''") + "'" for v in subt['values'])
+    condition = f"NEW.`{subt['parameter']}` IN ({values})"
+
+    return [
+        f"""CREATE TRIGGER `add_id_to_subtable_{subtable}` AFTER INSERT ON `{parent}`
+            FOR EACH ROW WHEN {condition}
+            BEGIN INSERT INTO `{subtable}` (`{fk}`) VALUES (NEW.id); END""",
+        f"""CREATE TRIGGER `delete_id_from_subtable_{subtable}` AFTER UPDATE ON `{parent}`
+            FOR EACH ROW WHEN NOT ({condition})
+            BEGIN DELETE FROM `{subtable}` WHERE `{fk}` = NEW.id; END""",
+        f"""CREATE TRIGGER `replace_id_to_subtable_{subtable}` AFTER UPDATE ON `{parent}`
+            FOR EACH ROW WHEN {condition}
+            BEGIN INSERT INTO `{subtable}` (`{fk}`)
+            SELECT NEW.id WHERE NOT EXISTS (SELECT 1 FROM `{subtable}` WHERE `{fk}` = NEW.id); END""",
+        ]
+
+
+def _parse_create_table(body):
+    """Columns of one CREATE TABLE statement, in the same format as
+    parse_all_tables"""
+    columns = {}
+    for line in body.split('\n'):
+        line = line.strip().rstrip(',')
+
+        m = search(r"^`(\w+)` (\w+)(?:\((\d+)\))?", line)
+        if m is not None:
+            name, mysql_type, length = m.groups()
+            if mysql_type.lower() not in MYSQL_TYPES:
+                lg.warning(f'Unknown type "{mysql_type}" of column {name}, it is stored as TEXT')
+                mysql_type = 'text'
+            col_type, default_length = MYSQL_TYPES[mysql_type.lower()]
+            if col_type == 'QString':
+                length = int(length) if length is not None else default_length
+            else:
+                length = None
+
+            comment = search(r"""COMMENT\s*(?:'((?:[^']|'')*)'|"((?:[^"]|"")*)")""", line)
+            if comment is not None:
+                doc = comment.group(1) if comment.group(1) is not None else comment.group(2)
+            else:
+                doc = None
+            alias, doc = split_comment(name, doc)
+
+            columns[name] = {
+                'type': col_type,
+                'values': [],
+                'index': False,
+                'length': length,
+                'alias': alias,
+                'doc': doc,
+                }
+            continue
+
+        m = search(r"^PRIMARY KEY \(`(\w+)`\)", line)
+        if m is not None:
+            columns[m.group(1)]['index'] = None
+            continue
+
+        m = search(r"^UNIQUE KEY `\w+` \((.*)\)", line)
+        if m is not None:
+            for name in findall(r'`(\w+)`', m.group(1)):
+                if columns[name]['index'] is False:
+                    columns[name]['index'] = None
+            continue
+
+        m = search(r"FOREIGN KEY \(`(\w+)`\) REFERENCES `(\w+)` \(`(\w+)`\)", line)
+        if m is not None:
+            columns[m.group(1)]['index'] = f'{m.group(2)} ({m.group(3)})'
+
+    return columns
@@ -13,8 +13,12 @@ LEVELS = [
     'recordings',
     ]
 
+# table with the rows which were changed (see install_change_tracking)
+CHANGE_LOG = 'change_log'
+
 METATABLES = [
     'allowed_values',
+    CHANGE_LOG,
     'intended_for',
     'files',
     'subject_codes',
@@ -39,11 +43,33 @@ EXPECTED_TABLES = (
 
 
 def parse_all_tables(info_schema, db):
+    """Parse all the tables and columns in the database, using one query per
+    type of metadata (indices, comments, allowed values) for all the tables.
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    dict
+        key is the name of the table, value is a dict with one key per column
+    """
+    all_indices = lookup_all_indexes(info_schema, db)
+    all_comments = lookup_all_comments(info_schema, db)
+    all_lengths = lookup_all_lengths(info_schema, db)
+    all_values = lookup_all_allowed_values(db)
+
     TABLES = {}
     for table in sorted(db.tables()):
 
-        indices = lookup_indexes(info_schema, db, table)
-        comments = lookup_comments(info_schema, db, table)
+        indices = all_indices.get(table, {})
+        comments = all_comments.get(table, {})
+        lengths = all_lengths.get(table, {})
+        allowed_values = all_values.get(table, {})
 
         driver = db.driver()
         rec = driver.record(table)
@@ -54,17 +80,10 @@ def parse_all_tables(info_schema, db):
             name = field.name()
             d = {}
             d['type'] = QMetaType.typeName(field.type())
-            d['values'] = lookup_allowed_values(db, table, name)
+            d['values'] = allowed_values.get(name, [])
             d['index'] = indices.get(name, False)
-            doc = comments.get(name, None)
-            if doc is None:
-                d['alias'] = name
-                d['doc'] = None
-            elif ': ' in doc:
-                d['alias'], d['doc'] = doc.split(': ')
-            else:
-                d['alias'] = doc.strip()
-                d['doc'] = None
+            d['length'] = lengths.get(name, None)
+            d['alias'], d['doc'] = split_comment(name, comments.get(name, None))
 
             table_d[name] = d
 
@@ -73,6 +92,60 @@ def parse_all_tables(info_schema, db):
     return TABLES
 
 
+def split_comment(name, comment):
+    """The comment of a column is "Alias: Documentation" (or only "Alias")
+
+    Parameters
+    ----------
+    name : str
+        name of the column (used as alias if there is no comment)
+    comment : str or None
+        comment of the column
+
+    Returns
+    -------
+    str
+        alias
+    str or None
+        documentation
+    """
+    if comment is None or len(comment) == 0:
+        return name, None
+    elif ': ' in comment:
+        alias, doc = comment.split(': ', 1)
+        return alias, doc
+    else:
+        return comment.strip(), None
+
+
+def parse_all_subtables(info_schema, db):
+    """Parse the triggers of all the levels with one query
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    list of dict
+        list of subtables, with the same structure as parse_subtables
+    """
+    all_statements = lookup_all_statements(info_schema, db)
+
+    SUBTABLES = []
+    for table in LEVELS:
+        for statement in all_statements.get(table, []):
+            sub = parse_trigger_statements(statement)
+            if sub is not None:
+                sub['parent'] = table
+                SUBTABLES.append(sub)
+
+    return SUBTABLES
+
+
 def lookup_allowed_values(db, table, column):
     """Look up allowed values from the table
 
@@ -104,6 +177,32 @@ def lookup_allowed_values(db, table, column):
     return values
 
 
+def lookup_all_allowed_values(db):
+    """Look up allowed values for all the tables and columns at once
+
+    Parameters
+    ----------
+    db : instance of QSqlDatabase
+
+    Returns
+    -------
+    dict of dict of list of str
+        allowed values, first by table and then by column
+    """
+    query = QSqlQuery(db)
+    query.prepare('SELECT `table_name`, `column_name`, `allowed_value` FROM allowed_values')
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    values = {}
+    while query.next():
+        table = query.value('table_name')
+        column = query.value('column_name')
+        values.setdefault(table, {}).setdefault(column, []).append(query.value('allowed_value'))
+
+    return values
+
+
 def lookup_indexes(info_schema, db, table):
     """Look up which columns are indices
 
@@ -147,6 +246,46 @@ def lookup_indexes(info_schema, db, table):
     return values
 
 
+def lookup_all_indexes(info_schema, db):
+    """Look up which columns are indices in all the tables at once
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    dict of dict
+        key is the name of the table, value is the same as lookup_indexes
+    """
+    if not info_schema.databaseName() == 'information_schema':
+        raise ValueError('The first argument should be the `information_schema` database, not the database with the data')
+
+    query = QSqlQuery(info_schema)
+    query.prepare("""SELECT `table_name`, `column_name`, `referenced_table_name`, `referenced_column_name` FROM `key_column_usage`
+        WHERE `table_schema` = :schema""")
+    query.bindValue(':schema', db.databaseName())
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    values = {}
+    while query.next():
+        table = query.value('table_name')
+        k = query.value('column_name')
+        t = query.value('referenced_table_name')
+        c = query.value('referenced_column_name')
+        if t == '':
+            values.setdefault(table, {})[k] = None
+        else:
+            values.setdefault(table, {})[k] = f'{t} ({c})'
+
+    return values
+
+
 def lookup_comments(info_schema, db, table):
     """Look up which columns have comments
 
@@ -188,6 +327,82 @@ def lookup_comments(info_schema, db, table):
     return values
 
 
+def lookup_all_comments(info_schema, db):
+    """Look up which columns have comments in all the tables at once
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    dict of dict
+        key is the name of the table, value is the same as lookup_comments
+    """
+    if not info_schema.databaseName() == 'information_schema':
+        raise ValueError('The first argument should be the `information_schema` database, not the database with the data')
+
+    query = QSqlQuery(info_schema)
+    query.prepare("""SELECT `table_name`, `column_name`, `column_comment` FROM `columns`
+        WHERE `table_schema` = :schema""")
+    query.bindValue(':schema', db.databaseName())
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    values = {}
+    while query.next():
+        table = query.value('table_name')
+        k = query.value('column_name')
+        c = query.value('column_comment')
+        if len(c) > 0:
+            if isinstance(c, QByteArray):
+                c = c.data().decode()
+            values.setdefault(table, {})[k] = c
+
+    return values
+
+
+def lookup_all_lengths(info_schema, db):
+    """Look up the maximum number of characters of the text columns in all the
+    tables at once
+
+    Parameters
+    ----------
+    info_schema : instance of QSqlDatabase
+        this should be the `information_schema` database
+    db : instance of QSqlDatabase
+        the database with the actual data
+
+    Returns
+    -------
+    dict of dict
+        key is the name of the table, then the name of the column. Value is
+        the declared length (f.e. 255 for VARCHAR(255))
+    """
+    if not info_schema.databaseName() == 'information_schema':
+        raise ValueError('The first argument should be the `information_schema` database, not the database with the data')
+
+    query = QSqlQuery(info_schema)
+    query.prepare("""SELECT `table_name`, `column_name`, `character_maximum_length` FROM `columns`
+        WHERE `table_schema` = :schema AND `character_maximum_length` IS NOT NULL""")
+    query.bindValue(':schema', db.databaseName())
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    values = {}
+    while query.next():
+        table = query.value('table_name')
+        k = query.value('column_name')
+        values.setdefault(table, {})[k] = int(query.value('character_maximum_length'))
+
+    return values
+
+
 def parse_subtables(info_schema, db, table):
     statements = lookup_statements(info_schema, db, table)
 
@@ -208,7 +423,8 @@ def lookup_statements(info_schema, db, table):
 
     query = QSqlQuery(info_schema)
     query.prepare("""SELECT `action_statement` FROM `triggers`
-        WHERE `event_object_schema` = :schema AND `event_object_table` = :table AND `event_manipulation` = 'INSERT' AND `action_timing` = 'AFTER'""")
+        WHERE `event_object_schema` = :schema AND `event_object_table` = :table AND `event_manipulation` = 'INSERT' AND `action_timing` = 'AFTER'
+        AND `trigger_name` NOT LIKE 'log\\_change\\_%'""")
     query.bindValue(':schema', db.databaseName())
     query.bindValue(':table', table)
 
@@ -225,6 +441,37 @@ def lookup_statements(info_schema, db, table):
     return statements
 
 
+def lookup_all_statements(info_schema, db):
+    """Look up the AFTER INSERT triggers of all the tables at once
+
+    Returns
+    -------
+    dict of list of str
+        key is the name of the table, value is the list of statements
+    """
+    if not info_schema.databaseName() == 'information_schema':
+        raise ValueError('The first argument should be the `information_schema` database, not the database with the data')
+
+    query = QSqlQuery(info_schema)
+    query.prepare("""SELECT `event_object_table`, `action_statement` FROM `triggers`
+        WHERE `event_object_schema` = :schema AND `event_manipulation` = 'INSERT' AND `action_timing` = 'AFTER'
+        AND `trigger_name` NOT LIKE 'log\\_change\\_%'""")
+    query.bindValue(':schema', db.databaseName())
+
+    if not query.exec():
+        raise SyntaxError(query.lastError().text())
+
+    statements = {}
+    while query.next():
+        table = query.value('event_object_table')
+        c = query.value('action_statement')
+        if isinstance(c, QByteArray):
+            c = c.data().decode()
+        statements.setdefault(table, []).append(c)
+
+    return statements
+
+
 def parse_trigger_statements(statement):
 
     cond_str = search(r"IF NEW.([a-z_]+) = '(.+?)'", statement)
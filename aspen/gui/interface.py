@@ -22,6 +22,7 @@ from PyQt5.QtWidgets import (
     QMenu,
     QMessageBox,
     QPushButton,
+    QProgressBar,
     QProgressDialog,
     QDoubleSpinBox,
     QSpinBox,
@@ -55,11 +56,14 @@ from PyQt5.QtSql import (
     QSqlTableModel,
     )
 
-from ..api import list_subjects, Subject, Session, Run, Channels, Electrodes
-from ..api.utils import collect_columns
+from ..api import list_subject_codes, Subject, Session, Run, Channels, Electrodes
+from ..api.backend import refresh_objects
+from ..api.utils import collect_columns, subject_name
 from ..database import access_database, lookup_allowed_values
 from ..database.tables import LEVELS
-from ..bids.root import create_bids
+from ..bids.root import create_bids, add_intended_for
+from ..bids.plan import plan_bids
+from ..bids.estimate import estimate_plan, format_estimate
 from ..bids.io.parrec import convert_parrec_nibabel
 from ..bids.utils import find_one_file
 from ..io.parrec import add_parrec
@@ -70,7 +74,19 @@ from ..io.events import read_events_from_ephys
 from ..io.tsv import load_tsv, save_tsv
 
 from .actions import create_menubar, Search, create_shortcuts
-from .models import FilesWidget, EventsModel
+from .models import FilesWidget, EventsModel, ObjectList
+from .worker import (
+    DatabaseLoader,
+    FileStatusChecker,
+    attach_files,
+    attach_rows,
+    attach_session_groups,
+    attach_tree,
+    read_events,
+    read_files_and_groups,
+    read_rows,
+    read_tree,
+    )
 from .utils import (
     _protocol_name, _name, _session_name, guess_modality, _sort_session_bci, _check_session_bci,
     _session_bci_hide_fields, _check_change_age, _throw_msg_box, _update_visual_parameters_table,
@@ -130,6 +146,8 @@ FILTER_TASKS.extend(UNKNOWN_TASKS)
 HIGHLIGHT_DEFAULT_VALUE_ORANGE = QColor(255, 165, 8)
 
 EXTRA_LEVELS = ['channels', 'electrodes']
+# levels which can have many items, shown with ObjectList
+OBJECT_LEVELS = ['subjects', 'sessions', 'runs']
 NULL_TEXT = 'Unknown / Unspecified'
 
 settings = QSettings("aspen", "aspen")
@@ -138,6 +156,7 @@ lg = getLogger(__name__)
 
 class Interface(QMainWindow):
     db = None
+    loader = None
     test = False
     unsaved_changes = False
 
@@ -148,6 +167,8 @@ class Interface(QMainWindow):
         self.channels_model = None
         self.events_model = None
         self.all_current_params = None
+        self.shown_params = []  # levels in the parameters table (see list_params)
+        self.session_groups = {}  # session id -> channels and electrodes
         self.current_user_rights = None
         self.dict_run_params = None
         self.runs_list = None
@@ -197,10 +218,14 @@ class Interface(QMainWindow):
         groups = {}
         for k in LEVELS + EXTRA_LEVELS:
             groups[k] = QGroupBox(k.capitalize())
-            lists[k] = QListWidget()
-            if k in LEVELS:
+            if k in OBJECT_LEVELS:
+                lists[k] = ObjectList()
+                lists[k].objectChanged.connect(self.select_object)
+            elif k in LEVELS:
+                lists[k] = QListWidget()
                 lists[k].currentItemChanged.connect(self.proc_all)
             elif k in EXTRA_LEVELS:
+                lists[k] = QListWidget()
                 lists[k].currentItemChanged.connect(self.show_channels_electrodes)
 
             # right click
@@ -357,7 +382,16 @@ class Interface(QMainWindow):
         self.modified_by = None
         self.search = Search()
 
-        self.statusBar()
+        # busy indicator while the worker reads from the database
+        self.loading_bar = QProgressBar()
+        self.loading_bar.setRange(0, 0)
+        self.loading_bar.setMaximumWidth(120)
+        self.loading_bar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.loading_bar)
+
+        # files are colored when the check (in the background) is done
+        self.file_checker = FileStatusChecker(self)
+        self.file_checker.checked.connect(self.show_file_status)
         self.show()
 
         self.sql_access(self.config['DATABASENAME'], self.config['DATABASEUSER'],
@@ -392,21 +426,24 @@ class Interface(QMainWindow):
         """
         self.db = access_database(db_name, username, hostname, password)
         self.db['db'].transaction()
+        self.db['transaction'] = True  # the API should not commit the changes
 
         self.events_model = EventsModel(self.db)
 
         self.events_view.setModel(self.events_model)
-        self.events_view.hideColumn(0)
 
         self.channels_model = QSqlTableModel(self, self.db['db'])
         self.channels_model.setTable('channels')
         self.channels_view.setModel(self.channels_model)
-        self.channels_view.hideColumn(0)
+        _hide_columns(self.channels_view, self.channels_model, ('id', 'channel_group_id'))
 
         self.electrodes_model = QSqlTableModel(self, self.db['db'])
         self.electrodes_model.setTable('electrodes')
         self.electrodes_view.setModel(self.electrodes_model)
-        self.electrodes_view.hideColumn(0)
+        _hide_columns(self.electrodes_view, self.electrodes_model, ('id', 'electrode_group_id'))
+
+        self.loader = DatabaseLoader(self.db, self)
+        self.loader.loading.connect(self.loading_bar.setVisible)
 
         self.list_subjects()
 
@@ -420,6 +457,7 @@ class Interface(QMainWindow):
     @editor_rights
     def sql_rollback(self, *args, **kwargs):
         self.db['db'].rollback()
+        refresh_objects(self.db)
         self.unsaved_changes = False
         self.setWindowTitle('')
         self.db['db'].transaction()
@@ -430,10 +468,13 @@ class Interface(QMainWindow):
         code_to_select : str
             code of the subject to select
         """
+        if self.loader is not None:
+            self.loader.cancel()
+        self.shown_params = []
+        self.session_groups = {}
         for line in self.lists.values():
             line.clear()
 
-        to_select = None
         if self.subjsort.isChecked():
             args = {
                 'alphabetical': True,
@@ -444,18 +485,20 @@ class Interface(QMainWindow):
                 'alphabetical': False,
                 'reverse': True,
                 }
-        for subj in list_subjects(self.db, **args):
+        # the subjects are created only when they are selected
+        rows = []
+        to_select = 0  # select first one
+        for subj_id, codes in list_subject_codes(self.db, **args):
             # ASP-62 Request to display all patient names in lowercase.
-            item = QListWidgetItem(str(subj).lower())
-            if subj.id in self.search.subjects:
-                highlight(item)
-            item.setData(Qt.UserRole, subj)
-            self.lists['subjects'].addItem(item)
-            if code_to_select is not None and code_to_select == str(subj):
-                to_select = item
-            if to_select is None:  # select first one
-                to_select = item
-        self.lists['subjects'].setCurrentItem(to_select)
+            rows.append((subject_name(codes).lower(), subj_id, subj_id in self.search.subjects))
+            if code_to_select is not None and code_to_select == subject_name(codes):
+                to_select = len(rows) - 1
+        self.lists['subjects'].set_rows(
+            rows, factory=lambda subj_id: Subject(self.db, id=subj_id), current=to_select)
+
+    @pyqtSlot(object)
+    def select_object(self, obj):
+        self.proc_all(item=obj)
 
     @pyqtSlot(QListWidgetItem, QListWidgetItem)
     def proc_all(self, current=None, previous=None, item=None):
@@ -469,7 +512,9 @@ class Interface(QMainWindow):
             item = current.data(Qt.UserRole)
 
         if item.t == 'subject':
-            self.list_sessions_and_protocols(item)
+            # sessions, runs and recordings of the subject are read in the background
+            self.load('tree', read_tree, item.id, callback=partial(self.show_subject, item))
+            return
 
         elif item.t == 'session':
             self.list_runs(item)
@@ -484,8 +529,30 @@ class Interface(QMainWindow):
         elif item.t == 'recording':
             self.list_channels_electrodes(item)
 
-        self.list_params()
-        self.list_files()
+        self.load_params()
+        self.load_files()
+
+    def load(self, key, func, *args, callback):
+        """Call func(db, *args) in the worker thread and then callback(result)
+        in the GUI (see DatabaseLoader). A new request with the same key
+        cancels the previous one.
+
+        When there are unsaved changes, func is called directly with the main
+        connection, because the connection of the worker cannot see the
+        changes which have not been committed yet. For this reason, call
+        modified() after each change, before the views are loaded again.
+        """
+        if self.unsaved_changes or self.loader is None:
+            callback(func(self.db, *args))
+        else:
+            self.loader.submit(key, func, *args, callback=callback)
+
+    def show_subject(self, subj, tree):
+        attach_tree(self.db, tree)
+        self.list_sessions_and_protocols(subj)
+        if self.lists['sessions'].count() == 0 and self.lists['protocols'].count() == 0:
+            self.load_params()
+            self.load_files()
 
     def list_sessions_and_protocols(self, subj=None):
 
@@ -496,6 +563,8 @@ class Interface(QMainWindow):
             if level in ('subjects', ):
                 continue
             l.clear()
+        if self.loader is not None:
+            self.loader.cancel('events')
 
         # XEL-60 We need to sort BCI sessions differently
         subject_list = subj.list_sessions()
@@ -509,15 +578,14 @@ class Interface(QMainWindow):
         subject_list.extend(bci_list)  # add bci entries at end of list so sort goes non-bci -> bci in view
 
         # XEL-60 adding a display of session number on the session list view
+        rows = []
         for index, sess in enumerate(subject_list):  # XEL-60 index
             if sess.name != 'BCI':
-                item = QListWidgetItemTime(sess, f"{_session_name(sess)}")  # XEL-60 adding index to view
+                title = f"{_session_name(sess)}"  # XEL-60 adding index to view
             else:
-                item = QListWidgetItemTime(sess, f"{_session_bci_name(sess)}")  # ASP-161 different display
-            if sess.id in self.search.sessions:
-                highlight(item)
-            self.lists['sessions'].addItem(item)
-        self.lists['sessions'].setCurrentRow(0)
+                title = f"{_session_bci_name(sess)}"  # ASP-161 different display
+            rows.append((title, sess, sess.id in self.search.sessions))
+        self.lists['sessions'].set_rows(rows)
 
         for protocol in subj.list_protocols():
             item = QListWidgetItem(_protocol_name(protocol))
@@ -534,12 +602,10 @@ class Interface(QMainWindow):
                 continue
             l.clear()
 
+        rows = []
         for i, run in enumerate(sess.list_runs()):
-            item = QListWidgetItemTime(run, f'#{i + 1: 3d}: {run.task_name}')
-            if run.id in self.search.runs:
-                highlight(item)
-            self.lists['runs'].addItem(item)
-        self.lists['runs'].setCurrentRow(0)
+            rows.append((f'#{i + 1: 3d}: {run.task_name}', run, run.id in self.search.runs))
+        self.lists['runs'].set_rows(rows)
 
     def list_recordings(self, run=None):
 
@@ -592,45 +658,100 @@ class Interface(QMainWindow):
     def statusbar_selected(self):
 
         statusbar = []
-        for k, v in self.lists.items():
-            item = v.currentItem()
-            if item is None:
-                continue
-            obj = item.data(Qt.UserRole)
+        for k, obj in self.current_objects():
             statusbar.append(repr(obj))
 
         self.statusBar().showMessage('\t'.join(statusbar))
 
-    def list_params(self):
+    def current_objects(self):
+        """Objects which are selected in each list
+
+        Returns
+        -------
+        list of tuple
+            level (f.e. 'runs') and object
+        """
+        objs = []
+        for k in self.lists:
+            obj = self.current(k)
+            if obj is not None:
+                objs.append((k, obj))
+        return objs
+
+    def load_params(self):
+        """Read the rows of the selected objects in the background, then
+        list_params. The objects whose parameters are shown already are not
+        read again."""
+        objs = self.current_objects()
+        n_shown = self._n_shown_params(objs)
+        objs = [obj for k, obj in objs[n_shown:]]
+        self.load(
+            'params', read_rows, [(obj.t, obj.id) for obj in objs],
+            callback=partial(self.show_params, objs))
+
+    def show_params(self, objs, rows):
+        attach_rows(objs, rows)
+        self.list_params(refresh=False)
+
+    def _n_shown_params(self, objs):
+        """Number of levels (from the top) whose parameters are shown already
+        for the same objects (and the same session, which changes the fields)"""
+        sess = self.current('sessions')
+        session_name = None if sess is None else sess.name
+        n_shown = 0
+        for (k, obj), shown in zip(objs, self.shown_params):
+            if shown['level'] != k or shown['obj'] is not obj or shown['session_name'] != session_name:
+                break
+            n_shown += 1
+        return n_shown
+
+    def list_params(self, refresh=True):
+        """Show the parameters of the selected objects
+
+        Parameters
+        ----------
+        refresh : bool
+            if False, the widgets of the levels which are shown already (same
+            objects) are kept, only the levels below are created again
+        """
         self.statusbar_selected()
 
         self.t_params.blockSignals(True)
-        self.t_params.clearContents()
 
         # ASP-64 Need to store the session, so we don't create a lookup request inside the dict loop
-        current_session_name = self.lists['sessions'].currentItem().data(Qt.UserRole).name
+        current_session_name = self.current('sessions').name
 
-        all_params = []
-        for k, v in self.lists.items():
-            item = v.currentItem()
-            if item is None:
-                continue
-            obj = item.data(Qt.UserRole)
+        objs = self.current_objects()
+        if refresh:
+            self.session_groups = {}
+            n_shown = 0
+        else:
+            n_shown = self._n_shown_params(objs)
+        shown_params = self.shown_params[:n_shown]
+        # remove the rows (and their widgets) of the levels which changed
+        n_rows = sum(len(shown['parameters']) for shown in shown_params)
+        self.t_params.setRowCount(n_rows)
+
+        for k, obj in objs[n_shown:]:
+            shown = {
+                'level': k,
+                'obj': obj,
+                'session_name': current_session_name,
+                'modified_by': None,
+                }
+            shown_params.append(shown)
 
             parameters = {}
             parameters.update(list_parameters(self, obj))
+            all_parameters = dict(parameters)
             if 'Modified By' in parameters:
-                self.modified_by = parameters['Modified By']
+                shown['modified_by'] = parameters['Modified By']
 
-            # ASP-63 We need a small reference when checking parms to corresponding fields. When found connect slots.
-            if 'Age' in parameters:
-                _age = parameters['Age']
+            # ASP-63 When the date of birth or the start time change, update the age
             if 'Date of Birth' in parameters:
-                _dob = parameters['Date of Birth']
-                _dob.dateChanged.connect(lambda: _check_change_age(_dob, _start_time, _age))
+                parameters['Date of Birth'].dateChanged.connect(self.update_age)
             if 'Start Time' in parameters:
-                _start_time = parameters['Start Time']
-                _start_time.dateChanged.connect(lambda: _check_change_age(_dob, _start_time, _age))
+                parameters['Start Time'].dateChanged.connect(self.update_age)
             if 'Task Name' in parameters:  # ASP-229 fixing a bug for display of Task Names in params
                 _task_names_combobox = parameters['Task Name']
                 apply_task_name_sorting_filtering(_task_names_combobox, self, FILTER_TASKS)
@@ -652,12 +773,12 @@ class Interface(QMainWindow):
 
             elif k == 'recordings':
                 if obj.modality in ('ieeg', 'eeg', 'meg'):
-                    parameters.update(list_parameters(self, obj))
-                    sess = self.current('sessions')
+                    parameters.update(all_parameters)
+                    channels_list, electrodes_list = self.list_session_groups(self.current('sessions'))
                     w = QComboBox()  # add callback here
                     w.addItem('(undefined channels)', None)
 
-                    for chan in sess.list_channels():
+                    for chan in channels_list:
                         w.addItem(_name(chan.name), chan)
 
                     channels = obj.channels
@@ -671,7 +792,7 @@ class Interface(QMainWindow):
                     w = QComboBox()
                     w.addItem('(undefined electrodes)', None)
 
-                    for elec in sess.list_electrodes():
+                    for elec in electrodes_list:
                         w.addItem(_name(elec.name), elec)
 
                     electrodes = obj.electrodes
@@ -682,36 +803,66 @@ class Interface(QMainWindow):
                     w.activated.connect(partial(self.combo_chanelec, widget=w))
                     parameters.update({'Electrodes': w})
 
+            shown['parameters'] = parameters
+
+            i = self.t_params.rowCount()
+            self.t_params.setRowCount(i + len(parameters))
             for p_k, p_v in parameters.items():
+                item = QTableWidgetItem(self.groups[k].title())
+                item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
+                item.setBackground(QBrush(QColor('lightGray')))
+                self.t_params.setItem(i, 0, item)
+                item = QTableWidgetItem(p_k)
+                item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
+                self.t_params.setItem(i, 1, item)
+                self.t_params.setCellWidget(i, 2, p_v)
+                i += 1
+
+        self.shown_params = shown_params
+        all_params = []
+        for shown in shown_params:
+            if shown['modified_by'] is not None:
+                self.modified_by = shown['modified_by']
+            for p_k, p_v in shown['parameters'].items():
                 all_params.append({
-                    'level': self.groups[k].title(),
+                    'level': self.groups[shown['level']].title(),
                     'parameter': p_k,
                     'value': p_v,
                 })
         self.all_current_params = all_params  # ASP-107 quick save of all the params
-        self.t_params.setRowCount(len(all_params))
-
-        for i, val in enumerate(all_params):
-            item = QTableWidgetItem(val['level'])
-            item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-            item.setBackground(QBrush(QColor('lightGray')))
-            self.t_params.setItem(i, 0, item)
-            item = QTableWidgetItem(val['parameter'])
-            item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-            self.t_params.setItem(i, 1, item)
-            # item = QTableWidgetItem(str(val['value']))
-            self.t_params.setCellWidget(i, 2, val['value'])
 
         # ASP-68 Addition of dedicated function call to modify visuals of parameters
         _update_visual_parameters_table(self.t_params)
 
         # ASP-123 need to hide DoB, which is always the first element in self.all_current_params
-        if self.current_user_rights == "Student":
+        if self.current_user_rights == "Student" and n_shown == 0:
             _ = QLabel()
             _.setText("***")
             self.t_params.setCellWidget(0, 2, _)
         self.t_params.blockSignals(False)
 
+    def update_age(self):
+        """ASP-63 Compute the age from the date of birth and the start time
+        which are shown in the parameters"""
+        if self.current_user_rights == "Student":  # the date of birth is hidden
+            return
+        params = {val['parameter']: val['value'] for val in self.all_current_params}
+        if all(p in params for p in ('Date of Birth', 'Start Time', 'Age')):
+            _check_change_age(params['Date of Birth'], params['Start Time'], params['Age'])
+
+    def list_session_groups(self, sess):
+        """Channels and electrodes of one session. They are kept until the
+        parameters are refreshed or the database is modified.
+
+        Returns
+        -------
+        list of instances of Channels
+        list of instances of Electrodes
+        """
+        if sess.id not in self.session_groups:
+            self.session_groups[sess.id] = (sess.list_channels(), sess.list_electrodes())
+        return self.session_groups[sess.id]
+
     def combo_chanelec(self, i, widget):
         data = widget.currentData()
         recording = self.current('recordings')
@@ -735,35 +886,63 @@ class Interface(QMainWindow):
         self.modified()
 
     def current(self, level):
+        if level in OBJECT_LEVELS:
+            return self.lists[level].current()
         item = self.lists[level].currentItem()
         if item is not None:
             return item.data(Qt.UserRole)
 
+    def load_files(self):
+        """Read the files of the selected objects (and check if they exist) in
+        the background, then show them"""
+        objs = self.current_objects()
+        session_id = self._session_groups_to_read()
+        self.load(
+            'files', read_files_and_groups, [(obj.t, obj.id) for k, obj in objs], session_id,
+            callback=partial(self.show_files, objs, session_id))
+
     def list_files(self):
+        self.file_checker.clear()  # the files might have been added or moved
+        objs = self.current_objects()
+        session_id = self._session_groups_to_read()
+        self.show_files(objs, session_id, read_files_and_groups(
+            self.db, [(obj.t, obj.id) for k, obj in objs], session_id))
+
+    def _session_groups_to_read(self):
+        """id of the current session, if its channels and electrodes are not
+        known yet (see list_session_groups)"""
+        sess = self.current('sessions')
+        if sess is None or sess.id in self.session_groups:
+            return None
+        return sess.id
+
+    def show_files(self, objs, session_id, result):
 
         self.t_files.blockSignals(True)
         self.t_files.clearContents()
 
+        files, groups = result
+        if groups is not None:
+            self.session_groups[session_id] = attach_session_groups(self.db, groups)
+        files = attach_files(self.db, files)
         all_files = []
-        for k, v in self.lists.items():
-            item = v.currentItem()
-            if item is None:
-                continue
-            obj = item.data(Qt.UserRole)
-            for file in obj.list_files():
+        for k, obj in objs:
+            for file in files[(obj.t, obj.id)]:
                 # ASP-123 For students account we hide the value for protocols
                 if self.current_user_rights == "Student" and self.groups[k].title() == "Protocols":
                     all_files.append({
                         'level': self.groups[k].title(),
                         'format': file.format,
                         'path': "***",
+                        'status': None,
                         'obj': [obj, file],
                     })
                 else:
                     all_files.append({
                         'level': self.groups[k].title(),
                         'format': file.format,
-                        'path': file.path,
+                        'path': file.stored_path,  # resolved by file_checker
+                        'status': self.file_checker.check(file.stored_path),
                         'obj': [obj, file],
                     })
 
@@ -782,28 +961,24 @@ class Interface(QMainWindow):
             self.t_files.setItem(i, 1, item)
 
             item = QTableWidgetItem(str(val['path']))
-            try:
-                path_exists = val['path'].exists()
-
-            except PermissionError as err:
-                lg.warning(err)
-                item.setForeground(QBrush(QColor('orange')))
-
-            except AttributeError:
-                pass
-            else:
-                if not path_exists:
-                    item.setForeground(QBrush(QColor('red')))
-
+            _color_file_status(item, val['status'])
             item.setData(Qt.UserRole, val['obj'])
             self.t_files.setItem(i, 2, item)
 
         self.t_files.blockSignals(False)
         _mark_channel_file_visual(self.t_files,
-                                  self.current('sessions').list_channels(),
+                                  self.list_session_groups(self.current('sessions'))[0],
                                   self.all_current_params,
                                   self.lists['channels'])
 
+    @pyqtSlot(str, str)
+    def show_file_status(self, path, status):
+        """Color the files when the check is done (see FileStatusChecker)"""
+        for i in range(self.t_files.rowCount()):
+            item = self.t_files.item(i, 2)
+            if item is not None and item.text() == path:
+                _color_file_status(item, status)
+
     def changed(self, obj, column, x):
         if isinstance(x, QDate):
             x = x.toPyDate()
@@ -822,7 +997,7 @@ class Interface(QMainWindow):
         self.modified()
 
     def show_events(self, item):
-        self.events_model.update(item.events)
+        self.load('events', read_events, item.id, callback=self.events_model.update)
 
     @editor_rights
     def compare_events_with_file(self, *args, **kwargs):
@@ -873,9 +1048,9 @@ class Interface(QMainWindow):
     def exporting(self, checked=None, subj=None, sess=None, run=None, *args, **kwargs):
 
         if subj is None:
-            subj = self.lists['subjects'].currentItem().data(Qt.UserRole)
-            sess = self.lists['sessions'].currentItem().data(Qt.UserRole)
-            run = self.lists['runs'].currentItem().data(Qt.UserRole)
+            subj = self.current('subjects')
+            sess = self.current('sessions')
+            run = self.current('runs')
 
         d = {}
         d['subjects'] = str(subj)
@@ -953,15 +1128,16 @@ class Interface(QMainWindow):
 
         if table == 'events':
             run.events = x
-            self.show_events(run)
-
         else:
             current.data = _fake_names(x)
+        self.modified()
+
+        if table == 'events':
+            self.show_events(run)
+        else:
             recording = self.current('recordings')
             self.list_channels_electrodes(recording=recording)
 
-        self.modified()
-
     def tsv_export(self, table):
 
         tsv_file = QFileDialog.getSaveFileName(
@@ -984,24 +1160,26 @@ class Interface(QMainWindow):
 
     @editor_rights
     def rightclick_list(self, pos, level=None, *args, **kwargs):
-        item = self.lists[level].itemAt(pos)
+        if level in OBJECT_LEVELS:
+            obj = self.lists[level].object_at(pos)
+        else:
+            item = self.lists[level].itemAt(pos)
+            obj = None if item is None else item.data(Qt.UserRole)
 
         menu = QMenu(self)
         # ASP-107 deprecating manually adding channel files
-        if item is None and level == 'channels':
+        if obj is None and level == 'channels':
             action = QAction(f'Add {level}', self)
             action.triggered.connect(lambda x: _throw_msg_box("Deprecated", "Use 'Import > channels from IEEG/EEG/MEG recording' option instead"))
             menu.addAction(action)
 
         # ASP-107 still need this one for all other in-menu right-clicks
-        elif item is None:
+        elif obj is None:
             action = QAction(f'Add {level}', self)
             action.triggered.connect(lambda x: self.new_item(level=level))
             menu.addAction(action)
 
         else:
-            obj = item.data(Qt.UserRole)
-
             if obj.t in ('channel_group', 'electrode_group'):
                 action_rename = QAction('Rename', self)
                 action_rename.triggered.connect(lambda x: self.rename_item(obj))
@@ -1022,10 +1200,12 @@ class Interface(QMainWindow):
 
         if ok and text != '':
             item.name = text
+            self.modified()
 
     @admin_rights
     def delete_item(self, item):
         item.delete()
+        self.modified()
 
         if item.t == 'subject':
             self.list_subjects()
@@ -1044,7 +1224,6 @@ class Interface(QMainWindow):
 
         self.list_params()
         self.list_files()
-        self.modified()
 
     @editor_rights
     def rightclick_files(self, pos, *args, **kwargs):
@@ -1119,6 +1298,7 @@ class Interface(QMainWindow):
 
     def modified(self):
         self.unsaved_changes = True
+        self.session_groups = {}
         self.setWindowTitle('*' + self.windowTitle())
 
     def do_export(self, checked=None):
@@ -1142,6 +1322,18 @@ class Interface(QMainWindow):
             subset['sessions'].append(query.value(1))
             subset['runs'].append(query.value(2))
 
+        # the plan does not depend on the folder, it's moved there by create_bids
+        plan = plan_bids(self.db, 'bids_output', subset=add_intended_for(self.db, subset))
+        estimate = estimate_plan(self.db, plan, deface=False)
+        answer = QMessageBox.question(
+            self,
+            'Export to BIDS',
+            format_estimate(estimate) + '\n\nDo you want to continue?',
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.Yes)
+        if answer == QMessageBox.No:
+            return
+
         data_path = QFileDialog.getSaveFileName(
             self,
             "Choose directory where to save the recordings in BIDS format",
@@ -1160,7 +1352,7 @@ class Interface(QMainWindow):
                 )
             return
 
-        create_bids(self.db, data_path, deface=False, subset=subset)
+        create_bids(self.db, data_path, deface=False, plan=plan)
 
     @editor_rights
     def new_item(self, checked=None, level=None, *args, **kwargs):
@@ -1250,6 +1442,7 @@ class Interface(QMainWindow):
                 )
 
         if ok and text != '':
+            self.modified()  # before the views are loaded again
             if level == 'subjects':
                 code = text.strip()
                 Subject.add(self.db, code)
@@ -1288,7 +1481,6 @@ class Interface(QMainWindow):
                 self.list_recordings(self.current('runs'))
                 self.list_channels_electrodes(current_recording)
                 self.list_params()
-            self.modified()
 
     @editor_rights
     def edit_subject_codes(self, *args, **kwargs):
@@ -1306,8 +1498,8 @@ class Interface(QMainWindow):
         if ok and text != '':
             text = text.strip(', ')
             subject.codes = [x.strip() for x in text.split(',')]
-            self.list_subjects()
             self.modified()
+            self.list_subjects()
 
     @editor_rights
     def new_mental_strategy(self, *args, **kwargs):  # ASP-167 Allowing for mental_strategy additions in runs.mental_strategy
@@ -1367,12 +1559,12 @@ class Interface(QMainWindow):
             if item is None:  # ASP-102 Providing a bit more information to the user if no recording can be found.
                 _throw_msg_box('Warning!', "Please add a Recording, before you add recording file(s).")
             else:  # ASP-102 only add the file and list_files()/modified() if item is not None, prevent XCB error
-                current_session_name = self.lists['sessions'].currentItem().data(Qt.UserRole).name
+                current_session_name = self.current('sessions').name
                 if _check_session_bci(current_session_name):  # ASP-226 adding a check to only do this for bci sess
                     extract_file_name_properties(self, path)
                 item.add_file(format_file, path)
-                self.list_files()
                 self.modified()
+                self.list_files()
 
     @editor_rights
     def edit_file(self, level_obj, file_obj, *args, **kwargs):
@@ -1384,9 +1576,9 @@ class Interface(QMainWindow):
             path = get_new_file.filepath.text()
             file_obj.path = path
             file_obj.format = format_file
+            self.modified()
 
         self.list_files()
-        self.modified()
 
     @editor_rights
     def calculate_offset(self, *args, **kwargs):
@@ -1423,14 +1615,14 @@ class Interface(QMainWindow):
                 return
             offset = float(text[:-1])
             rec_moving.offset = offset
+            self.modified()
 
             self.list_params()
-            self.modified()
 
     @editor_rights
     def edit_electrode_data(self, *args, **kwargs):
         elec = self.current('electrodes')
-        data = elec.data
+        data = elec.read_data(primary_key=True)
         edit_electrodes = EditElectrodes(self, data)
         result = edit_electrodes.exec()
 
@@ -1439,10 +1631,10 @@ class Interface(QMainWindow):
             value = edit_electrodes.value.text()
 
             data[parameter] = array(value).astype(data.dtype[parameter])
-            elec.data = data
+            elec.update_data(data)
+            self.modified()
 
             self.show_channels_electrodes(item=elec)
-            self.modified()
 
     def io_parrec(self):
         run = self.current('runs')
@@ -1456,9 +1648,9 @@ class Interface(QMainWindow):
                 break
 
         if success:
+            self.modified()
             self.list_recordings(run)
             self.list_params()
-            self.modified()
         else:
             self.statusBar().showMessage('Cound not find PAR/REC to collect info from')
 
@@ -1485,9 +1677,9 @@ class Interface(QMainWindow):
                 break
 
         progress.setValue(i + 1)
+        self.modified()
         self.list_runs(sess)
         self.list_params()
-        self.modified()
 
     def io_ephys(self):
         sess = self.current('sessions')
@@ -1501,10 +1693,10 @@ class Interface(QMainWindow):
             return
 
         add_ephys_to_sess(self.db, sess, Path(ephys_file))
+        self.modified()
 
         self.list_runs(sess)
         self.list_params()
-        self.modified()
 
     def io_events_only(self):
         run = self.current('runs')
@@ -1518,9 +1710,9 @@ class Interface(QMainWindow):
 
         if len(events) > 0:
             run.events = events
-            self.show_events(run)
-
             self.modified()
+
+            self.show_events(run)
         else:
             print('there were no events')
 
@@ -1539,10 +1731,10 @@ class Interface(QMainWindow):
             run.start_time = compare_events.info['start_time']
             run.duration = compare_events.info['duration']
             run.events = compare_events.info['events']
+            self.modified()
 
             self.list_params()
             self.show_events(run)
-            self.modified()
 
     def io_channels(self):
         recording = self.current('recordings')
@@ -1596,8 +1788,8 @@ class Interface(QMainWindow):
     @admin_rights
     def delete_file(self, level_obj, file_obj):
         level_obj.delete_file(file_obj)
-        self.list_files()
         self.modified()
+        self.list_files()
 
     def closeEvent(self, event):
 
@@ -1616,6 +1808,9 @@ class Interface(QMainWindow):
         settings.setValue('window/geometry', self.saveGeometry())
         settings.setValue('window/state', self.saveState())
 
+        if self.loader is not None:
+            self.loader.close()
+        self.file_checker.close()
         event.accept()
 
 
@@ -1727,7 +1922,7 @@ def make_combobox(value, possible_values):
 
 
 def make_electrode_combobox(self, elec):
-    subj = self.lists['subjects'].currentItem().data(Qt.UserRole)
+    subj = self.current('subjects')
     intended = {'Unknown': 0}
     for sess in subj.list_sessions():
         sess_name = _session_name(sess)
@@ -1787,6 +1982,13 @@ def copy_to_clipboard(text):
     clipboard.setText(text)
 
 
+def _color_file_status(item, status):
+    if status == 'no permission':
+        item.setForeground(QBrush(QColor('orange')))
+    elif status == 'missing':
+        item.setForeground(QBrush(QColor('red')))
+
+
 def highlight(item):
     item.setBackground(Qt.yellow)
     font = item.font()
@@ -1794,19 +1996,17 @@ def highlight(item):
     item.setFont(font)
 
 
-class QListWidgetItemTime(QListWidgetItem):
-    def __init__(self, obj, title):
-        self.obj = obj
-        super().__init__(title)
-        self.setData(Qt.UserRole, obj)
-
-    def __lt__(self, other):
-        return self.obj.start_time < other.obj.start_time
-
-
 def _fake_names(x):
     """We cannot have empty channel names, so we use it the MICROMED convention."""
     for i in range(x['name'].shape[0]):
         if x['name'][i] == '':
             x['name'][i] = f'el{i + 1}'
     return x
+
+
+def _hide_columns(view, model, names):
+    """Hide the columns by name (the position depends on the schema)"""
+    for name in names:
+        i = model.fieldIndex(name)
+        if i >= 0:
+            view.hideColumn(i)
@@ -6,6 +6,7 @@ import sys
 from PyQt5.QtWidgets import QApplication
 
 from .interface import Interface
+from ..database.instrument import start_instrumentation
 
 lg = getLogger(__name__)
 handler = StreamHandler(stream=sys.stdout)
@@ -39,8 +40,14 @@ def main():
     parser.add_argument(
         '-H', '--hostname', default='localhost',
         help='host name (if different from localhost)')
+    parser.add_argument(
+        '--profile-sql', default=None,
+        help='record all the SQL statements and write a report to this file on exit (.json or text)')
     args = parser.parse_args()
 
+    if args.profile_sql is not None:
+        start_instrumentation(args.profile_sql)
+
     if args.mysql is not None and args.username is not None:
         if args.password is not None:
             password = args.password
@@ -167,7 +167,7 @@ class EditElectrodes(QDialog):
 
         self.parameter = QComboBox()
         for n in data.dtype.names:
-            if n in ('name', 'x', 'y', 'z'):
+            if n in ('id', 'name', 'x', 'y', 'z'):
                 continue
             self.parameter.addItem(n)
 
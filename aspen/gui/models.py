@@ -1,12 +1,27 @@
-from numpy import argmin, abs, empty, atleast_1d
+from numpy import abs, argsort, atleast_1d, clip, empty, searchsorted, where
 from PyQt5.QtWidgets import (
+    QListView,
     QTableWidget,
     )
-from PyQt5.QtCore import QUrl, QAbstractTableModel, Qt, QVariant
-from PyQt5.QtGui import QBrush
+from PyQt5.QtCore import (
+    QUrl,
+    QAbstractListModel,
+    QAbstractTableModel,
+    QModelIndex,
+    Qt,
+    QVariant,
+    pyqtSignal,
+    )
+from PyQt5.QtGui import QBrush, QFont
 
+from ..api.utils import get_dtypes
 from ..io.ephys import localize_blackrock
 
+# number of rows which are added to the view at once (see ObjectsModel)
+FETCH_PAGE = 100
+# maximum difference (in s) between the onset of an event and of the marker in the file
+ONSET_TOLERANCE = 0.001
+
 
 class FilesWidget(QTableWidget):
     def __init__(self, parent):
@@ -27,18 +42,143 @@ class FilesWidget(QTableWidget):
         self.parent.new_file(filename=file_path)
 
 
+class ObjectsModel(QAbstractListModel):
+    """Objects of the api shown in a list. Each row has a text, the object (or
+    the value which is passed to `factory` to create it, only when the object
+    is needed) and whether the row is highlighted.
+
+    The rows are added to the view in pages (see canFetchMore and fetchMore),
+    so the time to show the list does not depend on the number of rows.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.n_fetched = 0
+        self.factory = None
+        self.objects = {}  # row -> object created by factory
+
+    def set_rows(self, rows, factory=None):
+        """
+        rows : list of tuple
+            text, object (or the argument of factory) and highlighted (bool)
+        factory : function or None
+            function which creates the object of one row. If None, the rows
+            contain the objects.
+        """
+        self.beginResetModel()
+        self.rows = rows
+        self.factory = factory
+        self.objects = {}
+        self.n_fetched = min(FETCH_PAGE, len(rows))
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.n_fetched
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.n_fetched < len(self.rows)
+
+    def fetchMore(self, parent):
+        n_rows = min(FETCH_PAGE, len(self.rows) - self.n_fetched)
+        if parent.isValid() or n_rows <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.n_fetched, self.n_fetched + n_rows - 1)
+        self.n_fetched += n_rows
+        self.endInsertRows()
+
+    def fetch_until(self, row):
+        """Make sure that the row is in the view"""
+        while row >= self.n_fetched and self.canFetchMore(QModelIndex()):
+            self.fetchMore(QModelIndex())
+
+    def object(self, row):
+        if self.factory is None:
+            return self.rows[row][1]
+        if row not in self.objects:
+            self.objects[row] = self.factory(self.rows[row][1])
+        return self.objects[row]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+
+        text, value, highlighted = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+
+        elif role == Qt.UserRole:
+            return self.object(index.row())
+
+        elif role == Qt.BackgroundRole and highlighted:
+            return QBrush(Qt.yellow)
+
+        elif role == Qt.FontRole and highlighted:
+            font = QFont()
+            font.setBold(True)
+            return font
+
+        else:
+            return QVariant()
+
+
+class ObjectList(QListView):
+    """List of objects, with ObjectsModel. It emits objectChanged when the
+    user selects an object."""
+    objectChanged = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.setUniformItemSizes(True)
+        self.setModel(ObjectsModel(self))
+        self.selectionModel().currentChanged.connect(self._current_changed)
+
+    def set_rows(self, rows, factory=None, current=0):
+        """Replace the rows (see ObjectsModel.set_rows) and select one row"""
+        self.model().set_rows(rows, factory)
+        self.setCurrentRow(current)
+
+    def setCurrentRow(self, row):
+        if 0 <= row < self.count():
+            self.model().fetch_until(row)
+            self.setCurrentIndex(self.model().index(row))
+
+    def count(self):
+        return len(self.model().rows)
+
+    def clear(self):
+        self.model().set_rows([])
+
+    def current(self):
+        """Object which is currently selected (or None)"""
+        index = self.currentIndex()
+        if index.isValid():
+            return self.model().object(index.row())
+
+    def object_at(self, pos):
+        index = self.indexAt(pos)
+        if index.isValid():
+            return self.model().object(index.row())
+
+    def _current_changed(self, current, previous):
+        if current.isValid():
+            self.objectChanged.emit(self.model().object(current.row()))
+
+
 class EventsModel(QAbstractTableModel):
     X = None
     columns = None
     file_events = None
+    matched = None  # for each event, if it matches the closest marker in the file
 
     def __init__(self, db):
-        columns = [k for k, v in db['tables']['events'].items()]
-        self.columns = columns
+        self.columns = list(get_dtypes(db['tables']['events']).names)
         super().__init__()
 
     def update(self, data):
         self.file_events = None
+        self.matched = None
         self.beginResetModel()
         self.X = data
         self.endResetModel()
@@ -56,6 +196,7 @@ class EventsModel(QAbstractTableModel):
 
         self.beginResetModel()
         self.file_events = file_events
+        self.matched = match_events(self.X, file_events)
         self.endResetModel()
 
     def rowCount(self, index):
@@ -85,18 +226,59 @@ class EventsModel(QAbstractTableModel):
             val = self.X[i][j]
             return str(val)
 
-        elif role == Qt.ForegroundRole and self.file_events is not None:
-            mrk_diff = abs(self.file_events['onset'] - self.X[i]['onset'])
-            i_min = argmin(mrk_diff)
-            if mrk_diff[i_min] > 0.001 or self.file_events['value'][i_min] != self.X[i]['value']:
-                return QBrush(Qt.red)
-            else:
+        elif role == Qt.ForegroundRole and self.matched is not None:
+            if self.matched[i]:
                 return QBrush(Qt.green)
+            else:
+                return QBrush(Qt.red)
 
         else:
             return QVariant()
 
 
+def match_events(events, file_events, tolerance=ONSET_TOLERANCE):
+    """Compare each event with the closest marker in the file (if two markers
+    are equally close, the first one in the file).
+
+    Parameters
+    ----------
+    events : numpy structured array
+        events with 'onset' and 'value'
+    file_events : numpy structured array
+        markers in the file with 'onset' and 'value' (not empty)
+    tolerance : float
+        maximum difference between the onsets (in s)
+
+    Returns
+    -------
+    numpy array of bool
+        for each event, True if the closest marker has the same onset (within
+        tolerance) and the same value
+
+    Notes
+    -----
+    The markers are sorted once and the closest marker is found with a binary
+    search, so it takes O((N + M) log M) instead of O(N * M).
+    """
+    order = argsort(file_events['onset'], kind='stable')
+    onsets = file_events['onset'][order]
+    x = events['onset']
+
+    # first marker after the event and first marker (of those with the same onset) before
+    after = searchsorted(onsets, x, side='left')
+    before = clip(after - 1, 0, len(onsets) - 1)
+    before = searchsorted(onsets, onsets[before], side='left')
+    after = clip(after, 0, len(onsets) - 1)
+
+    diff_before = abs(onsets[before] - x)
+    diff_after = abs(onsets[after] - x)
+    use_after = (diff_after < diff_before) | ((diff_after == diff_before) & (order[after] < order[before]))
+    closest = where(use_after, order[after], order[before])
+    diff = where(use_after, diff_after, diff_before)
+
+    return ~(diff > tolerance) & (file_events['value'][closest] == events['value'])
+
+
 def read_file_markers(d):
     markers = d.read_markers()
     orig_mrk = empty(len(markers), dtype=[('onset', '<f8'), ('value', '<U8')])
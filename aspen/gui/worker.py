@@ -0,0 +1,415 @@
+"""Read from the database in a background thread, so that the GUI does not
+freeze while it waits for the database.
+
+The worker thread has its own connection (see connection_pool) and the
+functions which run in the worker only return python values (ids, row
+snapshots, arrays), never objects of the api, because those belong to the
+connection of the worker. The GUI creates its own objects from these values
+(see attach_rows and attach_tree), without querying the database again.
+
+Each request has a key (f.e. 'events'). When a new request with the same key
+is submitted, the previous one is cancelled: if it has not started yet, it's
+skipped, otherwise its result is discarded.
+
+The files are checked separately (see FileStatusChecker), because each check
+can take seconds on a network drive.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from PyQt5.QtCore import (
+    Qt,
+    QObject,
+    QThread,
+    pyqtSignal,
+    pyqtSlot,
+    )
+
+from ..api import (
+    load_tree,
+    Subject,
+    Session,
+    Protocol,
+    Run,
+    Recording,
+    Channels,
+    Electrodes,
+    File,
+    )
+from ..api.backend import load_rows
+from ..api.utils import collect_columns, list_channels_electrodes
+from ..database.pool import connection_pool
+
+lg = getLogger(__name__)
+
+# how long (in s) the status of a file is valid
+FILE_STATUS_TTL = 60
+# number of threads which check the files at the same time
+FILE_STATUS_THREADS = 8
+
+LEVEL_CLASSES = {
+    'subject': Subject,
+    'session': Session,
+    'run': Run,
+    'recording': Recording,
+    }
+CLASSES = dict(
+    LEVEL_CLASSES,
+    protocol=Protocol,
+    channel_group=Channels,
+    electrode_group=Electrodes,
+    )
+
+
+class DatabaseWorker(QObject):
+    finished = pyqtSignal(str, int, object)
+    failed = pyqtSignal(str, int, str)
+
+    def __init__(self, pool, latest):
+        super().__init__()
+        self.pool = pool
+        self.latest = latest
+
+    @pyqtSlot(str, int, object, object)
+    def run(self, key, request_id, func, args):
+        if self.latest.get(key) != request_id:
+            return  # cancelled before it started
+
+        try:
+            with self.pool.connection() as worker_db:
+                result = func(worker_db, *args)
+        except Exception as err:
+            lg.warning(f'Could not load {key}: {err}')
+            self.failed.emit(key, request_id, str(err))
+        else:
+            self.finished.emit(key, request_id, result)
+
+    def close(self):
+        # runs in the worker thread, which owns the connection
+        self.pool.close()
+
+
+class DatabaseLoader(QObject):
+    """Run functions in the worker thread and call the callback (in the main
+    thread) with the result.
+
+    Parameters
+    ----------
+    db : dict
+        information about the database (the worker uses its own connection to
+        the same database)
+    """
+    loading = pyqtSignal(bool)
+    _request = pyqtSignal(str, int, object, object)
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self._latest = {}  # key -> id of the last request
+        self._callbacks = {}  # (key, request id) -> callback
+        self._n_requests = 0
+
+        self.thread = QThread()
+        self.worker = DatabaseWorker(connection_pool(db, max_connections=1), self._latest)
+        self.worker.moveToThread(self.thread)
+        self._request.connect(self.worker.run)
+        self.worker.finished.connect(self._finished)
+        self.worker.failed.connect(self._failed)
+        self.thread.finished.connect(self.worker.close, Qt.DirectConnection)
+        self.thread.start()
+
+    @property
+    def pending(self):
+        """Number of requests which are running or waiting"""
+        return len(self._callbacks)
+
+    def submit(self, key, func, *args, callback):
+        """Run func(worker_db, *args) in the worker and then
+        callback(result) in the main thread. The previous request with the
+        same key is cancelled.
+        """
+        self.cancel(key)
+        self._n_requests += 1
+        request_id = self._n_requests
+        self._latest[key] = request_id
+        self._callbacks[(key, request_id)] = callback
+        self.loading.emit(True)
+        self._request.emit(key, request_id, func, args)
+
+    def cancel(self, key=None):
+        """Cancel the requests with this key (all the requests, if None)"""
+        keys = list(self._latest) if key is None else [key, ]
+        for k in keys:
+            request_id = self._latest.pop(k, None)
+            self._callbacks.pop((k, request_id), None)
+        self.loading.emit(self.pending > 0)
+
+    def close(self):
+        self.cancel()
+        self.thread.quit()
+        self.thread.wait()  # the worker closes its connection when it stops
+
+    @pyqtSlot(str, int, object)
+    def _finished(self, key, request_id, result):
+        callback = self._callbacks.pop((key, request_id), None)
+        if self._latest.get(key) == request_id:
+            self._latest.pop(key)
+        self.loading.emit(self.pending > 0)
+        if callback is not None:
+            callback(result)
+
+    @pyqtSlot(str, int, str)
+    def _failed(self, key, request_id, message):
+        self._callbacks.pop((key, request_id), None)
+        if self._latest.get(key) == request_id:
+            self._latest.pop(key)
+        self.loading.emit(self.pending > 0)
+
+
+def read_tree(db, subj_id):
+    """Sessions, runs and recordings of one subject (see load_tree)
+
+    Returns
+    -------
+    dict
+        where the key is (t, id) and the value is a tuple with the row
+        snapshot and the list of the (t, id) of the children
+    """
+    tree = {}
+    for subj in load_tree(db, subset={'subjects': [subj_id, ]}):
+        _walk_tree(subj, tree)
+    return tree
+
+
+def attach_tree(db, tree):
+    """Create (or update) the objects of the main connection with the rows
+    and the children read by read_tree, without querying the database"""
+    objects = {}
+    for (t, id_), (row, children) in tree.items():
+        cls = LEVEL_CLASSES[t]
+        objects[(t, id_)] = cls._from_tree(db, id_, collect_columns(db, cls.t), row=row)
+
+    for key, (row, children) in tree.items():
+        parent = objects[key]
+        parent._children = []
+        for child_key in children:
+            child = objects[child_key]
+            setattr(child, child.parent_level, parent)
+            parent._children.append(child)
+
+
+def read_rows(db, keys):
+    """Row snapshots of some objects
+
+    Parameters
+    ----------
+    keys : list of tuple
+        (t, id) of the objects
+
+    Returns
+    -------
+    dict
+        where the key is (t, id) and the value is the row snapshot
+    """
+    ids = {}
+    for t, id_ in keys:
+        ids.setdefault(t, []).append(id_)
+
+    out = {}
+    for t, level_ids in ids.items():
+        rows = load_rows(db, t, collect_columns(db, t), ids=level_ids)
+        for id_, row in rows.items():
+            out[(t, id_)] = row
+    return out
+
+
+def attach_rows(objs, rows):
+    """Replace the row snapshots of the objects with the rows read by
+    read_rows"""
+    for obj in objs:
+        row = rows.get((obj.t, obj.id))
+        if row is not None:
+            obj._row = row
+
+
+def read_files(db, keys):
+    """Files of some objects, with their rows
+
+    Parameters
+    ----------
+    keys : list of tuple
+        (t, id) of the objects
+
+    Returns
+    -------
+    dict
+        where the key is (t, id) and the value is a list of dict with keys
+        'id' and 'row'
+    """
+    out = {}
+    for t, id_ in keys:
+        obj = CLASSES[t](db, id=id_)
+        files = []
+        for file in obj.list_files():
+            file.format  # read the row snapshot
+            files.append({
+                'id': file.id,
+                'row': file._row,
+                })
+        out[(t, id_)] = files
+    return out
+
+
+def read_files_and_groups(db, keys, session_id=None):
+    """Files of some objects (see read_files) and the channels and electrodes
+    of the session (see read_session_groups, None if session_id is None)"""
+    groups = None if session_id is None else read_session_groups(db, session_id)
+    return read_files(db, keys), groups
+
+
+def read_session_groups(db, session_id):
+    """Channels and electrodes of one session, with their rows
+
+    Returns
+    -------
+    dict
+        where the key is 'channel_group' or 'electrode_group' and the value is
+        a list of tuple with the id and the row snapshot (same order as
+        Session.list_channels and Session.list_electrodes)
+    """
+    out = {}
+    for name, cls in (('channel', Channels), ('electrode', Electrodes)):
+        ids = list_channels_electrodes(db, session_id, name=name)
+        rows = load_rows(db, cls.t, collect_columns(db, cls.t), ids=ids)
+        out[cls.t] = [(id_, rows[id_]) for id_ in ids if id_ in rows]
+    return out
+
+
+def attach_session_groups(db, groups):
+    """Objects of the main connection for the groups read by
+    read_session_groups
+
+    Returns
+    -------
+    list of instances of Channels
+    list of instances of Electrodes
+    """
+    return tuple(
+        [cls._from_tree(db, id_, collect_columns(db, cls.t), row=row) for id_, row in groups[cls.t]]
+        for cls in (Channels, Electrodes))
+
+
+def attach_files(db, files):
+    """Objects of the main connection for the files read by read_files
+
+    Returns
+    -------
+    dict
+        where the key is (t, id) and the value is a list of instances of File
+    """
+    columns = collect_columns(db, File.t)
+    return {
+        key: [File._from_tree(db, f['id'], columns, row=f['row']) for f in obj_files]
+        for key, obj_files in files.items()}
+
+
+class FileStatusChecker(QObject):
+    """Check if the files exist in a pool of threads and keep the results for
+    some time (see file_status).
+
+    Parameters
+    ----------
+    ttl : float
+        how long (in s) the status of a file is valid
+    max_workers : int
+        number of threads which check the files at the same time
+    """
+    checked = pyqtSignal(str, str)  # path, status
+
+    def __init__(self, parent=None, ttl=FILE_STATUS_TTL, max_workers=FILE_STATUS_THREADS):
+        super().__init__(parent)
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='file_status')
+        self._cache = {}  # path -> (status, time of the check)
+        self._pending = set()  # paths which are being checked
+        self._lock = Lock()
+
+    def status(self, path):
+        """Status of the file, if it was checked recently, otherwise None"""
+        path = str(path)
+        with self._lock:
+            status, checked_at = self._cache.get(path, (None, None))
+        if status is not None and monotonic() - checked_at < self.ttl:
+            return status
+
+    def check(self, path):
+        """Status of the file, if it was checked recently. Otherwise, the file
+        is checked in the background, the result is emitted with `checked`
+        (in the main thread) and it returns None."""
+        status = self.status(path)
+        if status is not None:
+            return status
+
+        path = str(path)
+        with self._lock:
+            if path in self._pending:
+                return None
+            self._pending.add(path)
+        future = self.executor.submit(file_status, path)
+        future.add_done_callback(partial(self._done, path))
+
+    def clear(self):
+        """Forget the files which were checked (f.e. when a file was added)"""
+        with self._lock:
+            self._cache = {}
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, path, future):
+        # runs in the thread of the pool
+        if future.cancelled():
+            status = None
+        else:
+            status = future.result()
+        with self._lock:
+            self._pending.discard(path)
+            if status is not None:
+                self._cache[path] = (status, monotonic())
+        if status is not None:
+            self.checked.emit(path, status)
+
+
+def file_status(path):
+    """Check if a file exists, after resolving the path (both might be slow
+    on network drives)
+
+    Returns
+    -------
+    str
+        'exists', 'missing' or 'no permission'
+    """
+    try:
+        path_exists = Path(path).resolve().exists()
+    except PermissionError as err:
+        lg.warning(err)
+        return 'no permission'
+    except OSError as err:  # f.e. the network drive is not available
+        lg.warning(err)
+        return 'missing'
+    return 'exists' if path_exists else 'missing'
+
+
+def read_events(db, run_id):
+    return Run(db, run_id).events
+
+
+def _walk_tree(obj, tree):
+    children = obj._children if obj._children is not None else []
+    tree[(obj.t, obj.id)] = (obj._row, [(child.t, child.id) for child in children])
+    for child in children:
+        _walk_tree(child, tree)
@@ -13,6 +13,7 @@ from ...nibabel import nifti1 as nifti1
 from ...nibabel import parrec as pr
 from ..affines import apply_affine, from_matvec, to_matvec
 from ..filename_parser import splitext_addext
+from ..loadsave import save
 from ..mriutils import MRIError, calculate_dwell_time
 from ..orientations import apply_orientation, inv_ornt_aff, io_orientation
 from ..parrec import one_line
@@ -240,22 +241,12 @@ def error(msg, exit_code):
     sys.exit(exit_code)
 
 
-def proc_file(infile, opts):
-    # figure out the output filename, and see if it exists
-    basefilename = splitext_addext(os.path.basename(infile))[0]
-    if opts.outdir is not None:
-        # set output path
-        basefilename = os.path.join(opts.outdir, basefilename)
-
-    # prep a file
-    if opts.compressed:
-        verbose('Using gzip compression')
-        outfilename = basefilename + '.nii.gz'
-    else:
-        outfilename = basefilename + '.nii'
-    if os.path.isfile(outfilename) and not opts.overwrite:
-        raise OSError(f'Output file "{outfilename}" exists, use --overwrite to overwrite it')
+def make_nifti(infile, opts):
+    """Convert the PAR/REC file to a NIfTI image in memory (without writing it)
 
+    Returns the NIfTI image, the PAR/REC image, the affine which reorients the
+    data and the bvals and bvecs (which are used by proc_file).
+    """
     # load the PAR header and data
     scaling = 'dv' if opts.scaling == 'off' else opts.scaling
     infile = fname_ext_ul_case(infile)
@@ -344,8 +335,30 @@ def proc_file(infile, opts):
             dump_ext = nifti1.Nifti1Extension('comment', hdr_dump)
         nhdr.extensions.append(dump_ext)
 
+    return nimg, pr_img, t_aff, bvals, bvecs
+
+
+def proc_file(infile, opts):
+    # figure out the output filename, and see if it exists
+    basefilename = splitext_addext(os.path.basename(infile))[0]
+    if opts.outdir is not None:
+        # set output path
+        basefilename = os.path.join(opts.outdir, basefilename)
+
+    # prep a file
+    if opts.compressed:
+        verbose('Using gzip compression')
+        outfilename = basefilename + '.nii.gz'
+    else:
+        outfilename = basefilename + '.nii'
+    if os.path.isfile(outfilename) and not opts.overwrite:
+        raise OSError(f'Output file "{outfilename}" exists, use --overwrite to overwrite it')
+
+    nimg, pr_img, t_aff, bvals, bvecs = make_nifti(infile, opts)
+    pr_hdr = pr_img.header
+
     verbose(f'Writing {outfilename}')
-    nibabel.save(nimg, outfilename)
+    save(nimg, outfilename)
 
     # write out bvals/bvecs if requested
     if opts.bvs:
@@ -21,7 +21,7 @@ from .deprecated import deprecate_with_version
 from .filebasedimages import ImageFileError
 from .filename_parser import _stringify_path, splitext_addext
 from .imageclasses import all_image_classes
-from .openers import ImageOpener
+from .openers import ImageOpener, gzip_threads
 
 _compressed_suffixes = ('.gz', '.bz2', '.zst')
 
@@ -151,12 +151,18 @@ def save(img: FileBasedImage, filename: FileSpec, **kwargs) -> None:
     filename : str or os.PathLike
        filename (often implying filenames) to which to save `img`.
     \*\*kwargs : keyword arguments
-        Keyword arguments to format-specific save
+        Keyword arguments to format-specific save. ``gzip_threads`` is the
+        number of threads which compress gz files (see
+        ``openers.gzip_threads``)
 
     Returns
     -------
     None
     """
+    if 'gzip_threads' in kwargs:
+        with gzip_threads(kwargs.pop('gzip_threads')):
+            return save(img, filename, **kwargs)
+
     filename = _stringify_path(filename)
 
     # Save the type as expected
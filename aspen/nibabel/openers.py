@@ -12,8 +12,15 @@ from __future__ import annotations
 
 import gzip
 import io
+import os
+import struct
 import typing as ty
+import zlib
 from bz2 import BZ2File
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from os.path import splitext
 
 from ._compression import HAVE_INDEXED_GZIP, IndexedGzipFile, pyzstd
@@ -78,14 +85,185 @@ class DeterministicGzipFile(gzip.GzipFile):
         )
 
 
+class ParallelGzipFile(io.BufferedIOBase):
+    """Write-only gzip file, compressed by a pool of threads (like pigz)
+
+    The data is split in blocks of ``block_size`` bytes, which are compressed
+    at the same time in different threads. Each block is compressed with the
+    last 32 KiB of the previous block as dictionary and it ends on a byte
+    boundary (``Z_SYNC_FLUSH``), so the compressed blocks are concatenated into
+    one deflate stream. The output is a standard gzip file (one member, no
+    file name, ``mtime`` of 0 by default), which can be read by any gzip
+    reader. The output does not depend on the number of threads (with one
+    thread, the blocks are compressed in the calling thread).
+
+    Parameters
+    ----------
+    filename : str, optional
+        file to write (if `fileobj` is not specified)
+    mode : {'wb', 'w'}
+        only writing is supported
+    compresslevel : int
+        compression level of zlib
+    fileobj : file-like, optional
+        file object where the compressed data is written
+    mtime : int
+        modification time in the gzip header
+    threads : int, optional
+        number of threads (if None, the number of CPUs)
+    """
+
+    #: size (in bytes) of the uncompressed blocks
+    block_size = 2**20
+
+    def __init__(
+        self,
+        filename: str | None = None,
+        mode: Mode = 'wb',
+        compresslevel: int = 9,
+        fileobj: io.IOBase | None = None,
+        mtime: int = 0,
+        threads: int | None = None,
+    ):
+        if mode not in ('w', 'wb'):
+            raise ValueError(f'ParallelGzipFile can only write, not "{mode}"')
+        if fileobj is None:
+            if filename is None:
+                raise TypeError('Must define either fileobj or filename')
+            fileobj = self.myfileobj = open(filename, 'wb')
+        else:
+            self.myfileobj = None
+        if threads is None:
+            threads = os.cpu_count() or 1
+
+        self.name = filename if filename is not None else getattr(fileobj, 'name', '')
+        self.mode = 'wb'
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads
+        if threads > 1:
+            self._executor = ThreadPoolExecutor(threads, thread_name_prefix='gzip')
+        else:
+            self._executor = None
+        self._pending: deque = deque()
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._crc = 0
+        self._size = 0
+
+        if compresslevel == 9:
+            xfl = b'\x02'
+        elif compresslevel == 1:
+            xfl = b'\x04'
+        else:
+            xfl = b'\x00'
+        # magic, deflate, no flags, mtime, extra flags, unknown OS
+        fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(mtime)) + xfl + b'\xff')
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b, /) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        data = memoryview(b).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += data.nbytes
+        self._buffer += data
+
+        n_blocks = len(self._buffer) // self.block_size
+        for i in range(n_blocks):
+            self._submit(bytes(self._buffer[i * self.block_size:(i + 1) * self.block_size]), False)
+        del self._buffer[: n_blocks * self.block_size]
+        return data.nbytes
+
+    def tell(self) -> int:
+        return self._size
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # only to check the position, see volumeutils.seek_tell
+        if whence == 0 and offset == self._size:
+            return self._size
+        raise io.UnsupportedOperation('ParallelGzipFile cannot seek')
+
+    def flush(self) -> None:
+        # the blocks are compressed when they are full or when the file is closed
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), True)
+            self._buffer = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF))
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            if self.myfileobj is not None:
+                self.myfileobj.close()
+                self.myfileobj = None
+            super().close()
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        if self._executor is None:
+            self.fileobj.write(_deflate_block(block, self._zdict, self.compresslevel, last))
+            self._zdict = block[-32768:]
+            return
+        self._pending.append(
+            self._executor.submit(_deflate_block, block, self._zdict, self.compresslevel, last)
+        )
+        self._zdict = block[-32768:]
+        # write the blocks which are ready, so that only a few blocks are kept in memory
+        while len(self._pending) > 2 * self.threads or (self._pending and self._pending[0].done()):
+            self.fileobj.write(self._pending.popleft().result())
+
+
+def _deflate_block(block: bytes, zdict: bytes, compresslevel: int, last: bool) -> bytes:
+    """Raw deflate of one block (zlib releases the GIL while it compresses)"""
+    if zdict:
+        compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY, zdict,
+        )
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+#: number of threads set by gzip_threads (None if not set)
+_GZIP_THREADS: ContextVar[int | None] = ContextVar('gzip_threads', default=None)
+
+
+@contextmanager
+def gzip_threads(threads: int | None):
+    """Number of threads which compress the gz files opened for writing in this
+    context (in the current thread), instead of ``Opener.default_gzip_threads``
+
+    The files are written by ``ParallelGzipFile`` (with one thread per CPU, if
+    `threads` is None), so the bytes do not depend on `threads`.
+    """
+    token = _GZIP_THREADS.set((os.cpu_count() or 1) if threads is None else threads)
+    try:
+        yield
+    finally:
+        _GZIP_THREADS.reset(token)
+
+
 def _gzip_open(
     filename: str,
     mode: Mode = 'rb',
     compresslevel: int = 9,
     mtime: int = 0,
     keep_open: bool = False,
-) -> gzip.GzipFile:
-    if not HAVE_INDEXED_GZIP or mode != 'rb':
+    threads: int | None = None,
+) -> gzip.GzipFile | ParallelGzipFile:
+    if mode in ('w', 'wb') and threads is not None:
+        gzip_file = ParallelGzipFile(filename, mode, compresslevel, mtime=mtime, threads=threads)
+
+    elif not HAVE_INDEXED_GZIP or mode != 'rb':
         gzip_file = DeterministicGzipFile(filename, mode, compresslevel, mtime=mtime)
 
     # use indexed_gzip if possible for faster read access.  If keep_open ==
@@ -122,13 +300,15 @@ class Opener:
         passed to opening method when `fileish` is str.  ``mode``, if not
         specified, is `rb`.  ``compresslevel``, if relevant, and not specified,
         is set from class variable ``default_compresslevel``. ``keep_open``, if
-        relevant, and not specified, is ``False``.
+        relevant, and not specified, is ``False``. ``threads``, for gz files, if
+        not specified, is set by ``gzip_threads`` or from class variable
+        ``default_gzip_threads``.
     \*\*kwargs : keyword arguments
         passed to opening method when `fileish` is str.  Change of defaults as
         for \*args
     """
 
-    gz_def = (_gzip_open, ('mode', 'compresslevel', 'mtime', 'keep_open'))
+    gz_def = (_gzip_open, ('mode', 'compresslevel', 'mtime', 'keep_open', 'threads'))
     bz2_def = (BZ2File, ('mode', 'buffering', 'compresslevel'))
     zstd_def = (_zstd_open, ('mode', 'level_or_option', 'zstd_dict'))
     compress_ext_map: dict[str | None, OpenerDef] = {
@@ -139,6 +319,9 @@ class Opener:
     }
     #: default compression level when writing gz and bz2 files
     default_compresslevel = 1
+    #: default number of threads which compress the gz files with
+    #: ParallelGzipFile (None uses gzip)
+    default_gzip_threads: int | None = None
     #: default option for zst files
     default_zst_compresslevel = 3
     default_level_or_option = {
@@ -170,6 +353,11 @@ class Opener:
         # Default compression level
         if 'compresslevel' in arg_names and 'compresslevel' not in kwargs:
             kwargs['compresslevel'] = self.default_compresslevel
+        if 'threads' in arg_names and 'threads' not in kwargs:
+            threads = _GZIP_THREADS.get()
+            if threads is None:
+                threads = self.default_gzip_threads
+            kwargs['threads'] = threads
         if 'level_or_option' in arg_names and 'level_or_option' not in kwargs:
             kwargs['level_or_option'] = self.default_level_or_option[mode]
         # Default keep_open hint
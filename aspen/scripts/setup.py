@@ -32,6 +32,7 @@ setup(
     entry_points={
         'console_scripts': [
             'aspen=aspen.gui.main:main',
+            'aspen-snapshot=aspen.database.snapshot:main',
         ],
     },
 )
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""Benchmark the main hot paths of the API on a synthetic SQLite database.
+
+The schema is parsed from the MySQL dumps in tests/data/example/sql, so the
+SQLite database has the same tables, subtables and allowed values as the test
+database. It's filled with synthetic data and the results are written to a
+json file, which can be compared across versions.
+
+Examples
+--------
+    python benchmarks/benchmark_api.py --output results.json
+    python benchmarks/benchmark_api.py --subjects 200 --events 1000 --only list_subjects,events_read
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from json import dump
+from logging import getLogger, ERROR
+from pathlib import Path
+from platform import python_version, platform
+from statistics import median
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from numpy import arange, nan
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtSql import QSqlQuery
+
+from aspen import __version__
+from aspen.api import list_subjects, load_tree, Run, Channels
+from aspen.api.backend import insert_rows
+from aspen.database import access_database, close_database
+from aspen.database.sqlite import (
+    create_sqlite_database,
+    open_sqlite_database,
+    parse_sql_dump,
+    )
+
+lg = getLogger('aspen')
+
+SQL_DIR = Path(__file__).resolve().parents[1] / 'tests' / 'data' / 'example' / 'sql'
+
+SESSION_NAMES = ('IEMU', 'MRI', 'OR', 'CT')
+TASK_NAMES = ('motor', 'rest', 'picnam', 'mario')
+# modalities which do not need any file, so that create_bids only uses the metadata
+MODALITIES = {
+    'IEMU': 'ieeg',
+    'OR': 'ieeg',
+    'MRI': 'ct',
+    'CT': 'ct',
+    }
+
+
+def main(arguments=None):
+    parser = ArgumentParser(prog='benchmark aspen API on a synthetic SQLite database')
+    parser.add_argument(
+        '--output', default='benchmark_results.json',
+        help='json file with the results')
+    parser.add_argument('--subjects', type=int, default=50, help='number of subjects')
+    parser.add_argument('--sessions', type=int, default=3, help='number of sessions per subject')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per session')
+    parser.add_argument('--recordings', type=int, default=1, help='number of recordings per run')
+    parser.add_argument('--events', type=int, default=100, help='number of events per run')
+    parser.add_argument('--channels', type=int, default=64, help='number of channels per channel group')
+    parser.add_argument('--repeat', type=int, default=5, help='number of repetitions of each benchmark')
+    parser.add_argument(
+        '--only', default=None,
+        help='comma-separated list of benchmarks to run (default: all)')
+    args = parser.parse_args(arguments)
+
+    lg.setLevel(ERROR)  # create_bids warns about the missing data
+    app = QCoreApplication.instance() or QCoreApplication([])  # noqa: F841
+
+    sizes = {
+        'subjects': args.subjects,
+        'sessions': args.sessions,
+        'runs': args.runs,
+        'recordings': args.recordings,
+        'events': args.events,
+        'channels': args.channels,
+        }
+    only = None if args.only is None else args.only.split(',')
+
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / 'benchmark.sqlite'
+        t0 = perf_counter()
+        db = create_synthetic_database(db_path, **sizes)
+        fill_time = perf_counter() - t0
+        close_database(db)
+
+        results = run_benchmarks(db_path, Path(tmp_dir), args.repeat, only)
+
+    output = {
+        'aspen_version': __version__,
+        'python_version': python_version(),
+        'platform': platform(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'command': ' '.join(argv),
+        'sizes': sizes,
+        'repeat': args.repeat,
+        'fill_time': fill_time,
+        'benchmarks': results,
+        }
+    with Path(args.output).open('w') as f:
+        dump(output, f, indent=2)
+
+    for name, r in results.items():
+        print(f'{name:<24} {r["median"] * 1000:10.1f} ms (min {r["min"] * 1000:.1f} ms)')
+
+
+def create_synthetic_database(db_path, subjects, sessions, runs, recordings, events, channels):
+    """Create a SQLite database with the schema of the test database and fill
+    it with synthetic data.
+
+    Returns
+    -------
+    dict
+        information about the database
+    """
+    tables, subtables = parse_sql_dump(sorted(SQL_DIR.glob('*.sql')))
+    db = create_sqlite_database(db_path, tables, subtables, connectionName='benchmark')
+
+    db['db'].transaction()
+    subj_ids = list(range(1, subjects + 1))
+    insert_rows(db, 'subjects', ['id', 'date_of_birth', 'sex'], [
+        [i, f'{1950 + i % 50}-01-01', ('Female', 'Male')[i % 2]] for i in subj_ids])
+    insert_rows(db, 'subject_codes', ['subject_id', 'code'], [
+        [i, f'sub{i:05d}'] for i in subj_ids])
+    insert_rows(db, 'protocols', ['id', 'subject_id', 'metc', 'date_of_signature'], [
+        [i, i, '14-090', '2015-01-01'] for i in subj_ids])
+
+    sess_rows = []
+    run_rows = []
+    rec_rows = []
+    start = datetime(2015, 1, 1, 9, 0, 0)
+    for subj_id in subj_ids:
+        for i in range(sessions):
+            sess_id = len(sess_rows) + 1
+            name = SESSION_NAMES[i % len(SESSION_NAMES)]
+            sess_rows.append([sess_id, subj_id, name])
+            for j in range(runs):
+                run_id = len(run_rows) + 1
+                start_time = start + timedelta(days=subj_id, hours=i, minutes=j)
+                run_rows.append([
+                    run_id, sess_id, TASK_NAMES[j % len(TASK_NAMES)],
+                    f'{start_time:%Y-%m-%d %H:%M:%S}.000'])
+                for k in range(recordings):
+                    rec_rows.append([len(rec_rows) + 1, run_id, MODALITIES[name]])
+
+    insert_rows(db, 'sessions', ['id', 'subject_id', 'name'], sess_rows)
+    insert_rows(db, 'runs', ['id', 'session_id', 'task_name', 'start_time'], run_rows)
+    insert_rows(db, 'recordings', ['id', 'run_id', 'modality'], rec_rows)
+
+    event_rows = []
+    for run_id, *_ in run_rows:
+        for onset in range(events):
+            event_rows.append([run_id, float(onset), 1., 'stim', str(onset % 4)])
+    insert_rows(db, 'events', ['run_id', 'onset', 'duration', 'trial_type', 'value'], event_rows)
+
+    # one channel group for each ephys recording
+    ephys_ids = [rec[0] for rec in rec_rows if rec[2] == 'ieeg']
+    insert_rows(db, 'channel_groups', ['id', 'name'], [
+        [i, f'group{i}'] for i in ephys_ids])
+    chan_rows = []
+    for group_id in ephys_ids:
+        for i in range(channels):
+            chan_rows.append([group_id, f'chan{i:03d}', 'ECOG', 'μV'])
+    insert_rows(db, 'channels', ['channel_group_id', 'name', 'type', 'units'], chan_rows)
+    query = QSqlQuery(db['db'])
+    if not query.exec('UPDATE recordings_ephys SET channel_group_id = recording_id'):
+        raise SyntaxError(query.lastError().text())
+    db['db'].commit()
+
+    return db
+
+
+def run_benchmarks(db_path, tmp_dir, repeat, only=None):
+    """Time each benchmark. Each benchmark opens the database, so that the
+    objects and the row snapshots are not shared between benchmarks.
+
+    Returns
+    -------
+    dict
+        for each benchmark, the list of 'times', 'min' and 'median' (in s)
+    """
+    results = {}
+    for name, (setup, func) in BENCHMARKS.items():
+        if only is not None and name not in only:
+            continue
+
+        times = []
+        for i in range(repeat):
+            db = open_sqlite_database(db_path, connectionName='benchmark')
+            args = setup(db, tmp_dir) if setup is not None else ()
+            t0 = perf_counter()
+            func(db, *args)
+            times.append(perf_counter() - t0)
+            del args
+            close_database(db)
+
+        results[name] = {
+            'times': times,
+            'min': min(times),
+            'median': median(times),
+            }
+
+    return results
+
+
+def bench_access_database(db):
+    """Open a second connection to the same file, as a read-only snapshot"""
+    db = access_database(db['db'].databaseName())
+    close_database(db)
+
+
+def bench_list_subjects(db):
+    list_subjects(db)
+    list_subjects(db, alphabetical=True)
+
+
+def bench_traverse(db):
+    """Walk the tree one level at a time (one query per object)"""
+    for subj in list_subjects(db):
+        for sess in subj.list_sessions():
+            for run in sess.list_runs():
+                run.task_name
+                for rec in run.list_recordings():
+                    rec.modality
+
+
+def bench_load_tree(db):
+    for subj in load_tree(db):
+        for sess in subj.list_sessions():
+            for run in sess.list_runs():
+                run.task_name
+                for rec in run.list_recordings():
+                    rec.modality
+
+
+def _first_run(db, tmp_dir):
+    return (Run(db, 1), )
+
+
+def bench_events_read(db, run):
+    run.events
+
+
+def bench_events_write(db, run):
+    events = run.events
+    run.events = events
+
+
+def _first_channels(db, tmp_dir):
+    query = QSqlQuery(db['db'])
+    query.exec('SELECT MIN(id) FROM channel_groups')
+    query.next()
+    chan = Channels(db, query.value(0))
+    data = chan.empty(len(chan.data))
+    data['name'] = [f'chan{i:03d}' for i in range(len(data))]
+    data['type'] = 'ECOG'
+    data['low_cutoff'] = arange(len(data))
+    data['high_cutoff'] = nan
+    return chan, data
+
+
+def bench_channels_write(db, chan, data):
+    chan.data = data
+
+
+def bench_search(db):
+    from aspen.gui.actions import Search
+
+    search = Search()
+    search.where(db, "runs.task_name = 'motor'")
+    search.where(db, "sessions.name = 'MRI' AND recordings.modality = 'ct'")
+
+
+def _bids_dir(db, tmp_dir):
+    return (tmp_dir / 'bids', )
+
+
+def bench_create_bids(db, bids_dir):
+    from aspen.bids import create_bids
+
+    create_bids(db, bids_dir)
+
+
+# name: (setup, benchmark); setup returns the extra arguments of the benchmark
+BENCHMARKS = {
+    'access_database': (None, bench_access_database),
+    'list_subjects': (None, bench_list_subjects),
+    'traverse_tree': (None, bench_traverse),
+    'load_tree': (None, bench_load_tree),
+    'events_read': (_first_run, bench_events_read),
+    'events_write': (_first_run, bench_events_write),
+    'channels_write': (_first_channels, bench_channels_write),
+    'search_where': (None, bench_search),
+    'create_bids': (_bids_dir, bench_create_bids),
+    }
+
+
+if __name__ == '__main__':
+    main()
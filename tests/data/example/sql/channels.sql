@@ -6,6 +6,7 @@ CREATE TABLE `channel_groups` (
 ) ;
 
 CREATE TABLE `channels` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
   `channel_group_id` int(11) DEFAULT NULL,
   `name` text DEFAULT NULL COMMENT 'Name: Label of the channel. The label must correspond to _electrodes.tsv name and all ieeg type channels are required to have a position.',
   `type` text DEFAULT NULL COMMENT 'Type: Type of channel.',
@@ -18,6 +19,7 @@ CREATE TABLE `channels` (
   `notch` float DEFAULT NULL COMMENT 'Notch Filter: Frequencies used for the notch filter applied to the channel, in Hz. If no notch filter applied, use n/a.',
   `status` text DEFAULT NULL COMMENT 'Status: Data quality observed on the channel (good/bad). A channel is considered bad if its data quality is compromised by excessive noise. Description of noise type SHOULD be provided in [status_description].',
   `status_description` text DEFAULT NULL COMMENT 'Status Description: Freeform text description of noise or artifact affecting data quality on the channel. It is meant to explain why the channel was declared bad in [status].',
+  PRIMARY KEY (`id`),
   KEY `channel_group_id` (`channel_group_id`),
   CONSTRAINT `channels_ibfk_1` FOREIGN KEY (`channel_group_id`) REFERENCES `channel_groups` (`id`) ON DELETE CASCADE
 ) ;
@@ -72,6 +72,7 @@ END ;;
 DELIMITER ;
 
 CREATE TABLE `electrodes` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
   `electrode_group_id` int(11) DEFAULT NULL,
   `name` text DEFAULT NULL COMMENT 'Name: Name of the electrode contact point.',
   `x` float DEFAULT NULL COMMENT 'x: X position. The positions of the center of each electrode in xyz space. Units are in millimeters or pixels',
@@ -85,6 +86,7 @@ CREATE TABLE `electrodes` (
   `type` text DEFAULT NULL COMMENT 'Type: Optional type of the electrode, e.g., cup, ring, clip-on, wire, needle, ...',
   `impedance` float DEFAULT NULL COMMENT 'Impedance: Impedance of the electrode in kOhm.',
   `dimension` text DEFAULT NULL COMMENT 'Dimension: Size of the group (grid/strip/probe) that this electrode belongs to. Must be of form [AxB] with the smallest dimension first (e.g., [1x8]).',
+  PRIMARY KEY (`id`),
   KEY `electrode_group_id` (`electrode_group_id`),
   CONSTRAINT `electrodes_ibfk_1` FOREIGN KEY (`electrode_group_id`) REFERENCES `electrode_groups` (`id`) ON DELETE CASCADE
 ) ;
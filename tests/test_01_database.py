@@ -1,6 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtSql import QSqlQuery
+from pytest import raises
+
 from aspen.database import access_database, close_database
+from aspen.database.cache import load_schema, schema_cache_path
+from aspen.database.instrument import (
+    instrumentation_stats,
+    normalize_sql,
+    reset_instrumentation,
+    start_instrumentation,
+    stop_instrumentation,
+    write_instrumentation_report,
+    )
+from aspen.database.sqlite import (
+    create_sqlite_database,
+    open_sqlite_database,
+    parse_sql_dump,
+    )
+from aspen.database.pool import connection_pool
+from aspen.database.snapshot import (
+    create_snapshot,
+    install_change_tracking,
+    refresh_snapshot,
+    remove_change_tracking,
+    )
+from aspen.api import list_subjects, Run, Subject
 
-from .paths import DB_ARGS
+from .paths import DB_ARGS, DATA_DIR
 
 
 def test_open(qtbot):
@@ -11,3 +38,151 @@ def test_open(qtbot):
     assert len(db['db'].tables()) == len(db['tables'])
 
     close_database(db)
+
+
+def test_schema_cache(qtbot, tmp_path):
+    db = access_database(**DB_ARGS, schema_cache=False)
+
+    # first time, it parses the schema and writes the cache
+    tables, subtables = load_schema(db['info'], db['db'], cache_dir=tmp_path)
+    assert schema_cache_path(db['db'], tmp_path).exists()
+    assert tables == db['tables']
+    assert subtables == db['subtables']
+
+    # second time, it reads the cache
+    tables, subtables = load_schema(db['info'], db['db'], cache_dir=tmp_path)
+    assert tables == db['tables']
+    assert subtables == db['subtables']
+
+    close_database(db)
+
+
+def test_instrumentation(qtbot, tmp_path):
+    assert normalize_sql("SELECT id FROM runs WHERE id IN (1, 2, 3) AND task_name = 'rest'") == 'SELECT id FROM runs WHERE id IN (...) AND task_name = ?'
+    assert normalize_sql('INSERT INTO events (`onset`, `value`)\n VALUES (?, ?), (?, ?)') == 'INSERT INTO events (`onset`, `value`) VALUES (?, ?), ...'
+
+    db = access_database(**DB_ARGS)
+
+    reset_instrumentation()
+    start_instrumentation()
+    for subj in list_subjects(db):
+        subj.date_of_birth
+    stop_instrumentation()
+
+    stats = instrumentation_stats()
+    assert sum(x['calls'] for x in stats) > 1
+    assert all('test_01_database.py' in x['call_site'] for x in stats)
+
+    report_file = tmp_path / 'report.json'
+    write_instrumentation_report(report_file)
+    assert report_file.exists()
+
+    # the statements are counted in all the threads
+    pool = connection_pool(db, max_connections=4)
+
+    def run_statements(i):
+        with pool.connection() as worker_db:
+            query = QSqlQuery(worker_db['db'])
+            for _ in range(100):
+                query.exec('SELECT 1')
+
+    reset_instrumentation()
+    start_instrumentation()
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(run_statements, range(4)))
+    stop_instrumentation()
+    assert sum(x['calls'] for x in instrumentation_stats() if x['sql'] == 'SELECT ?') == 400
+
+    close_database(db)
+
+
+def test_sqlite(qtbot, tmp_path):
+    tables, subtables = parse_sql_dump(sorted((DATA_DIR / 'example' / 'sql').glob('*.sql')))
+    assert 'MRI' in tables['sessions']['name']['values']
+
+    db_path = tmp_path / 'aspen.sqlite'
+    db = create_sqlite_database(db_path, tables, subtables, connectionName='test_sqlite')
+    subj = Subject.add(db, 'sqlite_subject')
+    sess = subj.add_session('MRI')
+    sess.MagneticFieldStrength = '3T'
+    close_database(db)
+
+    db = open_sqlite_database(db_path, connectionName='test_sqlite')
+    assert db['tables'] == tables
+    subj = Subject(db, 'sqlite_subject')
+    assert subj.list_sessions()[0].MagneticFieldStrength == '3T'
+    close_database(db)
+
+    # the rows deleted by ON DELETE CASCADE cannot be used, even if the object is in use
+    db = open_sqlite_database(db_path, connectionName='test_sqlite')
+    sess = Subject(db, 'sqlite_subject').list_sessions()[0]
+    run = sess.add_run('motor')
+    assert Run(db, id=run.id) is run
+    sess.delete()
+    with raises(ValueError):
+        Run(db, id=run.id)
+    close_database(db)
+
+    # unknown types are stored as text
+    sql_file = tmp_path / 'unknown.sql'
+    sql_file.write_text('CREATE TABLE `unknown` (\n  `id` int(11) NOT NULL,\n  `value` json DEFAULT NULL\n);\n')
+    tables, _ = parse_sql_dump([sql_file, ])
+    assert tables['unknown']['value']['type'] == 'QString'
+
+
+def test_snapshot(qtbot, tmp_path):
+    db = access_database(**DB_ARGS)
+    snapshot_path = tmp_path / 'snapshot.sqlite'
+    create_snapshot(db, snapshot_path)
+    assert not db.get('transaction', False)  # the read transaction is closed
+    codes = [subj.codes for subj in list_subjects(db)]
+    close_database(db)
+
+    db = access_database(str(snapshot_path))
+    assert db['info'] is None
+    assert [subj.codes for subj in list_subjects(db)] == codes
+    close_database(db)
+
+
+def test_snapshot_refresh(qtbot, tmp_path):
+    db = access_database(**DB_ARGS)
+    install_change_tracking(db)
+
+    snapshot_path = tmp_path / 'snapshot.sqlite'
+    assert refresh_snapshot(db, snapshot_path) is None  # full copy
+    assert refresh_snapshot(db, snapshot_path) == 0
+
+    subj = Subject.add(db, 'refreshed_subject')
+    subj.add_session('MRI')
+    assert refresh_snapshot(db, snapshot_path) > 0
+
+    subj.delete()
+    refresh_snapshot(db, snapshot_path)
+    remove_change_tracking(db)
+    close_database(db)
+
+    db = access_database(str(snapshot_path))
+    assert 'refreshed_subject' not in [code for subj in list_subjects(db) for code in subj.codes]
+    close_database(db)
+
+
+def test_connection_pool(qtbot):
+    db = access_database(**DB_ARGS)
+    pool = connection_pool(db, max_connections=2)
+    ids = [subj.id for subj in list_subjects(db)]
+
+    def n_sessions(subj_id):
+        with pool.connection() as worker_db:
+            assert worker_db['db'].connectionName() != db['db'].connectionName()
+            return len(Subject(worker_db, id=subj_id).list_sessions())
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(n_sessions, ids))
+    assert results == [len(Subject(db, id=i).list_sessions()) for i in ids]
+    assert len(pool) == 0  # each thread closed its connection when it exited
+
+    with pool.connection() as worker_db:  # main thread
+        assert worker_db is db
+
+    close_database(db)
+    assert len(pool) == 0
@@ -1,9 +1,10 @@
 from datetime import datetime, date
 from pytest import raises
-from numpy import empty
+from numpy import concatenate, empty
 
-from aspen.api import Subject, list_subjects, Electrodes, Channels, File
+from aspen.api import Subject, list_subjects, list_subject_codes, load_tree, load_files, Electrodes, Channels, File
 from aspen.api.filetype import parse_filetype
+from aspen.api.utils import prepared_query, sort_subjects_alphabetical, sort_subjects_date
 from aspen.database import access_database, close_database, add_allowed_value
 
 from .paths import TRC_PATH, DB_ARGS, T1_PATH
@@ -36,6 +37,16 @@ def test_api_subject():
     assert len(subj.codes) == 2
     assert str(subj) == 'rubble, zuma'
 
+    # the same statement is prepared only once
+    n_statements = len(db['statements'])
+    subj.refresh()
+    assert len(subj.codes) == 2
+    assert len(db['statements']) == n_statements
+    statement = 'SELECT code FROM subject_codes WHERE subject_codes.subject_id = :id'
+    assert prepared_query(db, statement) is prepared_query(db, statement)
+    # the whitespace in the literals is part of the statement
+    assert prepared_query(db, "SELECT subject_id FROM subject_codes WHERE code = 'a  b'") is not prepared_query(db, "SELECT subject_id FROM subject_codes WHERE code = 'a b'")
+
     close_database(db)
 
 
@@ -97,6 +108,11 @@ def test_api_run():
     run.duration = 10
     assert run.duration == 10
 
+    # values are read again from the database
+    run.refresh()
+    assert run.duration == 10
+    assert run.start_time == fake_time
+
     with raises(ValueError):
         sess.add_run('xxx')
 
@@ -198,6 +214,40 @@ def test_api_events():
     assert events['duration'][5] == 3
     assert events['trial_type'][5] == 'test'
 
+    # only send the differences
+    events = run.read_events(primary_key=True)
+    events['trial_type'][5] = 'changed'
+    new_event = events[:1].copy()
+    new_event['id'] = 0
+    new_event['onset'] = 20
+    run.update_events(concatenate([events[1:], new_event]))
+
+    events = run.events
+    assert events.shape == (10, )
+    assert events['onset'][0] == 1
+    assert events['onset'][-1] == 20
+    assert events['trial_type'][4] == 'changed'
+
+    # strings longer than the stored ones are not cut
+    long_type = 'a much longer trial type than the others'
+    events['trial_type'][0] = long_type
+    run.events = events
+    assert run.events['trial_type'][0] == long_type
+
+    # the ids are assigned again when the events are copied to another run
+    other_run = [x for x in sess.list_runs() if x != run][0]
+    other_run.events = run.read_events(primary_key=True)
+    assert (other_run.events == run.events).all()
+    other_run.events = None
+
+    # databases without the primary key: delete and insert
+    id_info = db['tables']['events'].pop('id')
+    events = run.read_events(primary_key=True)
+    assert (events['id'] == 0).all()
+    run.update_events(events[:5])
+    assert run.events.shape == (5, )
+    db['tables']['events']['id'] = id_info
+
     close_database(db)
 
 
@@ -246,6 +296,67 @@ def test_api_sorting():
     Subject.add(db, 'chase')
     assert len(list_subjects(db)) == 3
 
+    # sorting in one query gives the same order as sorting each subject
+    for alphabetical in (True, False):
+        for reverse in (True, False):
+            subjects = [Subject(db, id=subj.id) for subj in list_subjects(db)]
+            key = sort_subjects_alphabetical if alphabetical else sort_subjects_date
+            assert list_subjects(db, alphabetical, reverse) == sorted(subjects, key=key, reverse=reverse)
+            assert list_subject_codes(db, alphabetical, reverse) == [
+                (subj.id, subj.codes) for subj in list_subjects(db, alphabetical, reverse)]
+
+    close_database(db)
+
+
+def test_api_load_tree():
+    db = access_database(**DB_ARGS)
+
+    subjects = load_tree(db)
+    assert set(subjects) == set(list_subjects(db))
+
+    for subj in subjects:
+        sessions = subj.list_sessions()
+        assert sessions == Subject(db, id=subj.id).list_sessions()
+        for sess in sessions:
+            assert sess.subject == subj
+            for run in sess.list_runs():
+                assert run.session == sess
+                for rec in run.list_recordings():
+                    assert rec.run == run
+
+    subj = subjects[0]
+    subjects = load_tree(db, subset={'subjects': [subj.id, ]})
+    assert subjects == [subj, ]
+
+    # only one object for each row
+    assert subjects[0] is subj
+    assert Subject(db, id=subj.id) is subj
+
+    # the children of the objects in use are not restricted by the subset
+    sessions = subj.list_sessions()
+    subj.refresh()
+    load_tree(db, subset={'subjects': [subj.id, ], 'sessions': [sessions[0].id, ]})
+    assert subj.list_sessions() == sessions
+
+    close_database(db)
+
+
+def test_api_load_files():
+    db = access_database(**DB_ARGS)
+
+    subjects = list_subjects(db)
+    file = subjects[0].add_file(parse_filetype(TRC_PATH), TRC_PATH)
+
+    assert load_files(db, subjects) == subjects
+    assert subjects[0].list_files() == [file, ]
+    assert subjects[0].list_files()[0].format == 'micromed'
+    for subj in subjects[1:]:
+        assert subj.list_files() == []
+
+    # the files are read again after deleting one
+    subjects[0].delete_file(file)
+    assert subjects[0].list_files() == []
+
     close_database(db)
 
 
@@ -1,4 +1,7 @@
+import gzip
 from datetime import datetime
+from io import BytesIO
+from os import urandom
 
 from aspen.api import Subject, Run
 from aspen.io.tsv import save_tsv, load_tsv
@@ -6,6 +9,7 @@ from aspen.io.parrec import add_parrec
 from aspen.database import access_database, close_database
 from aspen.io.ephys import add_ephys_to_sess
 from aspen.io.channels import create_channels
+from aspen.nibabel.openers import ParallelGzipFile
 
 from .paths import TSV_PATH, T1_PATH, TRC_PATH, DB_ARGS
 
@@ -51,3 +55,25 @@ def test_import_ieeg():
     rec.attach_channels(chan)
 
     close_database(db)
+
+
+def test_parallel_gzip(monkeypatch):
+    monkeypatch.setattr(ParallelGzipFile, 'block_size', 1000)  # many blocks
+    data = urandom(2500) + bytes(4000) + urandom(1234)
+
+    outputs = []
+    for threads in (1, 2, 4):
+        f_out = BytesIO()
+        with ParallelGzipFile(fileobj=f_out, threads=threads) as f:
+            for i in range(0, len(data), 777):  # writes which do not match the blocks
+                f.write(data[i:i + 777])
+        assert gzip.decompress(f_out.getvalue()) == data
+        outputs.append(f_out.getvalue())
+
+    # the bytes do not depend on the number of threads
+    assert outputs[0] == outputs[1] == outputs[2]
+
+    f_out = BytesIO()
+    with ParallelGzipFile(fileobj=f_out, threads=2):
+        pass
+    assert gzip.decompress(f_out.getvalue()) == b''
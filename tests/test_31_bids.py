@@ -0,0 +1,165 @@
+from pathlib import Path
+
+from pytest import raises
+
+from aspen.bids.root import create_bids, _chain_tasks, _update_dataset
+from aspen.bids.manifest import task_key
+from aspen.bids.plan import plan_bids, save_plan, load_plan, rebase_plan
+from aspen.bids.estimate import estimate_plan, STAGES
+from aspen.database import access_database, close_database
+
+from .paths import DB_ARGS
+
+
+def _task(name, *writes):
+    return {'name': name, 'writes': [Path(f) for f in writes]}
+
+
+def test_bids_chain_tasks():
+    tasks = [
+        _task('a', 'sub-1/func/run-1_bold.nii.gz'),
+        _task('b', 'sub-1/func/run-2_bold.nii.gz'),
+        _task('c', 'sub-1/anat/T1w.nii.gz'),
+        _task('d', 'sub-1/func/run-2_bold.nii.gz', 'sub-1/func/run-1_bold.nii.gz'),  # joins a and b
+        _task('e', 'sub-1/anat/T1w.nii.gz'),
+        _task('f', 'sub-1/func/run-1_bold.nii.gz'),
+        ]
+
+    chains = _chain_tasks(tasks)
+    assert [[task['name'] for task in chain] for chain in chains] == [
+        ['a', 'b', 'd', 'f'],
+        ['c', 'e'],
+        ]
+
+    assert _chain_tasks([]) == []
+
+
+def test_bids_update_dataset(tmp_path):
+    data_path = tmp_path / 'bids'
+    func = data_path / 'sub-1' / 'func'
+    tasks = [
+        _task('unchanged', func / 'run-1_bold.nii.gz', func / 'run-1_bold.json'),
+        _task('changed', func / 'run-2_bold.nii.gz', func / 'run-2_bold.json'),
+        _task('missing', func / 'run-3_events.tsv'),
+        _task('unchanged_shared', func / 'run-4_events.tsv', func / 'shared.tsv'),
+        _task('changed_shared', func / 'run-5_events.tsv', func / 'shared.tsv'),
+        ]
+    for i, task in enumerate(tasks):
+        task.update(kind='events', run_id=i + 1)
+    plan = {
+        'data_path': data_path,
+        'tasks': tasks,
+        'directories': [func, ],
+        'scans': [],
+        'sessions_json': [],
+        }
+
+    fingerprints = {task_key(task, data_path): task['name'] for task in tasks}
+    old_tasks = {
+        task_key(task, data_path): {
+            'fingerprint': task['name'],
+            'outputs': [str(f.relative_to(data_path)) for f in task['writes']],
+            } for task in tasks}
+    old_tasks[task_key(tasks[1], data_path)]['fingerprint'] = 'old'
+    old_tasks[task_key(tasks[4], data_path)]['fingerprint'] = 'old'
+    old_tasks['events 9 sub-1/func/run-9_events.tsv'] = {  # run which was removed
+        'fingerprint': 'removed',
+        'outputs': ['sub-1/func/run-9_events.tsv', ],
+        }
+    manifest = {
+        'tasks': old_tasks,
+        'files': ['participants.tsv', 'sub-2/sub-2_scans.tsv'],
+        'directories': ['sub-1/func', 'sub-2', 'sub-2/anat'],
+        }
+
+    for old in old_tasks.values():
+        for f in old['outputs']:
+            (data_path / f).parent.mkdir(parents=True, exist_ok=True)
+            (data_path / f).write_text(f)
+    (func / 'run-3_events.tsv').unlink()
+    for f in manifest['files']:
+        (data_path / f).parent.mkdir(parents=True, exist_ok=True)
+        (data_path / f).write_text(f)
+    (data_path / 'sub-2' / 'anat').mkdir()
+
+    to_convert = _update_dataset(plan, manifest, fingerprints)
+    assert [task['name'] for task in to_convert] == [
+        'changed', 'missing', 'unchanged_shared', 'changed_shared']
+
+    # the files which are up-to-date are kept, the others are removed
+    assert sorted(str(f.relative_to(data_path)) for f in data_path.rglob('*') if f.is_file()) == [
+        'participants.tsv',
+        'sub-1/func/run-1_bold.json',
+        'sub-1/func/run-1_bold.nii.gz',
+        ]
+    assert not (data_path / 'sub-2').exists()
+
+
+def test_bids_plan_and_subset(tmp_path):
+    with raises(ValueError):
+        create_bids(None, tmp_path, subset={'subjects': [1, ]}, plan={'tasks': []})
+
+
+def test_bids_plan_round_trip(tmp_path):
+    db = access_database(**DB_ARGS)
+
+    plan = plan_bids(db, tmp_path / 'a' / 'bids')
+    assert len(plan['tasks']) > 0
+    json_file = tmp_path / 'plan.json'
+    save_plan(plan, json_file)
+
+    assert load_plan(json_file) == plan
+    assert rebase_plan(plan, plan['data_path']) is plan
+
+    # paths are stored relative to the root BIDS directory
+    new_path = tmp_path / 'b' / 'bids'
+    moved = load_plan(json_file, new_path)
+    assert moved == rebase_plan(plan, new_path)
+    assert moved['data_path'] == new_path
+    assert all(new_path in task['dest_path'].parents for task in moved['tasks'])
+    assert rebase_plan(moved, plan['data_path']) == plan
+
+    json_file.write_text(json_file.read_text().replace('"version"', '"old_version"'))
+    with raises(ValueError):
+        load_plan(json_file)
+
+    close_database(db)
+
+
+def test_bids_estimate(tmp_path):
+    db = access_database(**DB_ARGS)
+
+    plan = plan_bids(db, tmp_path / 'bids')
+    estimate = estimate_plan(db, plan)
+
+    planned = {f['path'] for f in estimate['files']}
+    assert all(task['output'] in planned for task in plan['tasks'])
+    assert all(f['stage'] in STAGES for f in estimate['files'])
+    assert estimate['size'] == sum(f['size'] for f in estimate['files'] if f['size'] is not None)
+    assert estimate['size'] > 0
+    assert estimate['total_time'] == sum(estimate['time'].values())
+
+    # the dry run does not write anything
+    assert not (tmp_path / 'bids').exists()
+
+    close_database(db)
+
+
+def test_bids_n_workers(tmp_path):
+    db = access_database(**DB_ARGS)
+
+    # same name, because the name of the folder is in dataset_description.json
+    create_bids(db, tmp_path / 'serial' / 'bids', deface=False, n_workers=1)
+    create_bids(db, tmp_path / 'parallel' / 'bids', deface=False, n_workers=2)
+
+    serial = _read_dataset(tmp_path / 'serial' / 'bids')
+    assert len(serial) > 0
+    assert serial == _read_dataset(tmp_path / 'parallel' / 'bids')
+
+    close_database(db)
+
+
+def _read_dataset(data_path):
+    return {
+        str(f.relative_to(data_path)): f.read_bytes()
+        for f in sorted(data_path.rglob('*')) if f.is_file()}